@@ -0,0 +1,91 @@
+"""Benchmarks the row loops iotrans runs over a CSV dump
+
+Usage (from a CKAN environment with this extension installed):
+    python benchmarks/row_pipeline.py [rows]
+
+Geometry reprojection is skipped, so the timings show the cost of reading,
+reshaping and writing rows rather than the cost of PROJ.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+from ckanext.iotrans import utils
+
+
+FIELDNAMES = ["_id"] + ["field_{}".format(i) for i in range(12)] + ["geometry"]
+GEOMETRY = '{"type": "Point", "coordinates": [-79.1, 43.2]}'
+
+
+def best_of(fn, runs=3):
+    """returns the fastest of a few runs of fn, in seconds"""
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(rows):
+    dir_path = tempfile.mkdtemp()
+    dump_filepath = os.path.join(dir_path, "dump.csv")
+    output_filepath = os.path.join(dir_path, "output.csv")
+    nonspatial_filepath = os.path.join(dir_path, "nonspatial.csv")
+    col_map = {
+        fieldname: fieldname[:7] + str(i)
+        for i, fieldname in enumerate(FIELDNAMES)
+    }
+
+    rng = random.Random(1)
+    records = [
+        [i] + ["value {}".format(rng.randint(0, 10 ** 6)) for _ in range(12)]
+        + [GEOMETRY]
+        for i in range(rows)
+    ]
+
+    # measure the row handling, not the reprojection
+    utils.transform_epsg = lambda source_epsg, target_epsg, geometry: geometry
+    utils._geometry_to_json = lambda geometry: geometry
+
+    timings = {
+        "write_to_csv (dump)": best_of(lambda: utils.write_to_csv(
+            dump_filepath, FIELDNAMES, iter(records)
+        )),
+        "transform_dump_epsg": best_of(lambda: utils.write_to_csv(
+            output_filepath, FIELDNAMES, utils.transform_dump_epsg(
+                dump_filepath, FIELDNAMES, 4326, 4326
+            )
+        )),
+        "dump_to_geospatial_generator (shp)": best_of(lambda: sum(
+            1 for _ in utils.dump_to_geospatial_generator(
+                dump_filepath, FIELDNAMES, "shp", 4326, 4326, col_map
+            )
+        )),
+    }
+    utils.write_to_csv(
+        nonspatial_filepath, FIELDNAMES[:-1], (row[:-1] for row in records)
+    )
+    timings["write_to_xml"] = best_of(lambda: utils.write_to_xml(
+        nonspatial_filepath, os.path.join(dir_path, "output.xml")
+    ), runs=1)
+
+    for name, seconds in timings.items():
+        print("{:<40}{:>8.3f}s".format(name, seconds))
+
+    tracemalloc.start()
+    sum(1 for _ in utils.dump_to_geospatial_generator(
+        dump_filepath, FIELDNAMES, "shp", 4326, 4326, col_map
+    ))
+    print("{:<40}{:>8.1f}KB".format(
+        "peak memory, geospatial generator",
+        tracemalloc.get_traced_memory()[1] / 1024,
+    ))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,90 @@
+"""Benchmarks what loading iotrans costs a CKAN worker at startup
+
+Usage (from a CKAN environment with this extension installed):
+    python benchmarks/startup.py [path/to/ckan.ini] [runs]
+
+Each case runs in a fresh python process, and reports how long it took
+and the resident memory of the process after it. With a CKAN config file,
+whole CKAN apps are built with it too, with and without
+ckanext.iotrans.preload_gdal - the config should enable the iotrans plugin.
+"""
+
+import sys
+import json
+import subprocess
+
+
+MEASURE = """
+import sys
+import json
+import time
+started = time.perf_counter()
+{code}
+seconds = time.perf_counter() - started
+rss_kb = 0
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(json.dumps({{
+    "seconds": seconds,
+    "rss_kb": rss_kb,
+    "gdal": "fiona" in sys.modules,
+}}))
+"""
+
+CASES = {
+    "python": "pass",
+    "import plugin": "import ckanext.iotrans.plugin",
+    "import plugin + preload_gdal": (
+        "import ckanext.iotrans.plugin\n"
+        "from ckanext.iotrans import utils\n"
+        "utils.preload_gdal()"
+    ),
+}
+
+MAKE_APP = """
+from ckan.cli import load_config
+from ckan.config.middleware import make_app
+config = load_config({config_path!r})
+config["ckanext.iotrans.preload_gdal"] = {preload!r}
+make_app(config)
+"""
+
+
+def measure(code, runs):
+    """runs code in fresh processes, returns its fastest run"""
+    results = []
+    for _ in range(runs):
+        stdout = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(code=code)],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+        results.append(json.loads(stdout.strip().splitlines()[-1]))
+    return min(results, key=lambda result: result["seconds"])
+
+
+def main(config_path=None, runs=5):
+    cases = dict(CASES)
+    if config_path:
+        for preload in ["false", "true"]:
+            cases["ckan app, preload_gdal = " + preload] = MAKE_APP.format(
+                config_path=config_path, preload=preload
+            )
+
+    print("{:<40}{:>10}{:>12}{:>8}".format("", "seconds", "RSS MB", "GDAL"))
+    for name, code in cases.items():
+        result = measure(code, runs)
+        print("{:<40}{:>10.3f}{:>12.1f}{:>8}".format(
+            name,
+            result["seconds"],
+            result["rss_kb"] / 1024,
+            "yes" if result["gdal"] else "no",
+        ))
+
+
+if __name__ == "__main__":
+    main(
+        sys.argv[1] if len(sys.argv) > 1 else None,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    )
@@ -0,0 +1,328 @@
+'''Reads and writes the geometry encodings iotrans supports
+
+Datastore geometry columns can hold GeoJSON (even python repr'd, with
+single quotes), WKT or hex encoded WKB. Each is turned into a GeoJSON-like
+dict, the way transform_epsg expects geometries.
+
+Only the standard library is used here, so tile building processes can
+import it cheaply.
+'''
+
+import re
+import json
+import struct
+
+
+# WKB geometry type codes, and the GeoJSON types they stand for
+WKB_TYPES = {
+    1: "Point",
+    2: "LineString",
+    3: "Polygon",
+    4: "MultiPoint",
+    5: "MultiLineString",
+    6: "MultiPolygon",
+    7: "GeometryCollection",
+}
+GEOJSON_TO_WKB_TYPES = {name: code for code, name in WKB_TYPES.items()}
+WKT_TYPES = {name.upper(): name for name in WKB_TYPES.values()}
+
+# EWKB flags, as written by PostGIS
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+HEX_DIGITS = re.compile(r"^(00|01)[0-9A-Fa-f]+$")
+WKT_HEADER = re.compile(
+    r"^\s*(?:SRID=\d+;)?\s*([A-Za-z]+)\s*(ZM|Z|M)?\s*", re.IGNORECASE
+)
+WKT_POSITION = re.compile(r"[-+.\deE]+(?:\s+[-+.\deE]+)+")
+
+
+def parse_geometry(value):
+    '''Returns a GeoJSON-like dict of a GeoJSON, WKT or hex WKB string'''
+    value = value.strip()
+    if value.startswith("{"):
+        return json.loads(value.replace("'", '"'))  # replace '' with ""
+    if len(value) % 2 == 0 and HEX_DIGITS.match(value):
+        return parse_wkb(bytes.fromhex(value))
+    return parse_wkt(value)
+
+
+def parse_wkb(data):
+    '''Returns a GeoJSON-like dict of WKB or EWKB bytes'''
+    return _read_wkb(data, 0)[0]
+
+
+def _read_wkb(data, offset):
+    '''Reads a WKB geometry at offset, returns it and where it ends'''
+    order = "<" if data[offset] == 1 else ">"
+    code, = struct.unpack_from(order + "I", data, offset + 1)
+    offset += 5
+
+    # dimensions are flagged in EWKB, or in the thousands in ISO WKB
+    base = code & 0x0FFFFFFF
+    has_z = bool(code & EWKB_Z) or base // 1000 in [1, 3]
+    has_m = bool(code & EWKB_M) or base // 1000 in [2, 3]
+    if code & EWKB_SRID:
+        offset += 4
+    geometry_type = WKB_TYPES[base % 1000]
+    dimensions = 2 + has_z + has_m
+
+    def positions(count):
+        nonlocal offset
+        values = struct.unpack_from(
+            "{}{}d".format(order, count * dimensions), data, offset
+        )
+        offset += 8 * count * dimensions
+        # GeoJSON has no room for M values
+        size = 3 if has_z else 2
+        return [
+            list(values[i:i + size])
+            for i in range(0, len(values), dimensions)
+        ]
+
+    def count():
+        nonlocal offset
+        number, = struct.unpack_from(order + "I", data, offset)
+        offset += 4
+        return number
+
+    if geometry_type == "Point":
+        coordinates = positions(1)[0]
+        # an empty point is written as NaNs
+        if coordinates[0] != coordinates[0]:
+            coordinates = []
+        return {"type": geometry_type, "coordinates": coordinates}, offset
+    if geometry_type == "LineString":
+        return {
+            "type": geometry_type, "coordinates": positions(count())
+        }, offset
+    if geometry_type == "Polygon":
+        return {
+            "type": geometry_type,
+            "coordinates": [positions(count()) for _ in range(count())],
+        }, offset
+
+    parts = []
+    for _ in range(count()):
+        part, offset = _read_wkb(data, offset)
+        parts.append(part)
+    if geometry_type == "GeometryCollection":
+        return {"type": geometry_type, "geometries": parts}, offset
+    return {
+        "type": geometry_type,
+        "coordinates": [part["coordinates"] for part in parts],
+    }, offset
+
+
+def _wkt_parts(body):
+    '''Splits the body of a WKT GEOMETRYCOLLECTION into its geometries'''
+    parts, depth, start = [], 0, 0
+    for i, character in enumerate(body):
+        if character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+        elif character == "," and depth == 0:
+            parts.append(body[start:i])
+            start = i + 1
+    parts.append(body[start:])
+    return [part for part in parts if part.strip()]
+
+
+def parse_wkt(value):
+    '''Returns a GeoJSON-like dict of a WKT or EWKT string'''
+    header = WKT_HEADER.match(value)
+    if not header:
+        raise ValueError("Unreadable geometry: {}".format(value[:50]))
+    name = header.group(1).upper()
+    dimensions = (header.group(2) or "").upper()
+    geometry_type = WKT_TYPES.get(name, None)
+    if not geometry_type:
+        raise ValueError("Unreadable geometry: {!r}".format(value[:50]))
+    body = value[header.end():].strip()
+
+    if body.upper() == "EMPTY":
+        if geometry_type == "GeometryCollection":
+            return {"type": geometry_type, "geometries": []}
+        return {"type": geometry_type, "coordinates": []}
+
+    if geometry_type == "GeometryCollection":
+        return {
+            "type": geometry_type,
+            "geometries": [parse_wkt(part) for part in _wkt_parts(body[1:-1])],
+        }
+
+    # GeoJSON has no room for M values
+    size = 3 if "Z" in dimensions else 2
+
+    # turn "x y, x y" into "[x, y], [x, y]" and brackets into lists,
+    # so json can do the parsing
+    coordinates = json.loads(
+        WKT_POSITION.sub(
+            lambda match: "[" + ",".join(match.group(0).split()[:size]) + "]",
+            re.sub(r"\bEMPTY\b", "", body, flags=re.IGNORECASE),
+        ).replace("(", "[").replace(")", "]")
+    )
+
+    if geometry_type == "Point":
+        coordinates = coordinates[0]
+    elif geometry_type == "MultiPoint":
+        # MULTIPOINT (1 2, 3 4) and MULTIPOINT ((1 2), (3 4)) are both valid
+        coordinates = [
+            position[0] if isinstance(position[0], list) else position
+            for position in coordinates
+        ]
+    return {"type": geometry_type, "coordinates": coordinates}
+
+
+def _wkt_number(value):
+    '''formats a coordinate as short as it can be read back exactly'''
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e16:
+        return str(int(value))
+    return repr(value)
+
+
+def _wkt_coordinates(coordinates):
+    '''formats nested coordinates as WKT'''
+    if not isinstance(coordinates[0], (list, tuple)):
+        return " ".join(map(_wkt_number, coordinates))
+    return "(" + ", ".join(map(_wkt_coordinates, coordinates)) + ")"
+
+
+def to_wkt(geometry):
+    '''Returns the WKT of a geometry, or "" if there is none'''
+    if geometry is None:
+        return ""
+    geometry_type = geometry["type"]
+    name = geometry_type.upper()
+    if geometry_type == "GeometryCollection":
+        parts = geometry.get("geometries", None) or []
+        if not parts:
+            return name + " EMPTY"
+        return "{} ({})".format(name, ", ".join(map(to_wkt, parts)))
+
+    coordinates = geometry["coordinates"]
+    if not coordinates:
+        return name + " EMPTY"
+    if _has_z(coordinates):
+        name += " Z"
+    if geometry_type == "Point":
+        return "{} ({})".format(name, _wkt_coordinates(coordinates))
+    if geometry_type == "MultiPoint":
+        return "{} ({})".format(
+            name, ", ".join(
+                ["(" + _wkt_coordinates(position) + ")"
+                 for position in coordinates]
+            )
+        )
+    return name + " " + _wkt_coordinates(coordinates)
+
+
+def _has_z(coordinates):
+    '''Returns whether nested coordinates have a Z value'''
+    while coordinates and isinstance(coordinates[0], (list, tuple)):
+        coordinates = coordinates[0]
+    return len(coordinates) > 2
+
+
+def _write_wkb(geometry, has_z, chunks):
+    '''Appends the little endian ISO WKB of a geometry to chunks'''
+    geometry_type = geometry["type"]
+    code = GEOJSON_TO_WKB_TYPES[geometry_type] + (1000 if has_z else 0)
+    chunks.append(struct.pack("<BI", 1, code))
+    size = 3 if has_z else 2
+
+    def positions(values):
+        flat = []
+        for position in values:
+            flat.extend(position[:size])
+            # 2D positions in a 3D geometry get a Z of 0
+            flat.extend([0.0] * (size - len(position)))
+        chunks.append(struct.pack("<{}d".format(len(flat)), *flat))
+
+    if geometry_type == "GeometryCollection":
+        parts = geometry.get("geometries", None) or []
+        chunks.append(struct.pack("<I", len(parts)))
+        for part in parts:
+            _write_wkb(part, has_z, chunks)
+        return
+
+    coordinates = geometry["coordinates"]
+    if geometry_type == "Point":
+        positions([coordinates or [float("nan")] * size])
+    elif geometry_type == "LineString":
+        chunks.append(struct.pack("<I", len(coordinates)))
+        positions(coordinates)
+    elif geometry_type == "Polygon":
+        chunks.append(struct.pack("<I", len(coordinates)))
+        for ring in coordinates:
+            chunks.append(struct.pack("<I", len(ring)))
+            positions(ring)
+    else:
+        chunks.append(struct.pack("<I", len(coordinates)))
+        for part in coordinates:
+            _write_wkb(
+                {"type": geometry_type[5:], "coordinates": part},
+                has_z, chunks,
+            )
+
+
+def to_wkb(geometry):
+    '''Returns the hex encoded WKB of a geometry, or "" if there is none'''
+    if geometry is None:
+        return ""
+    chunks = []
+    if geometry["type"] == "GeometryCollection":
+        has_z = any(
+            _has_z(part.get("coordinates", None) or [])
+            for part in geometry.get("geometries", None) or []
+        )
+    else:
+        has_z = _has_z(geometry["coordinates"])
+    _write_wkb(geometry, has_z, chunks)
+    return b"".join(chunks).hex().upper()
+
+
+def simplify_line(positions, tolerance, min_positions):
+    '''Douglas-Peucker simplification of a list of positions
+
+    Keeps the line as is if simplifying it would leave fewer than
+    min_positions positions
+    '''
+    if len(positions) <= min_positions:
+        return positions
+
+    squared_tolerance = tolerance * tolerance
+    keep = [False] * len(positions)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(positions) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = positions[first][0], positions[first][1]
+        dx = positions[last][0] - x1
+        dy = positions[last][1] - y1
+        squared_length = dx * dx + dy * dy
+
+        # find the position furthest from the segment first-last
+        furthest, furthest_distance = None, squared_tolerance
+        for i in range(first + 1, last):
+            px, py = positions[i][0] - x1, positions[i][1] - y1
+            if squared_length:
+                t = min(1, max(0, (px * dx + py * dy) / squared_length))
+                px, py = px - t * dx, py - t * dy
+            distance = px * px + py * py
+            if distance > furthest_distance:
+                furthest, furthest_distance = i, distance
+
+        if furthest is not None:
+            keep[furthest] = True
+            stack.append((first, furthest))
+            stack.append((furthest, last))
+
+    simplified = [
+        position for position, kept in zip(positions, keep) if kept
+    ]
+    if len(simplified) < min_positions:
+        return positions
+    return simplified
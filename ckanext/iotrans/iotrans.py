@@ -1,17 +1,24 @@
-"""the to_file() and prune() functions
+"""the to_file(), to_file_bulk(), to_file_plan(), to_file_progress(),
+to_file_queue_status() and prune() functions
 These function are the top level logic for this extension's CKAN actions
 """
 import ckan.plugins.toolkit as tk
+import ckan.model as model
+import ckan.authz as authz
 from ckan.common import config
 
 import tempfile
 import shutil
 import os
-import json
-import fiona
+import time
+import flask
+import random
+import cProfile
 import logging
-from fiona.crs import from_epsg
-from . import utils
+import functools
+import itertools
+from concurrent.futures import wait, FIRST_COMPLETED
+from . import utils, scheduler, progress, tiles
 
 
 @tk.side_effect_free
@@ -22,6 +29,29 @@ def to_file(context, data_dict):
         source_epsg: source EPSG of resource ID, if data is spatial
         target_epsgs: list of desired EPSGs of output files, if data is spatial
         target_formats: list of desired file formats
+        profile: profile this call, sysadmins only (optional)
+        gpkg_bulk_load: write gpkg outputs in bulk load mode (optional)
+        shp_compression: stored, deflate or zstd, to zip shp outputs with
+            (optional)
+        partition_rows: split each output into parts of at most this many
+            rows (optional)
+        fields: list of fields to export (optional)
+        filters: dict of datastore_search filters records must match
+            (optional)
+        bbox: [min x, min y, max x, max y] in source_epsg, records whose
+            geometry intersects it are exported (optional)
+        coordinate_precision: decimal places to round output coordinates to
+            (optional)
+        simplify_tolerance: simplify lines and polygons by this distance,
+            in source_epsg units (optional)
+        geometry_encoding: geojson, wkt or wkb, to write csv geometries in
+            (optional)
+        tile_min_zoom, tile_max_zoom, tile_simplify, tile_drop_rate: how to
+            build mbtiles outputs (optional)
+        bundle: true, "zip" or "tar", to also add every output to one
+            archive as it's written (optional)
+        error_policy: fail, skip or null - what to do with a row whose
+            geometry can't be read or reprojected (optional, default fail)
 
     a spatial datasets needs a geometry column
     assumes geometry column in dataset contains geometry
@@ -31,53 +61,129 @@ def to_file(context, data_dict):
     outputs:
         writes desired files to folder in /tmp
         returns a list of filepaths, where the outputs are stored on disk
+        if the call was profiled, "profile" is the filepath of its profile
+        outputs split by partition_rows are a dict of the filepath of their
+            "index", and the filepaths of their "parts"
+        if bundle was asked for, "bundle" is the filepath of the archive
+        if rows were skipped or nulled by error_policy, "errors" is the
+            filepath of a CSV of their _id, EPSG and error
+        "manifest" has the size in bytes, md5, sha256 and rows of each
+            output, keyed like the outputs
     '''
 
     logging.info("[ckanext-iotrans] Starting iotrans.to_file")
 
-    # create a temp directory to store the file we create on disk
-    dir_path = tempfile.mkdtemp(dir=config.get("ckan.storage_path"))
+    # Make sure the inputs point to a datastore resource
+    resource_metadata = _validate_inputs(context, data_dict)
 
-    # all the outputs of this action will be stored here
-    output = {}
+    # Only sysadmins can ask for a profile of their call
+    if (tk.asbool(data_dict.get("profile", False))
+            and not authz.is_sysadmin(context.get("user", None))):
+        raise tk.NotAuthorized("Only sysadmins can profile to_file")
 
-    # Make sure a resource id is provided
-    if not data_dict.get("resource_id", None):
-        raise tk.ValidationError(
-            {"constraints": ["Input CKAN 'resource_id' required!"]}
-        )
+    # If configured, wait in the export queue behind other exports
+    # Exports run from the queue (ex: to_file_bulk) dont get queued again
+    export_scheduler = scheduler.get_scheduler()
+    if (tk.asbool(config.get("ckanext.iotrans.queue_to_file", False))
+            and not export_scheduler.in_worker()):
+        return export_scheduler.submit(
+            _in_request_context(_run_export, context, data_dict),
+            utils.estimate_export_cost(data_dict, context),
+        ).result()
 
-    # make sure target_formats is provided in a list
-    if not isinstance(data_dict.get("target_formats", None), list):
+    # publish progress for to_file_progress to read
+    # _export counts its stages once it knows whether the data is spatial
+    export_progress = progress.ExportProgress(data_dict["resource_id"])
+    # progress is kept per resource, so its exports can't overlap
+    if not export_progress.acquire():
         raise tk.ValidationError(
             {
                 "constraints": [
-                    "Required input 'target_formats' be a list of strings"
+                    "An export of resource {} is already running".format(
+                        data_dict["resource_id"]
+                    )
                 ]
             }
         )
 
-    # Make sure the resource id provided is for a datastore resource
-    resource_metadata = tk.get_action("resource_show")(
-        context, {"id": data_dict["resource_id"]}
-    )
-    if (resource_metadata.get("datastore_active", None) in
-            ["false", "False", False]):
-        raise tk.ValidationError(
-            {
-                "constraints": [
-                    data_dict["resource_id"] + " is not a datastore resource!"
-                ]
-            }
+    # create a temp directory to store the file we create on disk
+    # if a scratch path is set, only finished outputs go to storage
+    dir_path = tempfile.mkdtemp(dir=utils.get_scratch_path())
+    published_path = None
+    # profile this call if asked to, or if it was sampled for profiling
+    profiler = _get_profiler(data_dict)
+    try:
+        if profiler:
+            output = profiler.runcall(
+                _export,
+                context, data_dict, resource_metadata, dir_path, export_progress
+            )
+            output["profile"] = utils.write_profile(
+                profiler, dir_path, resource_metadata["name"]
+            )
+        else:
+            output = _export(
+                context, data_dict, resource_metadata, dir_path, export_progress
+            )
+
+        if utils.get_scratch_path() != config.get("ckan.storage_path"):
+            published_path = tempfile.mkdtemp(
+                dir=config.get("ckan.storage_path")
+            )
+            output = utils.publish_outputs(output, published_path)
+            shutil.rmtree(dir_path, ignore_errors=True)
+    except Exception as e:
+        export_progress.finish(error=e)
+        # half written outputs are no use to anyone
+        shutil.rmtree(dir_path, ignore_errors=True)
+        if published_path:
+            shutil.rmtree(published_path, ignore_errors=True)
+        raise
+    finally:
+        utils.forget_digests(dir_path)
+    export_progress.finish()
+
+    logging.info("[ckanext-iotrans] finished file creation")
+
+    return output
+
+
+def _export(context, data_dict, resource_metadata, dir_path, export_progress):
+    '''Writes the dump and every output requested from to_file'''
+
+    # all the outputs of this action will be stored here
+    # with their sizes, checksums and row counts in the manifest
+    output = {}
+    manifest = {}
+    partition_rows = data_dict.get("partition_rows", None)
+
+    # outputs go into the bundle as soon as they're written, if asked for
+    bundle = None
+    if data_dict.get("bundle", None):
+        bundle = utils.Bundle(
+            utils.create_filepath(
+                dir_path, resource_metadata["name"] + " bundle", None,
+                data_dict["bundle"],
+            ),
+            data_dict["bundle"],
         )
 
+    # only the fields and records asked for are read from the datastore
+    query = utils.datastore_query(data_dict)
     datastore_resource = tk.get_action("datastore_search")(
-        context, {"resource_id": data_dict["resource_id"]}
+        context, dict(query, resource_id=data_dict["resource_id"])
     )
+    export_progress.total = datastore_resource["total"]
 
     # get fieldnames for the resource
     fieldnames = [field["id"] for field in datastore_resource["fields"]]
 
+    # inputs that depend on the fields are checked before anything is dumped
+    _validate_field_inputs(data_dict, fieldnames)
+    export_progress.stage_count = _count_stages(
+        data_dict, "geometry" in fieldnames
+    )
+
     # create working CSV dump filepath. This file will be used for all outputs
     # We will use it as an output if we're not dealing w geometric data
     # We will not use it as an output if we are dealing w geometric data
@@ -94,14 +200,34 @@ def to_file(context, data_dict):
         data_dict.get("source_epsg", None), 
         dump_suffix
     )
-    utils.write_to_csv(
+    started = time.time()
+    export_progress.stage("dump")
+    dump_counter = itertools.count()
+    # spatial dumps are indexed, to reproject them a range at a time
+    dump_index = utils.write_to_csv(
         dump_filepath, 
         fieldnames, 
-        utils.dump_generator(
-            data_dict["resource_id"],
-            fieldnames,
-            context,
-        )
+        utils.count_rows(
+            utils.dump_generator(
+                data_dict["resource_id"],
+                fieldnames,
+                context,
+                export_progress,
+                query,
+                data_dict.get("bbox", None),
+                data_dict["error_policy"] != "fail",
+            ),
+            dump_counter,
+        ),
+        index="geometry" in fieldnames,
+    )
+    # every output has the rows of the dump, which bbox may have narrowed
+    dump_rows = next(dump_counter)
+    export_progress.total = dump_rows
+    # time each step, so to_file_plan can estimate how long exports take
+    utils.record_throughput(
+        "dump", "geometry" in fieldnames, datastore_resource["total"],
+        time.time() - started,
     )
 
     # We now have our working dump file. The request tells us how to use it
@@ -111,54 +237,62 @@ def to_file(context, data_dict):
     if "geometry" in fieldnames:
         logging.info("[ckanext-iotrans] Geometric iotrans transformation started")
 
-        if not data_dict.get("source_epsg", None):
-            raise tk.ValidationError({"constraints":
-                                     ["Input 'source_epsg' required!"]})
-
-        # make sure inputs are correctly formatted
-        if isinstance(data_dict.get("target_epsgs", None), int):
-            data_dict["target_epsgs"] = list(data_dict["target_epsgs"])
-        if isinstance(data_dict.get("target_formats", None), str):
-            data_dict["target_formats"] = list(data_dict["target_formats"])
-
-        # throw an error if input target_epsgs is not a list of integers
-        if not all([isinstance(item, int)
-                    for item in data_dict["target_epsgs"]]):
-            raise tk.ValidationError(
-                {
-                    "constraints": [
-                        "Input 'target_epsgs' needs to be a list of integers"
-                    ]
-                }
+        zip_compression = utils.get_zip_compression(data_dict)
+        # GDAL and PROJ are only loaded once a spatial export needs them
+        fiona = utils.load_gdal()
+        from fiona.crs import from_epsg
+        geometry_options = utils.get_geometry_options(data_dict)
+        tile_options = utils.get_tile_options(data_dict)
+        # outputs in the same EPSG reproject each geometry once between them,
+        # and each output spreads it over reproject_workers processes
+        geometry_cache = None
+        reproject_workers = utils.get_process_workers("reproject_workers")
+        if len(data_dict["target_formats"]) > 1 or reproject_workers > 1:
+            geometry_cache = utils.GeometryCache(
+                dir_path,
+                dump_filepath,
+                dump_index,
+                reproject_workers,
+                keep=len(data_dict["target_formats"]) > 1,
+            )
+        # rows whose geometry fails are skipped or nulled, if asked for
+        row_errors = None
+        if data_dict["error_policy"] != "fail":
+            row_errors = utils.RowErrors(
+                utils.create_filepath(
+                    dir_path, resource_metadata["name"] + " errors", None,
+                    "csv",
+                ),
+                data_dict["error_policy"],
             )
 
         # for each target EPSG...
         for target_epsg in data_dict["target_epsgs"]:
             # for each target format...
             for target_format in data_dict["target_formats"]:
+                # vector tiles are always web mercator, so they're built once
+                if (target_format.lower() == "mbtiles"
+                        and target_epsg != data_dict["target_epsgs"][0]):
+                    continue
                 logging.info("[ckanext-iotrans] starting {}-{}".format(target_format, str(target_epsg)))
+                started = time.time()
+                # stages are named like the outputs they write
+                export_progress.stage("{}-{}".format(
+                    target_format,
+                    tiles.EPSG if target_format.lower() == "mbtiles"
+                    else target_epsg,
+                ))
+                # its files go into the bundle as they're written
+                if bundle:
+                    bundle.stream()
 
                 # init fiona driver list
                 drivers = {
                     "shp": "ESRI Shapefile",
                     "geojson": "GeoJSON",
+                    "geojsonseq": "GeoJSONSeq",
                     "gpkg": "GPKG",
                 }
-                if (
-                    target_format.lower() not in drivers.keys()
-                    and target_format.lower() != "csv"
-                ):
-                    raise tk.ValidationError(
-                        {
-                            "constraints": ['''
-                                "Input target_format '{target_format}' must be
-                                in the following: {accepted_formats}'''.format(
-                                    target_format=target_format,
-                                    accepted_formats=", ".join(drivers.keys()),
-                                )
-                            ]
-                        }
-                    )
 
                 # If the format+epsg combo match the dump, 
                 # process and add dump to output.
@@ -172,15 +306,25 @@ def to_file(context, data_dict):
                     output_filepath = utils.create_filepath(
                         dir_path, resource_metadata["name"], target_epsg, "csv"
                     )
-                    utils.write_to_csv(
+                    output_filepath = _write_output(
                         output_filepath,
-                        fieldnames,
                         utils.transform_dump_epsg(
                             dump_filepath,
                             fieldnames,
                             data_dict["source_epsg"],
                             target_epsg,
+                            export_progress,
+                            encoding=data_dict.get(
+                                "geometry_encoding", None
+                            ) or "geojson",
+                            geometry_cache=geometry_cache,
+                            errors=row_errors,
+                            **geometry_options
+                        ),
+                        lambda filepath, rows, offset: utils.write_to_csv(
+                            filepath, fieldnames, rows
                         ),
+                        partition_rows,
                     )
 
                     output = utils.append_to_output(
@@ -196,33 +340,59 @@ def to_file(context, data_dict):
                     output_filepath = utils.create_filepath(
                         dir_path, resource_metadata["name"], target_epsg, "csv"
                     )
-                    utils.write_to_csv(
+                    output_filepath = _write_output(
                         output_filepath,
-                        fieldnames,
                         utils.transform_dump_epsg(
                             dump_filepath,
                             fieldnames,
                             data_dict["source_epsg"],
                             target_epsg,
+                            export_progress,
+                            encoding=data_dict.get(
+                                "geometry_encoding", None
+                            ) or "geojson",
+                            geometry_cache=geometry_cache,
+                            errors=row_errors,
+                            **geometry_options
                         ),
+                        lambda filepath, rows, offset: utils.write_to_csv(
+                            filepath, fieldnames, rows
+                        ),
+                        partition_rows,
                     )
                     output = utils.append_to_output(
                         output, target_format, target_epsg, output_filepath
                     )
 
+                # vector tiles are cut from features in EPSG 4326
+                elif target_format.lower() == "mbtiles":
+                    output_filepath = utils.create_filepath(
+                        dir_path, resource_metadata["name"],
+                        tiles.EPSG, target_format)
+                    tiles.write_to_mbtiles(
+                        output_filepath,
+                        utils.dump_to_geospatial_generator(
+                            dump_filepath,
+                            fieldnames,
+                            target_format,
+                            data_dict["source_epsg"],
+                            4326,
+                            progress=export_progress,
+                            fields=datastore_resource["fields"],
+                            geometry_cache=geometry_cache,
+                            errors=row_errors,
+                        ),
+                        resource_metadata["name"],
+                        **tile_options
+                    )
+                    output = utils.append_to_output(
+                        output, target_format, tiles.EPSG, output_filepath
+                    )
+
                 # if format doesnt match the dump, get fiona drivers involved
                 elif target_format.lower() in drivers.keys():
 
                     # first, we need to build a schema
-                    ckan_to_fiona_typemap = {
-                        "text": "str",
-                        "date": "str",
-                        "timestamp": "str",
-                        "float": "float",
-                        "int": "int",
-                        "numeric": "float",
-                        "time": "str",
-                    }
                     # Get Point, Line, or Polygon from the first row of data
                     geom_type_map = {
                         "Point": "MultiPoint",
@@ -233,16 +403,13 @@ def to_file(context, data_dict):
                         "MultiPolygon": "MultiPolygon",
                     }
                     # and convert to multi (ex point to multipoint) and single quotes to double quotes                 
-                    geometry_type = geom_type_map[json.loads(datastore_resource["records"][0]["geometry"].replace("'", '"'))["type"]]
+                    geometry_type = geom_type_map[utils.first_geometry_type(
+                        datastore_resource["records"], row_errors is not None
+                    )]
                     # Get all the field data types (other than geometry)
                     # Map them to fiona data types
                     fields_metadata = {
-                        field["id"]: ckan_to_fiona_typemap[
-                            "".join(
-                                [char for char in field["type"]
-                                    if not char.isdigit()]
-                            )
-                        ]
+                        field["id"]: utils.fiona_type(field["type"])
                         for field in datastore_resource["fields"]
                         if field["id"] != "geometry"
                     }
@@ -252,24 +419,44 @@ def to_file(context, data_dict):
                         dir_path, resource_metadata["name"],
                         target_epsg, target_format)
 
-                    if target_format.lower() != "shp":
-                        with fiona.open(
-                            output_filepath,
-                            "w",
-                            schema=schema,
-                            driver=drivers[target_format],
-                            crs=from_epsg(target_epsg),
-                        ) as outlayer:
-                            outlayer.writerecords(
-                                utils.dump_to_geospatial_generator(
-                                    dump_filepath,
-                                    fieldnames,
-                                    target_format,
-                                    data_dict["source_epsg"],
-                                    target_epsg,
-                                )
+                    col_map = None
+
+                    if target_format.lower() == "geojson":
+                        # GeoJSON is plain text - we write it ourselves
+                        def write(filepath, features, offset):
+                            utils.write_to_geojson(
+                                filepath, features, target_epsg,
+                                geometry_options["precision"],
+                            )
+
+                    elif target_format.lower() == "geojsonseq":
+                        # one feature per line, nothing to close at the end
+                        def write(filepath, features, offset):
+                            utils.write_to_geojsonseq(
+                                filepath, features,
+                                geometry_options["precision"],
                             )
-                            outlayer.close()
+
+                    elif target_format.lower() != "shp":
+                        # GeoPackages can be bulk loaded - see get_gpkg_options
+                        gdal_options = {}
+                        layer_options = {}
+                        if target_format.lower() == "gpkg":
+                            gdal_options = utils.get_gpkg_options(data_dict)
+                            # GDAL fills the R-tree after the last feature
+                            layer_options["SPATIAL_INDEX"] = "YES"
+
+                        def write(filepath, features, offset):
+                            with fiona.Env(**gdal_options), fiona.open(
+                                filepath,
+                                "w",
+                                schema=schema,
+                                driver=drivers[target_format],
+                                crs=from_epsg(target_epsg),
+                                **layer_options
+                            ) as outlayer:
+                                outlayer.writerecords(features)
+                                outlayer.close()
 
                     elif target_format.lower() == "shp":
                         # Shapefiles are special
@@ -293,86 +480,741 @@ def to_file(context, data_dict):
                             working_schema["properties"] = {}
                             for field in datastore_resource["fields"]:
                                 if field["id"] != "geometry":
-                                    this_type = ckan_to_fiona_typemap[
-                                            "".join(
-                                                [
-                                                    char
-                                                    for char in field["type"]
-                                                    if not char.isdigit()
-                                                ]
-                                            )
-                                        ]
+                                    this_type = utils.fiona_type(field["type"])
                                     name = field["id"][:7] + str(i)
                                     col_map[field["id"]] = name
                                     working_schema["properties"][name] = this_type
                                     i += 1
 
-                        with fiona.open(
-                            output_filepath,
-                            "w",
-                            schema=working_schema,
-                            driver=drivers[target_format],
-                            crs=from_epsg(target_epsg),
-                        ) as outlayer:
-                            outlayer.writerecords(
-                                utils.dump_to_geospatial_generator(
-                                    dump_filepath,
-                                    fieldnames,
-                                    target_format,
-                                    data_dict["source_epsg"],
-                                    target_epsg,
-                                    col_map
-                                )
+                        def write(filepath, features, offset):
+                            # write the shapefile into a dir of its own,
+                            # so only its components go into the zip
+                            shp_dir = tempfile.mkdtemp(dir=dir_path)
+                            shapefile_path = os.path.join(
+                                shp_dir, os.path.basename(filepath)
                             )
-                            outlayer.close()
+                            try:
+                                # big layers get split into parts under 2GB
+                                parts = utils.write_shapefile_parts(
+                                    shapefile_path,
+                                    working_schema,
+                                    from_epsg(target_epsg),
+                                    features,
+                                )
 
-                        output_filepath = utils.write_to_zipped_shapefile(
-                            fieldnames, dir_path,
-                            resource_metadata, output_filepath, col_map
-                        )
+                                return utils.write_to_zipped_shapefile(
+                                    fieldnames, resource_metadata,
+                                    shapefile_path, filepath, col_map,
+                                    zip_compression, parts,
+                                )
+                            finally:
+                                shutil.rmtree(shp_dir, ignore_errors=True)
+
+                    features = utils.dump_to_geospatial_generator(
+                        dump_filepath,
+                        fieldnames,
+                        target_format,
+                        data_dict["source_epsg"],
+                        target_epsg,
+                        col_map,
+                        export_progress,
+                        datastore_resource["fields"],
+                        geometry_cache=geometry_cache,
+                        errors=row_errors,
+                        **geometry_options
+                    )
+                    output_filepath = _write_output(
+                        output_filepath, features, write, partition_rows
+                    )
 
                     output = utils.append_to_output(
                         output, target_format, target_epsg, output_filepath
                     )
 
+                utils.record_throughput(
+                    target_format, True, datastore_resource["total"],
+                    time.time() - started,
+                )
+                # skipped rows are left out of the output
+                rows = dump_rows
+                if row_errors:
+                    rows -= row_errors.skipped(
+                        4326 if target_format.lower() == "mbtiles"
+                        else target_epsg
+                    )
+                utils.add_to_manifest(manifest, output, rows)
+                if bundle:
+                    bundle.add(output)
+
+            if geometry_cache:
+                geometry_cache.forget(target_epsg)
+
+        if geometry_cache:
+            geometry_cache.forget()
+
+        if row_errors:
+            row_errors.close()
+            if row_errors.failed:
+                logging.warning(
+                    "[ckanext-iotrans] {} rows failed, and were {}".format(
+                        len(set(row_id for row_id, _ in row_errors.failed)),
+                        "skipped" if row_errors.policy == "skip" else "nulled",
+                    )
+                )
+                output["errors"] = row_errors.filepath
+                utils.add_to_manifest(manifest, output, len(row_errors.failed))
+                if bundle:
+                    bundle.add(output)
+
     # For non geometric transformations...
     elif "geometry" not in fieldnames:
         logging.info("[ckanext-iotrans] Non geometric iotrans transformation started")
         # for each target format...
         for target_format in data_dict["target_formats"]:
             logging.info("[ckanext-iotrans] starting {}".format(target_format))
+            started = time.time()
+            export_progress.stage("{}-None".format(target_format))
+            # its files go into the bundle as they're written
+            if bundle:
+                bundle.stream()
             output_filepath = utils.create_filepath(
                 dir_path, resource_metadata["name"], None, target_format
             )
 
             # CSV
             if target_format.lower() == "csv":
+                # the dump is the csv, unless it has to be split into parts
+                if partition_rows:
+                    output_filepath = _write_output(
+                        output_filepath,
+                        utils.read_dump(dump_filepath),
+                        lambda filepath, rows, offset: utils.write_to_csv(
+                            filepath, fieldnames, rows
+                        ),
+                        partition_rows,
+                    )
+                else:
+                    output_filepath = dump_filepath
                 output = utils.append_to_output(
-                    output, target_format, None, dump_filepath
+                    output, target_format, None, output_filepath
                 )
 
             # JSON
             elif target_format.lower() == "json":
-                utils.write_to_json(dump_filepath,
-                                    output_filepath,
-                                    datastore_resource,
-                                    context)
+                output_filepath = _write_output(
+                    output_filepath,
+                    utils.datastore_records(
+                        data_dict["resource_id"], context, export_progress,
+                        query,
+                    ),
+                    lambda filepath, records, offset: utils.write_to_json(
+                        dump_filepath,
+                        filepath,
+                        datastore_resource,
+                        context,
+                        records=records,
+                    ),
+                    partition_rows,
+                )
+                output = utils.append_to_output(
+                    output, target_format, None, output_filepath
+                )
+
+            # JSON Lines
+            elif target_format.lower() == "jsonl":
+                output_filepath = _write_output(
+                    output_filepath,
+                    utils.datastore_records(
+                        data_dict["resource_id"], context, export_progress,
+                        query,
+                    ),
+                    lambda filepath, records, offset: utils.write_to_jsonl(
+                        filepath, records
+                    ),
+                    partition_rows,
+                )
+                output = utils.append_to_output(
+                    output, target_format, None, output_filepath
+                )
+
+            # XLSX
+            elif target_format.lower() == "xlsx":
+                output_filepath = _write_output(
+                    output_filepath,
+                    utils.read_dump(dump_filepath),
+                    lambda filepath, rows, offset: utils.write_to_xlsx(
+                        dump_filepath, filepath, datastore_resource["fields"],
+                        export_progress, rows, offset,
+                    ),
+                    partition_rows,
+                )
                 output = utils.append_to_output(
                     output, target_format, None, output_filepath
                 )
 
             # XML
             elif target_format.lower() == "xml":
-                utils.write_to_xml(dump_filepath, output_filepath)
+                output_filepath = _write_output(
+                    output_filepath,
+                    utils.read_dump(dump_filepath),
+                    lambda filepath, rows, offset: utils.write_to_xml(
+                        dump_filepath, filepath, export_progress, rows, offset
+                    ),
+                    partition_rows,
+                )
                 output = utils.append_to_output(
                     output, target_format, None, output_filepath
                 )
 
-    logging.info("[ckanext-iotrans] finished file creation")
+            utils.record_throughput(
+                target_format, False, datastore_resource["total"],
+                time.time() - started,
+            )
+            utils.add_to_manifest(manifest, output, dump_rows)
+            if bundle:
+                bundle.add(output)
+
+    if bundle:
+        output["bundle"] = bundle.filepath
+        manifest["bundle"] = utils.file_digest(bundle.filepath)
+    output["manifest"] = manifest
 
     return output
 
 
+def to_file_bulk(context, data_dict):
+    '''
+    inputs:
+        resources: list of to_file inputs, one dict per resource
+            ex: [{"resource_id": ..., "target_formats": [...]}, ...]
+        max_workers: number of exports to run at once (optional)
+
+    resources are exported largest first on the shared export scheduler
+    at most max_workers of them are queued or running at once,
+    so other to_file calls can still get through during a batch
+    a failing resource is reported in "errors" and doesnt stop the batch
+
+    outputs:
+        returns a dict with:
+            "output": to_file output for each successful resource_id
+            "errors": error message for each failed resource_id
+    '''
+
+    logging.info("[ckanext-iotrans] Starting iotrans.to_file_bulk")
+
+    # make sure resources is provided in a list of dicts
+    specs = data_dict.get("resources", None)
+    if not isinstance(specs, list) or not all(
+        [isinstance(spec, dict) for spec in specs]
+    ):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Required input 'resources' be a list of to_file inputs"
+                ]
+            }
+        )
+
+    max_workers = utils.get_bulk_workers(data_dict.get("max_workers", None))
+
+    # plan the batch: biggest resources first, so the longest exports
+    # dont end up starting last and holding up the whole batch
+    planned = []
+    errors = {}
+    for i, spec in enumerate(specs):
+        key = spec.get("resource_id", None)
+        # results are keyed by resource_id, so repeats get their own key
+        if not key or key in errors or key in [job[1] for job in planned]:
+            key = "resources[{}]".format(i)
+        if not spec.get("resource_id", None):
+            errors[key] = {"constraints": ["Input CKAN 'resource_id' required!"]}
+            continue
+        try:
+            cost = utils.estimate_export_cost(spec, context)
+        except Exception as e:
+            errors[key] = utils.describe_error(e)
+            continue
+        planned.append((cost, key, spec))
+    planned.sort(key=lambda job: job[0], reverse=True)
+
+    # feed the scheduler max_workers jobs at a time
+    export_scheduler = scheduler.get_scheduler()
+    output = {}
+    running = {}
+    while planned or running:
+        while planned and len(running) < max_workers:
+            cost, key, spec = planned.pop(0)
+            job = _in_request_context(_run_export, context, dict(spec))
+            running[export_scheduler.submit(job, cost)] = key
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            key = running.pop(future)
+            try:
+                output[key] = future.result()
+            except Exception as e:
+                logging.error(
+                    "[ckanext-iotrans] to_file_bulk failed on {}: {}".format(
+                        key, utils.describe_error(e)
+                    )
+                )
+                errors[key] = utils.describe_error(e)
+
+    logging.info(
+        "[ckanext-iotrans] finished to_file_bulk: {} succeeded, {} failed".format(
+            len(output), len(errors)
+        )
+    )
+
+    return {"output": output, "errors": errors}
+
+
+@tk.side_effect_free
+def to_file_plan(context, data_dict):
+    '''
+    inputs:
+        same as to_file
+
+    estimates an export without running it, from a sample page of records
+    and the throughput of past exports on this node
+
+    outputs:
+        returns a dict with:
+            rows: number of records to export
+            outputs: estimated bytes and seconds of each to_file output
+            temp_disk_bytes: estimated peak disk use of the export
+            free_disk_bytes: free disk space where to_file writes, see
+                utils.get_scratch_path
+            fits_disk: whether temp_disk_bytes fits in free_disk_bytes
+            estimated_seconds: estimated duration of the whole export,
+                or None if some outputs were never timed on this node
+    '''
+
+    logging.info("[ckanext-iotrans] Starting iotrans.to_file_plan")
+
+    # Make sure the inputs point to a datastore resource
+    resource_metadata = _validate_inputs(context, data_dict)
+
+    sample = tk.get_action("datastore_search")(
+        context, dict(
+            utils.datastore_query(data_dict),
+            resource_id=data_dict["resource_id"],
+            limit=int(config.get("ckanext.iotrans.plan_sample_rows", 1000)),
+            include_total=True,
+        )
+    )
+    # every record is read to dump it, even those bbox leaves out
+    read_rows = sample["total"]
+    records = sample["records"]
+    fieldnames = [field["id"] for field in sample["fields"]]
+    spatial = "geometry" in fieldnames
+    # plans take and turn down the same inputs as exports
+    _validate_field_inputs(data_dict, fieldnames)
+
+    # bbox is applied as records are dumped, so the share of the sample it
+    # keeps is the share of the resource it's estimated to keep
+    rows = read_rows
+    if spatial and data_dict.get("bbox", None):
+        records = list(utils.in_bbox(
+            records, data_dict["bbox"], data_dict["error_policy"] != "fail"
+        ))
+        if sample["records"]:
+            rows = int(round(
+                read_rows * len(records) / len(sample["records"])
+            ))
+
+    row_sizes = utils.estimate_output_sizes(
+        records,
+        sample["fields"],
+        data_dict["target_formats"],
+        data_dict.get("source_epsg", None),
+        data_dict.get("target_epsgs", None),
+        rows,
+        utils.get_tile_options(data_dict) if spatial else None,
+        resource_metadata["name"],
+        data_dict["error_policy"],
+    )
+    history = utils.get_throughput_history()
+
+    dump_bytes = int(row_sizes.get("dump", 0) * rows)
+    dump_seconds = utils.estimate_seconds("dump", spatial, read_rows, history)
+    outputs = {}
+    for key, row_size in row_sizes.items():
+        if key == "dump":
+            continue
+        outputs[key] = {
+            "bytes": int(row_size * rows) + utils.EMPTY_OUTPUT_BYTES.get(
+                key.split("-")[0].lower(), 0
+            ),
+            "seconds": utils.estimate_seconds(
+                key.split("-")[0], spatial, rows, history
+            ),
+        }
+
+    # a non spatial csv output is the dump itself, unless it's partitioned:
+    # it takes no time past the dump, and no disk besides it
+    dump_output = None
+    if not spatial and not data_dict.get("partition_rows", None):
+        dump_output = next(
+            (key for key in outputs if key.lower() == "csv-none"), None
+        )
+        if dump_output:
+            outputs[dump_output]["seconds"] = 0.0
+
+    # the dump stays on disk next to every output
+    # shapefile components are on disk twice while they get zipped,
+    # mbtiles features and tile pieces are kept in a scratch database
+    # and a bundle holds another copy of every output
+    temp_disk_bytes = (0 if dump_output else dump_bytes) + sum(
+        [output["bytes"] * (
+            (2 if key.lower().startswith(("shp-", "mbtiles-")) else 1)
+            + (1 if data_dict["bundle"] else 0)
+        ) for key, output in outputs.items()]
+    )
+    free_disk_bytes = shutil.disk_usage(utils.get_scratch_path()).free
+
+    seconds = [dump_seconds] + [output["seconds"] for output in outputs.values()]
+
+    return {
+        "rows": rows,
+        "sample_rows": len(sample["records"]),
+        "dump_bytes": dump_bytes,
+        "outputs": outputs,
+        "temp_disk_bytes": temp_disk_bytes,
+        "free_disk_bytes": free_disk_bytes,
+        "fits_disk": temp_disk_bytes < free_disk_bytes,
+        "estimated_seconds": (
+            None if None in seconds else sum(seconds)
+        ),
+    }
+
+
+@tk.side_effect_free
+def to_file_progress(context, data_dict):
+    '''
+    inputs:
+        resource_id: CKAN datastore resource ID
+
+    outputs:
+        returns the progress to_file last published for the resource:
+            state: running, finished or failed
+            stage: what is being written, ex: "dump" or "geojson-4326"
+            stages_done, stage_count: stages finished, and stages in total
+            rows, total: rows processed by the stage, and rows to process
+            rows_per_second, eta_seconds: speed and time left of the stage
+    '''
+
+    if not data_dict.get("resource_id", None):
+        raise tk.ValidationError(
+            {"constraints": ["Input CKAN 'resource_id' required!"]}
+        )
+
+    record = progress.read_progress(data_dict["resource_id"])
+    if record is None:
+        raise tk.ObjectNotFound(
+            "No to_file progress recorded for {}".format(
+                data_dict["resource_id"]
+            )
+        )
+
+    return record
+
+
+@tk.side_effect_free
+def to_file_queue_status(context, data_dict):
+    '''
+    outputs:
+        returns the number of exports waiting in each priority lane,
+        the number of exports running, and the number of workers
+    '''
+    return scheduler.get_scheduler().status()
+
+
+def _validate_inputs(context, data_dict):
+    '''Checks to_file inputs, and returns the resource they point to'''
+
+    # Make sure a resource id is provided
+    if not data_dict.get("resource_id", None):
+        raise tk.ValidationError(
+            {"constraints": ["Input CKAN 'resource_id' required!"]}
+        )
+
+    # make sure target_formats is provided in a list
+    if not isinstance(data_dict.get("target_formats", None), list):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Required input 'target_formats' be a list of strings"
+                ]
+            }
+        )
+
+    # fields and filters are optional, and passed on to datastore_search
+    if data_dict.get("fields", None) and (
+        not isinstance(data_dict["fields"], list)
+        or not all([isinstance(item, str) for item in data_dict["fields"]])
+    ):
+        raise tk.ValidationError(
+            {"constraints": ["Input 'fields' needs to be a list of strings"]}
+        )
+    if data_dict.get("filters", None) and not isinstance(
+        data_dict["filters"], dict
+    ):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'filters' needs to be a dict of field names "
+                    "and values"
+                ]
+            }
+        )
+
+    # bbox is optional, but has to be [min x, min y, max x, max y]
+    bbox = data_dict.get("bbox", None)
+    if bbox and (
+        not isinstance(bbox, list) or len(bbox) != 4
+        or not all([isinstance(item, (int, float)) for item in bbox])
+        or bbox[0] > bbox[2] or bbox[1] > bbox[3]
+    ):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'bbox' needs to be a list of numbers: "
+                    "[min x, min y, max x, max y]"
+                ]
+            }
+        )
+
+    # partition_rows is optional, but has to be a positive integer
+    if data_dict.get("partition_rows", None) not in [None, ""]:
+        try:
+            data_dict["partition_rows"] = int(data_dict["partition_rows"])
+        except (TypeError, ValueError):
+            data_dict["partition_rows"] = 0
+        if data_dict["partition_rows"] < 1:
+            raise tk.ValidationError(
+                {
+                    "constraints": [
+                        "Input 'partition_rows' needs to be a positive integer"
+                    ]
+                }
+            )
+    else:
+        data_dict["partition_rows"] = None
+
+    # bundle is optional: true (a zip archive), "zip" or "tar"
+    bundle = data_dict.get("bundle", None)
+    if bundle in [None, "", False] or str(bundle).lower() == "false":
+        data_dict["bundle"] = None
+    elif bundle is True or str(bundle).lower() == "true":
+        data_dict["bundle"] = "zip"
+    elif str(bundle).lower() in utils.BUNDLE_FORMATS:
+        data_dict["bundle"] = str(bundle).lower()
+    else:
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'bundle' needs to be true or in the following: "
+                    "{}".format(", ".join(utils.BUNDLE_FORMATS))
+                ]
+            }
+        )
+
+    # error_policy is optional: fail (the default), skip or null
+    data_dict["error_policy"] = str(
+        data_dict.get("error_policy", None) or "fail"
+    ).lower()
+    if data_dict["error_policy"] not in utils.ERROR_POLICIES:
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'error_policy' must be in the following: "
+                    "{}".format(", ".join(utils.ERROR_POLICIES))
+                ]
+            }
+        )
+
+    # Make sure the resource id provided is for a datastore resource
+    resource_metadata = tk.get_action("resource_show")(
+        context, {"id": data_dict["resource_id"]}
+    )
+    if (resource_metadata.get("datastore_active", None) in
+            ["false", "False", False]):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    data_dict["resource_id"] + " is not a datastore resource!"
+                ]
+            }
+        )
+
+    return resource_metadata
+
+
+def _validate_field_inputs(data_dict, fieldnames):
+    '''Checks the to_file inputs that depend on the fields exported -
+    whether there's a geometry among them or not'''
+
+    # the datastore can't search geometries, so bbox is applied to records
+    # as they are dumped
+    if data_dict.get("bbox", None) and "geometry" not in fieldnames:
+        raise tk.ValidationError(
+            {"constraints": ["Input 'bbox' needs a 'geometry' field"]}
+        )
+
+    if "geometry" in fieldnames:
+        _validate_spatial_inputs(data_dict)
+        formats = utils.SPATIAL_FORMATS
+    else:
+        formats = utils.NONSPATIAL_FORMATS
+
+    for target_format in data_dict["target_formats"]:
+        if str(target_format).lower() not in formats:
+            raise tk.ValidationError(
+                {
+                    "constraints": [
+                        "Input target_format '{}' must be in the following: "
+                        "{}".format(target_format, ", ".join(formats))
+                    ]
+                }
+            )
+
+
+def _validate_spatial_inputs(data_dict):
+    '''Checks the to_file inputs needed to export spatial data'''
+
+    if not data_dict.get("source_epsg", None):
+        raise tk.ValidationError({"constraints":
+                                 ["Input 'source_epsg' required!"]})
+
+    # make sure inputs are correctly formatted
+    if isinstance(data_dict.get("target_epsgs", None), int):
+        data_dict["target_epsgs"] = [data_dict["target_epsgs"]]
+
+    # throw an error if input target_epsgs is not a list of integers
+    if not isinstance(data_dict.get("target_epsgs", None), list) or not all(
+        [isinstance(item, int) for item in data_dict["target_epsgs"]]
+    ):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'target_epsgs' needs to be a list of integers"
+                ]
+            }
+        )
+
+    # coordinate_precision and simplify_tolerance are optional
+    precision = data_dict.get("coordinate_precision", None)
+    if precision is not None and (
+        isinstance(precision, bool) or not isinstance(precision, int)
+        or not 0 <= precision <= 15
+    ):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'coordinate_precision' needs to be an integer "
+                    "from 0 to 15"
+                ]
+            }
+        )
+    if data_dict.get("geometry_encoding", None) and data_dict[
+        "geometry_encoding"
+    ] not in utils.GEOMETRY_ENCODERS:
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'geometry_encoding' must be in the following: "
+                    + ", ".join(utils.GEOMETRY_ENCODERS.keys())
+                ]
+            }
+        )
+    tolerance = data_dict.get("simplify_tolerance", None)
+    if tolerance is not None and (
+        isinstance(tolerance, bool) or not isinstance(tolerance, (int, float))
+        or tolerance < 0
+    ):
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'simplify_tolerance' needs to be a positive number"
+                ]
+            }
+        )
+
+
+def _count_stages(data_dict, spatial):
+    '''Returns how many stages an export has: its dump, and each output
+    it writes - mbtiles outputs are written once, whatever the EPSGs'''
+    if not spatial:
+        return 1 + len(data_dict["target_formats"])
+    return 1 + sum(
+        1 if target_format.lower() == "mbtiles"
+        else len(data_dict["target_epsgs"])
+        for target_format in data_dict["target_formats"]
+    )
+
+
+def _write_output(output_filepath, rows, write, partition_rows=None):
+    '''Writes rows to an output with write(filepath, rows, offset)
+
+    If partition_rows is set, rows are written to numbered parts of at most
+    partition_rows rows each, with an index of the parts. Returns what
+    to_file outputs for the file(s)
+    '''
+    if not partition_rows:
+        return write(output_filepath, rows, 0) or output_filepath
+
+    partitioner = utils.Partitioner(rows, partition_rows)
+    part_filepaths = []
+    for i, part_rows in enumerate(partitioner.parts()):
+        filepath = utils.part_filepath(output_filepath, i + 1)
+        part_filepaths.append(
+            write(filepath, part_rows, sum(partitioner.counts[:-1]))
+            or filepath
+        )
+    return utils.write_partition_index(
+        output_filepath, part_filepaths, partitioner.counts
+    )
+
+
+def _get_profiler(data_dict):
+    '''Returns a profiler if this to_file call should be profiled'''
+    sample_rate = float(config.get("ckanext.iotrans.profile_sample_rate", 0))
+    if not (tk.asbool(data_dict.get("profile", False))
+            or random.random() < sample_rate):
+        return None
+
+    profiler = cProfile.Profile()
+    try:
+        # only one profiler can run at a time in some python versions
+        profiler.enable()
+        profiler.disable()
+    except ValueError as e:
+        logging.warning(
+            "[ckanext-iotrans] cant profile this to_file call: {}".format(e)
+        )
+        return None
+    return profiler
+
+
+def _run_export(context, data_dict):
+    '''Runs to_file on a scheduler worker thread'''
+    try:
+        return to_file(context.copy(), data_dict)
+    finally:
+        # each worker thread gets its own db session - release it
+        model.Session.remove()
+
+
+def _in_request_context(fn, *args):
+    '''Binds args to fn, and fn to the current request if there is one'''
+    job = functools.partial(fn, *args)
+    # let worker threads see the request the export came in on
+    if flask.has_request_context():
+        job = flask.copy_current_request_context(job)
+    return job
+
+
 @tk.side_effect_free
 def prune(context, data_dict):
 
@@ -1,4 +1,5 @@
 import ckan.plugins as plugins
+import ckan.plugins.toolkit as tk
 from . import iotrans, utils
 
 
@@ -19,6 +20,10 @@ class IotransPlugin(plugins.SingletonPlugin):
     def get_actions(self):
         return {
             "to_file": iotrans.to_file,
+            "to_file_bulk": iotrans.to_file_bulk,
+            "to_file_plan": iotrans.to_file_plan,
+            "to_file_progress": iotrans.to_file_progress,
+            "to_file_queue_status": iotrans.to_file_queue_status,
             "prune": iotrans.prune,
         }
 
@@ -33,5 +38,22 @@ class IotransPlugin(plugins.SingletonPlugin):
     def get_auth_functions(self):
         return {
             "to_file": utils.iotrans_auth_function,
+            "to_file_bulk": utils.iotrans_auth_function,
+            "to_file_plan": utils.iotrans_auth_function,
+            "to_file_progress": utils.iotrans_auth_function,
+            "to_file_queue_status": utils.iotrans_auth_function,
             "prune": utils.iotrans_auth_function,
         }
+
+    """
+    # ==============================
+    # IConfigurable
+    # ==============================
+    GDAL and PROJ are loaded on the first spatial export,
+    unless ckanext.iotrans.preload_gdal asks for them at startup
+    """
+    plugins.implements(plugins.IConfigurable)
+
+    def configure(self, config):
+        if tk.asbool(config.get("ckanext.iotrans.preload_gdal", False)):
+            utils.preload_gdal()
@@ -0,0 +1,149 @@
+'''Progress reporting for long running to_file exports
+
+to_file publishes its progress to a small JSON status record on disk, so
+the to_file_progress action can read it from any CKAN process.
+'''
+
+import os
+import json
+import time
+import fcntl
+import codecs
+import tempfile
+
+from ckan.common import config
+
+
+# row loops report every this many rows. Writes to disk are throttled further
+REPORT_EVERY = 1000
+
+
+def get_progress_filepath(resource_id):
+    '''Returns where the progress of a resource's export is recorded'''
+    return os.path.join(
+        config.get("ckan.storage_path"), "iotrans", "progress",
+        "{}.json".format(resource_id),
+    )
+
+
+def get_lock_filepath(resource_id):
+    '''Returns the file an export of a resource holds a lock on'''
+    return get_progress_filepath(resource_id)[:-len("json")] + "lock"
+
+
+def read_progress(resource_id):
+    '''Returns the last progress recorded for a resource, or None'''
+    try:
+        with codecs.open(
+            get_progress_filepath(resource_id), "r", encoding="utf-8"
+        ) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class ExportProgress(object):
+    '''Tracks rows processed by each stage of an export
+
+    update() is cheap to call from row loops - the status record is only
+    rewritten once every `interval` seconds
+
+    Records are kept per resource, so only one export of a resource can
+    hold its lock at a time - see acquire
+    '''
+
+    def __init__(self, resource_id, stage_count=0, total=None, interval=None):
+        self.resource_id = resource_id
+        self.stage_count = stage_count
+        self.total = total
+        self.interval = float(
+            interval or config.get("ckanext.iotrans.progress_interval", 2)
+        )
+        self.stages_done = []
+        self.stage_name = None
+        self.rows = 0
+        self.started = time.time()
+        self.stage_started = self.started
+        self.written = 0
+        self.lock_file = None
+
+    def acquire(self):
+        '''Locks the resource for this export, before anything is written
+
+        Returns False if another export of the resource holds the lock, in
+        this process or any other. The lock goes with the process if it
+        dies, so an export that crashed doesn't hold it
+        '''
+        filepath = get_lock_filepath(self.resource_id)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.lock_file = open(filepath, "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def release(self):
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def stage(self, name):
+        '''Starts a new stage, ex: "dump" or "geojson-4326"'''
+        if self.stage_name:
+            self.stages_done.append(self.stage_name)
+        self.stage_name = name
+        self.rows = 0
+        self.stage_started = time.time()
+        self.write("running")
+
+    def update(self, rows):
+        '''Records how many rows the current stage has processed'''
+        self.rows = rows
+        if time.time() - self.written >= self.interval:
+            self.write("running")
+
+    def finish(self, error=None):
+        '''Records that the export finished, or failed with error'''
+        if self.stage_name:
+            self.stages_done.append(self.stage_name)
+            self.stage_name = None
+        if not error and self.total is not None:
+            self.rows = self.total
+        self.write("failed" if error else "finished", error)
+        self.release()
+
+    def write(self, state, error=None):
+        now = time.time()
+        elapsed = now - self.stage_started
+        rows_per_second = self.rows / elapsed if elapsed > 0 else None
+        eta_seconds = None
+        if rows_per_second and self.total is not None:
+            eta_seconds = max(0, self.total - self.rows) / rows_per_second
+
+        record = {
+            "resource_id": self.resource_id,
+            "state": state,
+            "stage": self.stage_name,
+            "stages_done": self.stages_done,
+            "stage_count": self.stage_count,
+            "rows": self.rows,
+            "total": self.total,
+            "rows_per_second": rows_per_second,
+            "eta_seconds": eta_seconds,
+            "elapsed_seconds": now - self.started,
+            "updated": now,
+        }
+        if error:
+            record["error"] = str(error)
+
+        # write a new file and swap it in, so readers never see half of it
+        filepath = get_progress_filepath(self.resource_id)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath))
+        with codecs.open(fd, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp_filepath, filepath)
+        self.written = now
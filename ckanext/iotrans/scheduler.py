@@ -0,0 +1,172 @@
+'''Priority scheduling for queued to_file work
+
+Exports are sorted into priority lanes by their estimated cost, so a small
+lookup table doesnt wait behind a huge spatial layer. Queued jobs age while
+they wait, so large jobs still get their turn during a stream of small ones.
+'''
+
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from ckan.common import config
+
+
+# priority lanes, from first to last served
+PRIORITIES = ["small", "medium", "large"]
+
+# relative cost of writing one value to each output format
+FORMAT_WEIGHTS = {
+    "csv": 1,
+    "json": 1,
+    "jsonl": 1,
+    "xml": 2,
+    "xlsx": 2,
+    "geojson": 2,
+    "geojsonseq": 2,
+    "gpkg": 3,
+    "shp": 3,
+    # every feature is cut into tiles at each zoom level
+    "mbtiles": 4,
+}
+
+# relative cost of one geometry value, compared to any other value
+GEOMETRY_WEIGHT = 10
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def estimate_cost(rows, fields, target_formats, target_epsgs=None):
+    '''Estimates how expensive an export is, in weighted values written
+
+    :param rows: number of records in the datastore resource
+    :param fields: list of datastore field ids
+    :param target_formats: list of requested formats
+    :param target_epsgs: list of requested EPSGs, if data is spatial
+    :return: estimated cost of the export
+    :rtype: int
+    '''
+    spatial = "geometry" in fields
+    row_weight = len(fields) + (GEOMETRY_WEIGHT - 1 if spatial else 0)
+
+    # spatial data gets written once per format per epsg, except vector
+    # tiles, which are only built once, in web mercator
+    epsgs = max(1, len(target_epsgs or [])) if spatial else 1
+    outputs = sum(
+        [FORMAT_WEIGHTS.get(str(target_format).lower(), 1)
+         * (1 if str(target_format).lower() == "mbtiles" else epsgs)
+         for target_format in target_formats]
+    )
+
+    return rows * row_weight * outputs
+
+
+def get_priority(cost):
+    '''Sorts an estimated cost into one of the PRIORITIES'''
+    if cost <= int(config.get("ckanext.iotrans.small_job_cost", 1000000)):
+        return "small"
+    if cost <= int(config.get("ckanext.iotrans.medium_job_cost", 100000000)):
+        return "medium"
+    return "large"
+
+
+class ExportScheduler(object):
+    '''Runs submitted jobs on a fixed pool of threads, cheapest lane first
+
+    A waiting job moves up one lane for every `aging_seconds` it has waited
+    '''
+
+    def __init__(self, workers, aging_seconds=60):
+        self.workers = workers
+        self.aging_seconds = aging_seconds
+        self.lanes = {priority: deque() for priority in PRIORITIES}
+        self.running = 0
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        self.threads = []
+
+    def submit(self, fn, cost=0):
+        '''Queues fn() and returns a Future for its result'''
+        future = Future()
+        with self.condition:
+            self.lanes[get_priority(cost)].append((time.time(), fn, future))
+            self._start_workers()
+            self.condition.notify()
+        return future
+
+    def status(self):
+        '''Returns queue depth, running jobs and pool size'''
+        with self.condition:
+            return {
+                "queued": {
+                    priority: len(lane) for priority, lane in self.lanes.items()
+                },
+                "running": self.running,
+                "workers": self.workers,
+            }
+
+    def in_worker(self):
+        '''True if called from a job already running on this scheduler'''
+        return getattr(self.local, "in_worker", False)
+
+    def _start_workers(self):
+        # threads are started on first use, so idle web workers dont pay
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(
+                target=self._work,
+                name="iotrans-export-{}".format(len(self.threads)),
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def _next_job(self):
+        # the head of each lane is its oldest job. Age lowers its rank
+        now = time.time()
+        best = None
+        for rank, priority in enumerate(PRIORITIES):
+            lane = self.lanes[priority]
+            if not lane:
+                continue
+            aged_rank = rank - (now - lane[0][0]) / self.aging_seconds
+            if best is None or aged_rank < best[0]:
+                best = (aged_rank, lane)
+        return best[1].popleft()
+
+    def _work(self):
+        self.local.in_worker = True
+        while True:
+            with self.condition:
+                while not any(self.lanes.values()):
+                    self.condition.wait()
+                queued_at, fn, future = self._next_job()
+                self.running += 1
+
+            logging.debug(
+                "[ckanext-iotrans] export job started after {}s in queue".format(
+                    round(time.time() - queued_at, 1)
+                )
+            )
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn())
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self.condition:
+                self.running -= 1
+
+
+def get_scheduler():
+    '''Returns the export scheduler shared by this process'''
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ExportScheduler(
+                int(config.get("ckanext.iotrans.bulk_workers", 4)),
+                float(config.get("ckanext.iotrans.aging_seconds", 60)),
+            )
+        return _scheduler
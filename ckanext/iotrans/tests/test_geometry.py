@@ -0,0 +1,73 @@
+"""
+Test module for the iotrans geometry encodings
+"""
+
+from ckanext.iotrans import geometry
+import pytest
+
+
+GEOMETRIES = [
+    {"type": "Point", "coordinates": [-79.556501959627, 43.632603612174]},
+    {"type": "LineString", "coordinates": [[0, 0], [1, 1.25], [2, 0, 5]]},
+    {"type": "Polygon", "coordinates": [
+        [[0, 0], [1, 0], [1, 1], [0, 0]],
+        [[0.1, 0.1], [0.2, 0.1], [0.2, 0.2], [0.1, 0.1]],
+    ]},
+    {"type": "MultiPoint", "coordinates": [[1, 2], [3, 4]]},
+    {"type": "MultiLineString", "coordinates": [[[0, 0], [1, 1]], [[2, 2], [3, 3]]]},
+    {"type": "MultiPolygon", "coordinates": [
+        [[[0, 0], [1, 0], [1, 1], [0, 0]]],
+        [[[5, 5], [6, 5], [6, 6], [5, 5]]],
+    ]},
+]
+
+
+@pytest.mark.parametrize("value", GEOMETRIES)
+def test_wkt_and_wkb_round_trip(value):
+    """checks if geometries read back from their WKT and WKB as they were"""
+    if value["type"] == "LineString":
+        # 2D positions of a 3D geometry get a Z of 0
+        value = dict(value, coordinates=[[0, 0, 0], [1, 1.25, 0], [2, 0, 5]])
+
+    assert geometry.parse_geometry(geometry.to_wkt(value)) == value
+    assert geometry.parse_geometry(geometry.to_wkb(value)) == value
+
+
+@pytest.mark.parametrize("value,parsed", [
+    ("{'type': 'Point', 'coordinates': [1, 2]}",
+     {"type": "Point", "coordinates": [1, 2]}),
+    ("SRID=4326;MULTIPOINT Z (1 2 3, 4 5 6)",
+     {"type": "MultiPoint", "coordinates": [[1, 2, 3], [4, 5, 6]]}),
+    ("LINESTRING M (1 2 9, 3 4 9)",
+     {"type": "LineString", "coordinates": [[1, 2], [3, 4]]}),
+    ("POINT EMPTY", {"type": "Point", "coordinates": []}),
+    ("0101000020E6100000000000000000F03F0000000000000040",
+     {"type": "Point", "coordinates": [1, 2]}),
+    ("GEOMETRYCOLLECTION (POINT (1 2), LINESTRING (0 0, 1 1))",
+     {"type": "GeometryCollection", "geometries": [
+         {"type": "Point", "coordinates": [1, 2]},
+         {"type": "LineString", "coordinates": [[0, 0], [1, 1]]},
+     ]}),
+])
+def test_parse_geometry(value, parsed):
+    """test case for geometry.parse_geometry"""
+    assert geometry.parse_geometry(value) == parsed
+
+
+@pytest.mark.parametrize("value", [
+    "not a geometry",
+    "CIRCLE (1 2, 3)",
+    "()",
+])
+def test_parse_geometry_unreadable(value):
+    """checks if geometry.parse_geometry says which value it can't read"""
+    with pytest.raises(ValueError, match="Unreadable geometry"):
+        geometry.parse_geometry(value)
+
+
+def test_to_wkt():
+    """test case for geometry.to_wkt"""
+    assert geometry.to_wkt(
+        {"type": "MultiPoint", "coordinates": [[304800.0, 4828895.14]]}
+    ) == "MULTIPOINT ((304800 4828895.14))"
+    assert geometry.to_wkt(None) == ""
@@ -2,8 +2,12 @@
 in context of a CKAN instance'''
 import pytest
 import os
+import json
+import hashlib
+import openpyxl
 
 import ckan.tests.helpers as helpers
+import ckan.plugins.toolkit as tk
 from .utils import csv_rows_eq, json_small, xml_eq, CORRECT_DIR_PATH
 
 
@@ -112,3 +116,254 @@ class TestIOTransNonSpatial(object):
         )
         assert compare_fn(test_path, correct_filepath)
 
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_bulk_reports_errors_per_resource(self, resource):
+        '''Checks if to_file_bulk exports good resources and reports
+        failed ones without aborting the batch'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014}, {"the year": 2013}],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resources": [
+                {"resource_id": resource["id"], "target_formats": ["csv"]},
+                {"target_formats": ["csv"]},
+            ],
+            "max_workers": 2,
+        }
+        result = helpers.call_action("to_file_bulk", **data)
+
+        test_path = result["output"][resource["id"]]["csv-None"]
+        correct_filepath = os.path.join(CORRECT_DIR_PATH, "correct_nonspatial.csv")
+        assert csv_rows_eq[1](test_path, correct_filepath)
+        assert list(result["errors"].keys()) == ["resources[1]"]
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_profile(self, resource, sysadmin):
+        '''Checks if to_file saves a profile next to its outputs
+        when a sysadmin asks for one'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014}, {"the year": 2013}],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "target_formats": ["csv"],
+            "profile": True,
+        }
+        result = helpers.call_action(
+            "to_file", context={"user": sysadmin["name"]}, **data
+        )
+
+        assert os.path.dirname(result["profile"]) == os.path.dirname(
+            result["csv-None"]
+        )
+        assert os.path.exists(result["profile"])
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_partition_rows(self, resource):
+        '''Checks if to_file splits outputs into standalone parts
+        and indexes them when partition_rows is set'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014 - i} for i in range(5)],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "target_formats": target_formats,
+            "partition_rows": 2,
+        }
+        result = helpers.call_action("to_file", **data)
+
+        for file_format in target_formats:
+            parts = result[f"{file_format}-None"]["parts"]
+            assert [os.path.basename(part) for part in parts] == [
+                f"{resource['name']} part {i}.{file_format}" for i in range(1, 4)
+            ]
+
+            with open(result[f"{file_format}-None"]["index"]) as f:
+                index = json.load(f)
+            assert index["rows"] == 5
+            assert [(part["offset"], part["rows"]) for part in index["parts"]] == [
+                (0, 2), (2, 2), (4, 1)
+            ]
+
+        # each json part is an array of its own
+        with open(result["json-None"]["parts"][2]) as f:
+            assert [record["the year"] for record in json.load(f)] == [2010]
+
+        with open(result["csv-None"]["parts"][1]) as f:
+            assert f.read().splitlines() == ["_id,the year", "3,2012", "4,2011"]
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_jsonl(self, resource):
+        '''Checks if to_file writes the records of json outputs
+        one per line in jsonl outputs'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014}, {"the year": 2013}],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "target_formats": ["json", "jsonl"],
+        }
+        result = helpers.call_action("to_file", **data)
+
+        with open(result["json-None"]) as f:
+            records = json.load(f)
+        with open(result["jsonl-None"]) as f:
+            assert [json.loads(line) for line in f] == records
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_xlsx(self, resource):
+        '''Checks if to_file writes typed cells in xlsx outputs'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014}, {"the year": 2013}],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "target_formats": ["xlsx"],
+        }
+        result = helpers.call_action("to_file", **data)
+
+        workbook = openpyxl.load_workbook(result["xlsx-None"], read_only=True)
+        assert [list(row) for row in workbook["Data"].values] == [
+            ["_id", "the year"], [1, 2014], [2, 2013]
+        ]
+        workbook.close()
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_manifest(self, resource):
+        '''Checks if to_file returns the size, checksums and rows
+        of each output in its manifest'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014}, {"the year": 2013}],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "target_formats": target_formats,
+        }
+        result = helpers.call_action("to_file", **data)
+
+        for file_format in target_formats:
+            with open(result[f"{file_format}-None"], "rb") as f:
+                contents = f.read()
+            assert result["manifest"][f"{file_format}-None"] == {
+                "file": os.path.basename(result[f"{file_format}-None"]),
+                "bytes": len(contents),
+                "md5": hashlib.md5(contents).hexdigest(),
+                "sha256": hashlib.sha256(contents).hexdigest(),
+                "rows": 2,
+            }
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_fields_and_filters(self, resource):
+        '''Checks if to_file only exports the fields and records
+        asked for'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [
+                {"the year": 2014, "ward": "1"},
+                {"the year": 2013, "ward": "2"},
+                {"the year": 2012, "ward": "1"},
+            ],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "target_formats": ["csv", "json"],
+            "fields": ["the year"],
+            "filters": {"ward": "1"},
+        }
+        result = helpers.call_action("to_file", **data)
+
+        with open(result["csv-None"]) as f:
+            assert f.read().splitlines() == ["the year", "2014", "2012"]
+        with open(result["json-None"]) as f:
+            assert json.load(f) == [{"the year": 2014}, {"the year": 2012}]
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_plan_csv_is_dump(self, resource):
+        '''Checks if to_file_plan counts a non spatial csv output once,
+        since it's the dump, unless it's partitioned'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014}, {"the year": 2013}],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        plan = helpers.call_action(
+            "to_file_plan", resource_id=resource["id"], target_formats=["csv"]
+        )
+        assert plan["temp_disk_bytes"] == plan["outputs"]["csv-None"]["bytes"]
+        assert plan["outputs"]["csv-None"]["seconds"] == 0
+
+        plan = helpers.call_action(
+            "to_file_plan", resource_id=resource["id"], target_formats=["csv"],
+            partition_rows=1,
+        )
+        assert plan["temp_disk_bytes"] == (
+            plan["dump_bytes"] + plan["outputs"]["csv-None"]["bytes"]
+        )
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_unknown_format(self, resource):
+        '''Checks if to_file, to_file_bulk and to_file_plan all turn down
+        a format they can't write'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [{"the year": 2014}, {"the year": 2013}],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {"resource_id": resource["id"], "target_formats": ["parquet"]}
+        for action in ["to_file", "to_file_plan"]:
+            with pytest.raises(tk.ValidationError):
+                helpers.call_action(action, **data)
+
+        result = helpers.call_action("to_file_bulk", resources=[data])
+        assert result["output"] == {}
+        assert list(result["errors"].keys()) == [resource["id"]]
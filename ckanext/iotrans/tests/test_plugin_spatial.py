@@ -2,6 +2,7 @@
 in context of a CKAN instance'''
 
 
+import csv
 import json
 import pytest
 import fiona
@@ -13,6 +14,7 @@ from .utils import (
     geographic_files_eq
 )
 import filecmp
+import sqlite3
 
 target_formats = ["csv", "geojson"]
 
@@ -176,6 +178,138 @@ class TestIOTransSpatial(object):
                     assert fiona_collections_eq(test_gpkg, correct_gpkg, 0.98)
 
 
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    @pytest.mark.parametrize("bulk_load", [True, False])
+    def test_to_file_gpkg_bulk_load(self, bulk_load, resource):
+        '''Checks if gpkg files are valid GeoPackages with a spatial index,
+        with and without bulk load mode'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [
+                {"the year": 2014, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.556501959627, 43.632603612174]
+                })},
+                {"the year": 2013, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.252341959627, 43.332603432174]
+                })}
+            ],
+        }
+        result = helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "source_epsg": 4326,
+            "target_epsgs": [4326],
+            "target_formats": ["gpkg"],
+            "gpkg_bulk_load": bulk_load,
+        }
+        result = helpers.call_action("to_file", **data)
+
+        connection = sqlite3.connect(result["gpkg-4326"])
+        try:
+            assert connection.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+            assert connection.execute("PRAGMA application_id").fetchone() == (0x47504B47,)
+            table_name, = connection.execute(
+                "SELECT table_name FROM gpkg_contents"
+            ).fetchone()
+            assert connection.execute(
+                "SELECT count(*) FROM gpkg_extensions "
+                "WHERE extension_name = 'gpkg_rtree_index' AND table_name = ?",
+                (table_name,)
+            ).fetchone() == (1,)
+            assert connection.execute(
+                'SELECT count(*) FROM "rtree_{}_geom"'.format(table_name)
+            ).fetchone() == (2,)
+        finally:
+            connection.close()
+
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_on_geojsonseq(self, resource):
+        '''Checks if to_file writes the features of geojson outputs
+        one per line in geojsonseq outputs'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [
+                {"the year": 2014, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.556501959627, 43.632603612174]
+                })},
+                {"the year": 2013, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.252341959627, 43.332603432174]
+                })}
+            ],
+        }
+        result = helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "source_epsg": 4326,
+            "target_epsgs": [4326, 2952],
+            "target_formats": ["geojson", "geojsonseq"],
+        }
+        result = helpers.call_action("to_file", **data)
+
+        for epsg in [4326, 2952]:
+            with open(result[f"geojson-{epsg}"]) as f:
+                features = json.load(f)["features"]
+            with open(result[f"geojsonseq-{epsg}"]) as f:
+                assert [json.loads(line) for line in f] == features
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_on_mbtiles(self, resource):
+        '''Checks if to_file builds one web mercator tile pyramid,
+        whatever the target epsgs'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [
+                {"the year": 2014, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.556501959627, 43.632603612174]
+                })},
+                {"the year": 2013, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.252341959627, 43.332603432174]
+                })}
+            ],
+        }
+        result = helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "source_epsg": 4326,
+            "target_epsgs": [4326, 2952],
+            "target_formats": ["mbtiles"],
+            "tile_max_zoom": 6,
+            "tile_drop_rate": 1,
+        }
+        result = helpers.call_action("to_file", **data)
+
+        assert list(result.keys()) == ["mbtiles-3857", "manifest"]
+        connection = sqlite3.connect(result["mbtiles-3857"])
+        try:
+            assert dict(connection.execute("SELECT * FROM metadata"))[
+                "maxzoom"
+            ] == "6"
+            assert connection.execute(
+                "SELECT DISTINCT zoom_level FROM tiles ORDER BY zoom_level"
+            ).fetchall() == [(zoom,) for zoom in range(7)]
+        finally:
+            connection.close()
+
+
     @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
     @pytest.mark.usefixtures("with_plugins")
     def test_to_file_on_spatial_multigeometries(self, resource):
@@ -320,3 +454,157 @@ class TestIOTransSpatial(object):
                 )
 
                 assert filecmp.cmp(test_path, correct_filepath)
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    @pytest.mark.parametrize("error_policy", ["skip", "null"])
+    def test_to_file_error_policy(self, error_policy, resource):
+        '''Checks if to_file skips or nulls rows with malformed geometries,
+        and lists them in its errors output, instead of failing'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [
+                {"the year": 2014, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.556501959627, 43.632603612174]
+                })},
+                {"the year": 2013, "geometry": '{"type": "Point"}'},
+                {"the year": 2012, "geometry": "not a geometry"},
+            ],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "source_epsg": 4326,
+            "target_epsgs": [4326, 2952],
+            "target_formats": ["csv", "geojson"],
+        }
+        with pytest.raises(AssertionError):
+            helpers.call_action("to_file", **data)
+
+        result = helpers.call_action(
+            "to_file", error_policy=error_policy, **data
+        )
+
+        with open(result["errors"]) as f:
+            errors = list(csv.DictReader(f))
+        assert [(row["_id"], row["epsg"]) for row in errors] == [
+            ("2", "4326"), ("3", "4326"), ("2", "2952"), ("3", "2952"),
+        ]
+        assert "No coordinates in geometry!" in errors[0]["error"]
+        assert result["manifest"]["errors"]["rows"] == 4
+
+        for epsg in [4326, 2952]:
+            with open(result[f"geojson-{epsg}"]) as f:
+                features = json.load(f)["features"]
+            if error_policy == "skip":
+                assert [f["properties"]["_id"] for f in features] == [1]
+                assert result["manifest"][f"csv-{epsg}"]["rows"] == 1
+            else:
+                assert [f["geometry"] for f in features[1:]] == [None, None]
+                assert result["manifest"][f"csv-{epsg}"]["rows"] == 3
+
+        # bbox can't tell where an unreadable geometry is, so its row is
+        # left to error_policy; the row without coordinates is left out
+        data["bbox"] = [-80, 43, -79, 44]
+        with pytest.raises(ValueError):
+            helpers.call_action("to_file", **data)
+        result = helpers.call_action(
+            "to_file", error_policy=error_policy, **data
+        )
+        with open(result["errors"]) as f:
+            errors = list(csv.DictReader(f))
+        assert [(row["_id"], row["epsg"]) for row in errors] == [
+            ("3", "4326"), ("3", "2952"),
+        ]
+        with open(result["geojson-4326"]) as f:
+            features = json.load(f)["features"]
+        assert [f["properties"]["_id"] for f in features] == (
+            [1] if error_policy == "skip" else [1, 3]
+        )
+
+        # plans estimate the sample without the rows that fail
+        plan = helpers.call_action(
+            "to_file_plan", error_policy=error_policy, **data
+        )
+        assert plan["outputs"]["csv-4326"]["bytes"] > 0
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_single_target_epsg(self, resource):
+        '''Checks if to_file takes an int target_epsgs, and counts one
+        stage per output it writes'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [
+                {"the year": 2014, "geometry": json.dumps({
+                    "type": "Point",
+                    "coordinates": [-79.556501959627, 43.632603612174]
+                })},
+            ],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        result = helpers.call_action(
+            "to_file",
+            resource_id=resource["id"],
+            source_epsg=4326,
+            target_epsgs=2952,
+            target_formats=["csv", "geojson"],
+        )
+        assert sorted(result.keys()) == ["csv-2952", "geojson-2952", "manifest"]
+
+        status = helpers.call_action(
+            "to_file_progress", resource_id=resource["id"]
+        )
+        assert status["state"] == "finished"
+        assert status["stage_count"] == 3
+        assert len(status["stages_done"]) == 3
+
+    @pytest.mark.ckan_config("ckan.plugins", "datastore iotrans")
+    @pytest.mark.usefixtures("with_plugins")
+    def test_to_file_plan_bbox(self, resource):
+        '''Checks if to_file_plan estimates the rows bbox keeps, and if
+        to_file_progress reports them once they're dumped'''
+
+        data = {
+            "resource_id": resource["id"],
+            "force": True,
+            "records": [
+                {"the year": year, "geometry": json.dumps({
+                    "type": "Point", "coordinates": [x, 43.6]
+                })}
+                for year, x in [(2014, -79.5), (2013, -75), (2012, -70),
+                                (2011, -65)]
+            ],
+        }
+        helpers.call_action("datastore_create", **data)
+
+        data = {
+            "resource_id": resource["id"],
+            "source_epsg": 4326,
+            "target_epsgs": [4326],
+            "target_formats": ["csv"],
+        }
+        plan = helpers.call_action("to_file_plan", **data)
+        bbox_plan = helpers.call_action(
+            "to_file_plan", bbox=[-80, 43, -79, 44], **data
+        )
+        assert plan["rows"] == 4
+        assert bbox_plan["rows"] == 1
+        assert bbox_plan["outputs"]["csv-4326"]["bytes"] < (
+            plan["outputs"]["csv-4326"]["bytes"]
+        )
+        assert bbox_plan["temp_disk_bytes"] < plan["temp_disk_bytes"]
+
+        helpers.call_action("to_file", bbox=[-80, 43, -79, 44], **data)
+        status = helpers.call_action(
+            "to_file_progress", resource_id=resource["id"]
+        )
+        assert status["total"] == 1
+        assert status["rows"] == 1
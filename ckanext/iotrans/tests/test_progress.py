@@ -0,0 +1,57 @@
+"""
+Test module for iotrans export progress reporting
+"""
+
+from ckan.common import config
+from ckanext.iotrans import progress
+
+
+def test_export_progress_is_readable(monkeypatch, tmp_path):
+    """checks if progress published by an export can be read back"""
+    monkeypatch.setitem(config, "ckan.storage_path", str(tmp_path))
+
+    export_progress = progress.ExportProgress(
+        "resource-id", stage_count=2, total=2000, interval=60
+    )
+    export_progress.stage("dump")
+    export_progress.update(1000)
+
+    # updates within the interval arent written to disk
+    record = progress.read_progress("resource-id")
+    assert record["state"] == "running"
+    assert record["stage"] == "dump"
+    assert record["rows"] == 0
+
+    export_progress.stage("csv-None")
+    export_progress.finish()
+
+    record = progress.read_progress("resource-id")
+    assert record["state"] == "finished"
+    assert record["stages_done"] == ["dump", "csv-None"]
+    assert record["rows"] == record["total"] == 2000
+
+
+def test_read_progress_without_export(monkeypatch, tmp_path):
+    """checks if progress is None for resources never exported"""
+    monkeypatch.setitem(config, "ckan.storage_path", str(tmp_path))
+
+    assert progress.read_progress("resource-id") is None
+
+
+def test_export_progress_lock(monkeypatch, tmp_path):
+    """checks if only one export of a resource can hold its lock"""
+    monkeypatch.setitem(config, "ckan.storage_path", str(tmp_path))
+
+    first = progress.ExportProgress("resource-id")
+    second = progress.ExportProgress("resource-id")
+    assert first.acquire()
+    assert not second.acquire()
+    other = progress.ExportProgress("other-resource-id")
+    assert other.acquire()
+    other.release()
+
+    first.finish()
+    assert second.acquire()
+    second.finish(error="failed")
+    assert first.acquire()
+    first.release()
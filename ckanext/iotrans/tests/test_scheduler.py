@@ -0,0 +1,76 @@
+"""
+Test module for the iotrans export scheduler
+"""
+
+from ckanext.iotrans import scheduler
+import threading
+
+
+def _blocked_scheduler(aging_seconds=60):
+    """returns a 1 worker scheduler, busy until the returned event is set"""
+    export_scheduler = scheduler.ExportScheduler(1, aging_seconds)
+    release = threading.Event()
+    export_scheduler.submit(release.wait)
+    while not export_scheduler.status()["running"]:
+        threading.Event().wait(0.01)
+    return export_scheduler, release
+
+
+def test_estimate_cost_ranks_spatial_exports_higher():
+    """test case for scheduler.estimate_cost"""
+    lookup_table = scheduler.estimate_cost(50, ["_id", "name"], ["csv"])
+    parcels = scheduler.estimate_cost(
+        20000000, ["_id", "name", "geometry"], ["csv", "shp"], [4326, 2952]
+    )
+
+    assert scheduler.get_priority(lookup_table) == "small"
+    assert scheduler.get_priority(parcels) == "large"
+
+
+def test_estimate_cost_format_weights():
+    """checks if scheduler.estimate_cost weighs every format to_file
+    writes, and only charges mbtiles for one EPSG"""
+    fields = ["_id", "name", "geometry"]
+
+    def cost(target_formats, target_epsgs=None):
+        return scheduler.estimate_cost(1000, fields, target_formats,
+                                       target_epsgs or [4326])
+
+    assert cost(["mbtiles"]) > cost(["shp"]) > cost(["csv"])
+    assert cost(["mbtiles"], [4326, 2952]) == cost(["mbtiles"])
+    assert cost(["csv"], [4326, 2952]) == 2 * cost(["csv"])
+    assert scheduler.estimate_cost(1000, ["_id"], ["xlsx"]) > (
+        scheduler.estimate_cost(1000, ["_id"], ["csv"])
+    )
+
+
+def test_scheduler_runs_small_jobs_first():
+    """checks if a queued small job runs before an older large one"""
+    export_scheduler, release = _blocked_scheduler()
+    finished = []
+    large = export_scheduler.submit(lambda: finished.append("large"), 10 ** 12)
+    small = export_scheduler.submit(lambda: finished.append("small"), 1)
+
+    assert export_scheduler.status()["queued"] == {
+        "small": 1, "medium": 0, "large": 1
+    }
+
+    release.set()
+    large.result(timeout=5)
+    small.result(timeout=5)
+    assert finished == ["small", "large"]
+
+
+def test_scheduler_ages_waiting_jobs():
+    """checks if a large job that waited long enough runs before a new
+    small job"""
+    export_scheduler, release = _blocked_scheduler(aging_seconds=0.01)
+    finished = []
+    large = export_scheduler.submit(lambda: finished.append("large"), 10 ** 12)
+    threading.Event().wait(0.1)
+    small = export_scheduler.submit(lambda: finished.append("small"), 1)
+
+    release.set()
+    large.result(timeout=5)
+    small.result(timeout=5)
+    assert finished == ["large", "small"]
@@ -0,0 +1,134 @@
+"""
+Test module for the iotrans vector tile builder
+"""
+
+from ckanext.iotrans import tiles
+import gzip
+import os
+import sqlite3
+
+
+def _read_message(data):
+    """returns {field number: [values]} of a protobuf message"""
+    fields, i = {}, 0
+    while i < len(data):
+        key, i = _read_varint(data, i)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, i = _read_varint(data, i)
+        elif wire_type == 1:
+            value, i = data[i:i + 8], i + 8
+        else:
+            length, i = _read_varint(data, i)
+            value, i = data[i:i + length], i + length
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def _read_varint(data, i):
+    value, shift = 0, 0
+    while True:
+        value |= (data[i] & 0x7F) << shift
+        i += 1
+        shift += 7
+        if data[i - 1] < 0x80:
+            return value, i
+
+
+def _read_packed(data):
+    values, i = [], 0
+    while i < len(data):
+        value, i = _read_varint(data, i)
+        values.append(value)
+    return values
+
+
+def test_encode_geometry():
+    """checks if polygons get MVT commands, with clockwise exterior rings"""
+    # a square, counter clockwise in tile coordinates
+    square = [[(10, 10), (10, 20), (20, 20), (20, 10), (10, 10)]]
+
+    # so it is written from its last corner, the other way around
+    assert tiles._encode_geometry(tiles.POLYGON, [square], 0, 0) == bytes([
+        9, 40, 20,  # MoveTo 20, 10
+        26, 0, 20, 19, 0, 0, 19,  # LineTo 20, 20 - 10, 20 - 10, 10
+        15,  # ClosePath
+    ])
+
+
+def test_write_to_mbtiles(tmp_path):
+    """checks if tiles.write_to_mbtiles builds a tile pyramid"""
+    features = [
+        {"type": "Feature", "properties": {"name": "a", "n": -3},
+         "geometry": {"type": "MultiPoint", "coordinates": [[-79.38, 43.65]]}},
+        {"type": "Feature", "properties": {"name": "b", "n": None},
+         "geometry": {"type": "MultiLineString",
+                      "coordinates": [[[-79.5, 43.6], [-79.3, 43.7]]]}},
+        {"type": "Feature", "properties": {"name": "c", "n": 1},
+         "geometry": None},
+    ]
+    filepath = os.path.join(tmp_path, "test - 3857.mbtiles")
+
+    tiles.write_to_mbtiles(
+        filepath, iter(features), "test", 0, 4, drop_rate=1
+    )
+
+    assert os.listdir(tmp_path) == ["test - 3857.mbtiles"]
+    connection = sqlite3.connect(filepath)
+    metadata = dict(connection.execute("SELECT * FROM metadata"))
+    assert metadata["format"] == "pbf"
+    assert metadata["bounds"] == "-79.5,43.6,-79.3,43.7"
+    assert [row[0] for row in connection.execute(
+        "SELECT zoom_level FROM tiles ORDER BY zoom_level"
+    )] == [0, 1, 2, 3, 4]
+
+    # Toronto is in tile 4/4/5, which mbtiles stores as row 10
+    tile_data, = connection.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = 4 "
+        "AND tile_column = 4 AND tile_row = 10"
+    ).fetchone()
+    connection.close()
+    layer = _read_message(_read_message(gzip.decompress(tile_data))[3][0])
+    assert layer[1] == [b"test"]
+    assert layer[5] == [tiles.EXTENT]
+    assert layer[3] == [b"name", b"n"]
+
+    features = [_read_message(feature) for feature in layer[2]]
+    assert [feature[1] for feature in features] == [[1], [2]]
+    assert [feature[3] for feature in features] == [
+        [tiles.POINT], [tiles.LINESTRING]
+    ]
+    # the line has no "n" tag, as its value is None
+    assert [len(_read_packed(feature[2][0])) for feature in features] == [4, 2]
+
+
+def test_count_tiles():
+    """test case for tiles.count_tiles"""
+    assert tiles.count_tiles([-180, -85, 180, 85], 0) == 1
+    assert tiles.count_tiles([-180, -85, 180, 85], 2) == 16
+    # Toronto fits in one tile at zoom 4, and spreads over 2 at zoom 10
+    assert tiles.count_tiles([-79.5, 43.6, -79.3, 43.7], 4) == 1
+    assert tiles.count_tiles([-79.5, 43.6, -79.3, 43.7], 10) == 2
+
+
+def test_estimate_mbtiles_bytes(tmp_path):
+    """checks if tiles.estimate_mbtiles_bytes scales a sample up to about
+    the size of the whole pyramid"""
+    features = [
+        {"type": "Feature", "properties": {"n": i},
+         "geometry": {"type": "MultiPoint", "coordinates": [
+             [-79.6 + (i % 40) * 0.01, 43.6 + (i // 40) * 0.01]
+         ]}}
+        for i in range(400)
+    ]
+    filepath = os.path.join(tmp_path, "all.mbtiles")
+    tiles.write_to_mbtiles(filepath, iter(features), "test", 0, 12)
+    actual = os.path.getsize(filepath)
+
+    scratch_path = os.path.join(tmp_path, "scratch")
+    os.makedirs(scratch_path)
+    estimate = tiles.estimate_mbtiles_bytes(
+        scratch_path, iter(features[::4]), 100, 400, "test", 0, 12
+    )
+    assert os.listdir(scratch_path) == []
+    assert actual / 2 < estimate < actual * 2
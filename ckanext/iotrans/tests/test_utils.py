@@ -5,10 +5,21 @@ Test module for various iotrans functions
 from .utils import CORRECT_DIR_PATH, TEST_TMP_PATH
 
 import ckanext.iotrans.utils as utils
+import datetime
+import errno
 import filecmp
+import fiona
+import hashlib
 import json
+import openpyxl
 import os
 import pytest
+import subprocess
+import sys
+import tarfile
+import zipfile
+from fiona.crs import from_epsg
+from ckan.common import config
 
 
 # Define fixtures
@@ -115,3 +126,628 @@ def test_dump_to_geospatial_generator(correct_geospatial_generator):
         assert len(item["properties"])
         assert all(x in item['geometry'] for x in ('coordinates', 'type'))
         assert len(item["geometry"])
+
+
+def test_estimate_output_sizes_nonspatial():
+    """test case for utils.estimate_output_sizes on non-spatial records"""
+    records = [{"_id": 1, "the year": 2014}, {"_id": 2, "the year": 2013}]
+    fields = [{"id": "_id", "type": "int"}, {"id": "the year", "type": "int"}]
+    sizes = utils.estimate_output_sizes(records, fields, ["csv", "json"])
+
+    assert sizes["csv-None"] == len("1,2014\r\n")
+    assert sizes["json-None"] == len('{"_id": 1, "the year": 2014}, ')
+
+
+@pytest.mark.parametrize("error_policy", ["fail", "skip", "null"])
+def test_estimate_output_sizes_error_policy(error_policy):
+    """checks if utils.estimate_output_sizes skips or nulls sample
+    geometries that can't be reprojected, as to_file would"""
+    records = [
+        {"_id": 1, "geometry": '{"type": "Point", "coordinates": [1, 2]}'},
+        {"_id": 2, "geometry": "not a geometry"},
+    ]
+    fields = [{"id": "_id", "type": "int"}, {"id": "geometry", "type": "text"}]
+    arguments = (records, fields, ["csv"], 4326, [4326])
+    if error_policy == "fail":
+        with pytest.raises(ValueError):
+            utils.estimate_output_sizes(*arguments)
+        return
+
+    sizes = utils.estimate_output_sizes(*arguments, error_policy=error_policy)
+    first_row = utils.estimate_output_sizes(
+        records[:1], fields, ["csv"], 4326, [4326]
+    )["csv-4326"]
+    if error_policy == "skip":
+        assert sizes["csv-4326"] == first_row / 2
+    else:
+        assert sizes["csv-4326"] == (first_row + len("2,\r\n")) / 2
+
+
+def test_write_to_csv_from_row_tuples(tmp_path):
+    """test case for utils.write_to_csv with rows made by utils.row_getter"""
+    fieldnames = ["_id", "the year"]
+    records = [{"_id": 1, "the year": 2014}, {"_id": 2, "the year": None}]
+    filepath = os.path.join(tmp_path, "test.csv")
+
+    utils.write_to_csv(filepath, fieldnames,
+                       map(utils.row_getter(fieldnames), records))
+
+    with open(filepath, newline="") as f:
+        assert f.read() == "_id,the year\r\n1,2014\r\n2,\r\n"
+
+
+def test_property_converter():
+    """test case for utils.property_converter on dump row values"""
+    to_properties = utils.property_converter(
+        ["int4", "numeric", "text", "date"], ["a", "b", "c", "d"]
+    )
+
+    assert to_properties(["2014", "1.5", "text", "2020-01-01"]) == {
+        "a": 2014, "b": 1.5, "c": "text", "d": "2020-01-01"
+    }
+    assert to_properties(["", "", "", ""]) == {
+        "a": None, "b": None, "c": "", "d": None
+    }
+
+
+def test_write_to_xlsx(tmp_path):
+    """checks if utils.write_to_xlsx types cells from the fields
+    and rolls over to a new sheet when one is full"""
+    dump_filepath = os.path.join(tmp_path, "test.csv")
+    with open(dump_filepath, "w", newline="") as f:
+        f.write(
+            "_id,the year,ratio,day,name\r\n"
+            "1,2014,1.5,2014-01-01T10:00:00,a\r\n"
+            "2,2013,,2013-01-01T00:00:00,b\x00\r\n"
+            "3,,2.5,,c\r\n"
+        )
+    fields = [
+        {"id": "_id", "type": "int"},
+        {"id": "the year", "type": "int4"},
+        {"id": "ratio", "type": "numeric"},
+        {"id": "day", "type": "timestamp"},
+        {"id": "name", "type": "text"},
+    ]
+    filepath = os.path.join(tmp_path, "test.xlsx")
+
+    utils.write_to_xlsx(dump_filepath, filepath, fields, max_rows=3)
+
+    workbook = openpyxl.load_workbook(filepath, read_only=True)
+    assert workbook.sheetnames == ["Data", "Data 2"]
+    assert [list(row) for row in workbook["Data"].values] == [
+        ["_id", "the year", "ratio", "day", "name"],
+        [1, 2014, 1.5, datetime.datetime(2014, 1, 1, 10), "a"],
+        [2, 2013, None, datetime.datetime(2013, 1, 1), "b"],
+    ]
+    assert [list(row) for row in workbook["Data 2"].values] == [
+        ["_id", "the year", "ratio", "day", "name"],
+        [3, None, 2.5, None, "c"],
+    ]
+    workbook.close()
+
+
+def test_write_to_geojson(tmp_path):
+    """checks if utils.write_to_geojson writes what GDAL's GeoJSON driver
+    wrote for the correct_empty_spatial fixture"""
+    filepath = os.path.join(tmp_path, "test_fixture_resource - 2952.geojson")
+    features = [
+        {"type": "Feature", "properties": {"_id": 1, "the year": 2014},
+         "geometry": {"type": "MultiPoint", "coordinates": [[0, 0]]}},
+        {"type": "Feature", "properties": {"_id": 2, "the year": 2012},
+         "geometry": {"type": "MultiPoint", "coordinates": []}},
+    ]
+
+    utils.write_to_geojson(filepath, iter(features), 2952)
+
+    assert filecmp.cmp(
+        filepath,
+        os.path.join(CORRECT_DIR_PATH, "correct_empty_spatial - 2952.geojson"),
+        shallow=False,
+    )
+
+
+@pytest.mark.parametrize("value, formatted", [
+    (0, "0.0"),
+    (43.6, "43.6"),
+    (-79.556501959627, "-79.556501959626999"),
+    (2 - 1e-14, "2.0"),
+    (1e-7, "0.0000001"),
+    (12345.000000011, "12345.000000010999429"),
+])
+def test_geojson_coordinate(value, formatted):
+    """test case for utils._geojson_coordinate matching GDAL's output"""
+    assert utils._geojson_coordinate(value) == formatted
+
+
+def test_write_to_zipped_shapefile(tmp_path):
+    """checks if utils.write_to_zipped_shapefile moves every component of
+    a shapefile, and the fields csv, into a compressed zip"""
+    shp_dir = os.path.join(tmp_path, "shp")
+    os.mkdir(shp_dir)
+    shapefile_path = os.path.join(shp_dir, "test_spatial - 4326.shp")
+    with fiona.open(
+        shapefile_path, "w", driver="ESRI Shapefile", crs=from_epsg(4326),
+        schema={"geometry": "MultiPoint", "properties": {"the yea2": "int"}},
+    ) as outlayer:
+        outlayer.write({
+            "type": "Feature", "properties": {"the yea2": 2014},
+            "geometry": {"type": "MultiPoint", "coordinates": [[-79.5, 43.6]]},
+        })
+
+    zip_filepath = utils.write_to_zipped_shapefile(
+        ["_id", "the year value column name", "geometry"],
+        {"name": "test_spatial"},
+        shapefile_path,
+        os.path.join(tmp_path, "test_spatial - 4326.shp"),
+        {"_id": "_id1", "the year value column name": "the yea2"},
+        zipfile.ZIP_DEFLATED,
+    )
+
+    assert zip_filepath == os.path.join(tmp_path, "test_spatial - 4326.zip")
+    assert os.listdir(shp_dir) == []
+    with zipfile.ZipFile(zip_filepath) as archive:
+        assert sorted(archive.namelist()) == [
+            "test_spatial - 4326.cpg", "test_spatial - 4326.dbf",
+            "test_spatial - 4326.prj", "test_spatial - 4326.shp",
+            "test_spatial - 4326.shx", "test_spatial fields.csv",
+        ]
+        assert all([info.compress_type == zipfile.ZIP_DEFLATED
+                    for info in archive.infolist()])
+        with open(os.path.join(CORRECT_DIR_PATH, "correct_spatial fields.csv"),
+                  "rb") as f:
+            assert archive.read("test_spatial fields.csv") == f.read()
+
+
+def test_write_shapefile_parts(tmp_path):
+    """checks if utils.write_shapefile_parts rolls over to a new part
+    before a part's .shp passes max_bytes"""
+    schema = {"geometry": "MultiPolygon", "properties": {"the year": "int"}}
+    geometry = {"type": "MultiPolygon", "coordinates": [
+        [[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 0.0]]]
+    ]}
+    features = [
+        {"type": "Feature", "properties": {"the year": year},
+         "geometry": geometry}
+        for year in range(10)
+    ]
+    # room for the .shp header and 3 polygons
+    max_bytes = 100 + 3 * utils.shapefile_record_bytes(geometry)
+    os.mkdir(os.path.join(tmp_path, "shp"))
+    shapefile_path = os.path.join(tmp_path, "shp", "test_spatial - 4326.shp")
+
+    parts = utils.write_shapefile_parts(
+        shapefile_path, schema, from_epsg(4326), features, max_bytes
+    )
+
+    assert [os.path.basename(filepath) for filepath, rows in parts] == [
+        "test_spatial - 4326 part {}.shp".format(i) for i in range(1, 5)
+    ]
+    assert [rows for filepath, rows in parts] == [3, 3, 3, 1]
+    assert not os.path.exists(shapefile_path)
+
+    years = []
+    for filepath, rows in parts:
+        assert os.path.getsize(filepath) <= max_bytes
+        with fiona.open(filepath) as part:
+            years += [feature["properties"]["the year"] for feature in part]
+    assert years == list(range(10))
+
+    zip_filepath = utils.write_to_zipped_shapefile(
+        ["_id", "the year", "geometry"], {"name": "test_spatial"},
+        shapefile_path, os.path.join(tmp_path, "test_spatial - 4326.shp"),
+        {"_id": "_id", "the year": "the year"}, parts=parts,
+    )
+    with zipfile.ZipFile(zip_filepath) as archive:
+        assert len(archive.namelist()) == 4 * 5 + 2
+        assert archive.read("test_spatial - 4326 manifest.csv").decode() == (
+            "part,shapefile,rows\r\n"
+            "1,test_spatial - 4326 part 1.shp,3\r\n"
+            "2,test_spatial - 4326 part 2.shp,3\r\n"
+            "3,test_spatial - 4326 part 3.shp,3\r\n"
+            "4,test_spatial - 4326 part 4.shp,1\r\n"
+        )
+
+
+def test_partitioner_and_index(tmp_path):
+    """test case for utils.Partitioner and utils.write_partition_index"""
+    fieldnames = ["_id", "the year"]
+    records = [{"_id": i, "the year": 2014 - i} for i in range(1, 6)]
+    output_filepath = os.path.join(tmp_path, "test.csv")
+
+    partitioner = utils.Partitioner(
+        map(utils.row_getter(fieldnames), records), 2
+    )
+    part_filepaths = []
+    for i, rows in enumerate(partitioner.parts()):
+        part_filepaths.append(utils.part_filepath(output_filepath, i + 1))
+        utils.write_to_csv(part_filepaths[-1], fieldnames, rows)
+
+    assert partitioner.counts == [2, 2, 1]
+    with open(part_filepaths[2], newline="") as f:
+        assert f.read() == "_id,the year\r\n5,2009\r\n"
+
+    output = utils.write_partition_index(
+        output_filepath, part_filepaths, partitioner.counts
+    )
+    assert output["index"] == os.path.join(tmp_path, "test csv index.json")
+    with open(output["index"]) as f:
+        index = json.load(f)
+    assert index["rows"] == 5
+    assert [part["file"] for part in index["parts"]] == [
+        "test part 1.csv", "test part 2.csv", "test part 3.csv"
+    ]
+    assert [part["offset"] for part in index["parts"]] == [0, 2, 4]
+
+
+@pytest.mark.parametrize("bundle_format", ["zip", "tar"])
+def test_bundle(tmp_path, bundle_format):
+    """checks if utils.Bundle adds each output file to its archive once,
+    parts and index included"""
+    filepaths = []
+    for name in ["test.csv", "test part 1.json", "test part 2.json",
+                 "test json index.json"]:
+        filepaths.append(os.path.join(tmp_path, name))
+        with open(filepaths[-1], "w") as f:
+            f.write(name)
+    bundle_filepath = os.path.join(tmp_path, "test bundle." + bundle_format)
+
+    bundle = utils.Bundle(bundle_filepath, bundle_format)
+    output = {"csv-None": filepaths[0]}
+    bundle.add(output)
+    output["json-None"] = {"index": filepaths[3], "parts": filepaths[1:3]}
+    bundle.add(output)
+
+    if bundle_format == "zip":
+        with zipfile.ZipFile(bundle_filepath) as archive:
+            contents = {name: archive.read(name).decode()
+                        for name in archive.namelist()}
+    else:
+        with tarfile.open(bundle_filepath) as archive:
+            contents = {member.name: archive.extractfile(member).read().decode()
+                        for member in archive.getmembers()}
+    assert contents == {
+        os.path.basename(filepath): os.path.basename(filepath)
+        for filepath in filepaths
+    }
+
+
+@pytest.mark.parametrize("bundle_format", ["zip", "tar"])
+def test_bundle_stream(tmp_path, bundle_format):
+    """checks if a streaming utils.Bundle takes files written with
+    utils.open_output as they're written, one at a time, and still copies
+    the others"""
+    def filepath(name):
+        return os.path.join(tmp_path, name)
+
+    bundle_filepath = filepath("test bundle." + bundle_format)
+    bundle = utils.Bundle(bundle_filepath, bundle_format)
+    output = {}
+
+    # one file streamed, while another is opened, and one not streamed
+    bundle.stream()
+    with utils.open_output(filepath("test.csv")) as f:
+        with utils.open_output(filepath("test.json")) as g:
+            g.write("json")
+        f.write("_id,the year\r\n1,2014\r\n")
+    with utils.open_output(filepath("test errors.csv"), stream=False) as f:
+        f.write("errors")
+    # streamed files aren't read back
+    with open(filepath("test.csv"), "w") as f:
+        f.write("not read")
+    output["csv-None"] = filepath("test.csv")
+    output["json-None"] = filepath("test.json")
+    output["errors"] = filepath("test errors.csv")
+    bundle.add(output)
+
+    # files written after add aren't streamed; streaming resumes after a copy
+    with open(filepath("test.xlsx"), "w") as f:
+        f.write("xlsx")
+    output["xlsx-None"] = filepath("test.xlsx")
+    bundle.add(output)
+    bundle.stream()
+    with utils.open_output(filepath("test.xml"), binary=True) as f:
+        f.write(b"xml" * 1000)
+    output["xml-None"] = filepath("test.xml")
+    bundle.add(output)
+
+    if bundle_format == "zip":
+        with zipfile.ZipFile(bundle_filepath) as archive:
+            assert archive.testzip() is None
+            contents = {name: archive.read(name)
+                        for name in archive.namelist()}
+    else:
+        with tarfile.open(bundle_filepath) as archive:
+            contents = {member.name: archive.extractfile(member).read()
+                        for member in archive.getmembers()}
+    assert contents == {
+        "test.csv": b"_id,the year\r\n1,2014\r\n",
+        "test.json": b"json",
+        "test errors.csv": b"errors",
+        "test.xlsx": b"xlsx",
+        "test.xml": b"xml" * 1000,
+    }
+    utils.forget_digests(str(tmp_path))
+
+
+def test_file_digest(tmp_path):
+    """checks if utils.file_digest hashes files written with
+    utils.open_output as they were written, and reads others"""
+    written = os.path.join(tmp_path, "written.csv")
+    with utils.open_output(written) as f:
+        f.write("_id,the year\r\n1,2014\r\n")
+    other = os.path.join(tmp_path, "other.csv")
+    with open(other, "wb") as f:
+        f.write(b"_id,the year\r\n1,2014\r\n")
+
+    for filepath in [written, other]:
+        digest = utils.file_digest(filepath)
+        with open(filepath, "rb") as f:
+            contents = f.read()
+        assert digest == {
+            "file": os.path.basename(filepath),
+            "bytes": len(contents),
+            "md5": hashlib.md5(contents).hexdigest(),
+            "sha256": hashlib.sha256(contents).hexdigest(),
+        }
+
+
+def test_add_to_manifest(tmp_path):
+    """checks if utils.add_to_manifest lists the rows of each output,
+    and of each part of partitioned outputs"""
+    output_filepath = os.path.join(tmp_path, "test.csv")
+    part_filepaths = []
+    for i, rows in enumerate([["1,2014", "2,2013"], ["3,2012"]]):
+        part_filepaths.append(utils.part_filepath(output_filepath, i + 1))
+        with utils.open_output(part_filepaths[-1]) as f:
+            f.write("\r\n".join(["_id,the year"] + rows) + "\r\n")
+    output = {
+        "csv-None": utils.write_partition_index(
+            output_filepath, part_filepaths, [2, 1]
+        ),
+    }
+
+    manifest = utils.add_to_manifest({}, output, 3)
+
+    assert manifest["csv-None"]["rows"] == 3
+    assert manifest["csv-None"]["index"]["file"] == "test csv index.json"
+    assert [(part["file"], part["rows"], part["bytes"])
+            for part in manifest["csv-None"]["parts"]] == [
+        ("test part 1.csv", 2, 30), ("test part 2.csv", 1, 22)
+    ]
+
+
+def test_publish_outputs(tmp_path, monkeypatch):
+    """checks if utils.publish_outputs moves output files into place,
+    copying them when they're on another filesystem"""
+    scratch_path = os.path.join(tmp_path, "scratch")
+    storage_path = os.path.join(tmp_path, "storage")
+    os.mkdir(scratch_path)
+    os.mkdir(storage_path)
+    filepaths = []
+    for name in ["test.csv", "test part 1.json", "test json index.json"]:
+        filepaths.append(os.path.join(scratch_path, name))
+        with open(filepaths[-1], "w") as f:
+            f.write(name)
+    output = {
+        "csv-None": filepaths[0],
+        "json-None": {"index": filepaths[2], "parts": filepaths[1:2]},
+        "manifest": {},
+    }
+
+    # pretend scratch_path is on another filesystem
+    replace = os.replace
+
+    def cross_device_replace(source, destination):
+        if os.path.dirname(source) == scratch_path:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        replace(source, destination)
+
+    monkeypatch.setattr(utils.os, "replace", cross_device_replace)
+    published = utils.publish_outputs(output, storage_path)
+
+    assert published == {
+        "csv-None": os.path.join(storage_path, "test.csv"),
+        "json-None": {
+            "index": os.path.join(storage_path, "test json index.json"),
+            "parts": [os.path.join(storage_path, "test part 1.json")],
+        },
+        "manifest": {},
+    }
+    assert os.listdir(scratch_path) == []
+    assert sorted(os.listdir(storage_path)) == [
+        "test json index.json", "test part 1.json", "test.csv"
+    ]
+    with open(published["csv-None"]) as f:
+        assert f.read() == "test.csv"
+
+
+def test_gdal_loaded_on_first_use():
+    """checks if importing iotrans leaves GDAL unloaded until
+    utils.load_gdal is called"""
+    code = (
+        "import sys\n"
+        "import ckanext.iotrans.plugin\n"
+        "from ckanext.iotrans import utils\n"
+        "assert 'fiona' not in sys.modules\n"
+        "assert utils.load_gdal() is sys.modules['fiona']\n"
+        "assert utils.transform_geom is not None\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_partitioner_empty():
+    """an empty resource is still written as one, empty, part"""
+    partitioner = utils.Partitioner([], 2)
+    assert [list(rows) for rows in partitioner.parts()] == [[]]
+    assert partitioner.counts == [0]
+
+
+@pytest.mark.parametrize("geometry,bounds", [
+    ('{"type": "Point", "coordinates": [-79.5, 43.6]}', (-79.5, 43.6, -79.5, 43.6)),
+    ("{'type': 'LineString', 'coordinates': [[-79.5, 43.6], [-79.2, 43.3]]}",
+     (-79.5, 43.3, -79.2, 43.6)),
+    ('{"type": "Point", "coordinates": [null, null]}', None),
+    (None, None),
+])
+def test_geometry_bounds(geometry, bounds):
+    """test case for utils.geometry_bounds"""
+    assert utils.geometry_bounds(geometry) == bounds
+
+
+def test_in_bbox():
+    """checks if utils.in_bbox keeps records whose geometry touches bbox"""
+    records = [
+        {"_id": 1, "geometry": '{"type": "Point", "coordinates": [-79.5, 43.6]}'},
+        {"_id": 2, "geometry": '{"type": "Point", "coordinates": [-79.2, 43.3]}'},
+        {"_id": 3, "geometry": '{"type": "LineString", '
+                               '"coordinates": [[-80, 43], [-79.4, 43.4]]}'},
+        {"_id": 4, "geometry": None},
+    ]
+    bbox = [-79.6, 43.4, -79.4, 43.7]
+
+    assert [record["_id"] for record in utils.in_bbox(records, bbox)] == [1, 3]
+
+    # unreadable geometries fail, or are kept for error_policy to handle
+    records.append({"_id": 5, "geometry": "not a geometry"})
+    with pytest.raises(ValueError):
+        list(utils.in_bbox(records, bbox))
+    assert [
+        record["_id"] for record in utils.in_bbox(records, bbox, True)
+    ] == [1, 3, 5]
+
+
+def test_simplify_geometry():
+    """test case for utils.simplify_geometry"""
+    line = '{"type": "LineString", "coordinates": ' \
+           '[[0, 0], [1, 0.05], [2, 0], [2, 2]]}'
+    assert utils.simplify_geometry(line, 0.1)["coordinates"] == [
+        [0, 0], [2, 0], [2, 2]
+    ]
+
+    # rings keep at least 4 positions
+    polygon = {"type": "Polygon",
+               "coordinates": [[[0, 0], [1, 0.05], [2, 0], [0, 0]]]}
+    assert utils.simplify_geometry(polygon, 1)["coordinates"] == [
+        [[0, 0], [1, 0.05], [2, 0], [0, 0]]
+    ]
+
+
+def test_round_geometry():
+    """checks if utils.round_geometry rounds every coordinate"""
+    geometry = utils.transform_epsg(
+        4326, 4326,
+        '{"type": "LineString", "coordinates": '
+        '[[-79.556501959627, 43.632603612174], [-79.25234, 43.3326034]]}'
+    )
+    assert utils.round_geometry(geometry, 4)["coordinates"] == [
+        [[-79.5565, 43.6326], [-79.2523, 43.3326]]
+    ]
+
+
+def test_reprojection_geometry_cache(tmp_path):
+    """checks if a second utils.Reprojection reads the geometries the first
+    spilled to the cache, and if unfinished spill files are deleted"""
+    geometries = [
+        '{"type": "Point", "coordinates": [-79.556501959627, 43.632603612174]}',
+        '{"type": "LineString", "coordinates": '
+        '[[-79.556501959627, 43.632603612174], [-79.25234, 43.3326034]]}',
+    ]
+    cache = utils.GeometryCache(str(tmp_path))
+
+    unfinished = utils.Reprojection(cache, 4326, 2952, precision=2)
+    unfinished(geometries[0])
+    unfinished.close()
+    assert cache.filepaths == {}
+    assert os.listdir(str(tmp_path)) == []
+
+    first = utils.Reprojection(cache, 4326, 2952, precision=2)
+    reprojected = [dict(first(geometry)) for geometry in geometries]
+    first.finish()
+    first.close()
+    assert list(cache.filepaths.keys()) == [(4326, 2952, 2, None)]
+
+    second = utils.Reprojection(cache, 4326, 2952, precision=2)
+    # the cached geometries are read back in order, not reprojected again
+    assert [second(None) for _ in geometries] == reprojected
+    second.close()
+
+    cache.forget(2952)
+    assert cache.filepaths == {}
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_parallel_reprojection(tmp_path, monkeypatch):
+    """checks if geometries reprojected by ranges of the dump, in a pool of
+    processes, come back in the order and form of a serial Reprojection"""
+    monkeypatch.setattr(utils, "DUMP_RANGE_ROWS", 2)
+    dump_filepath = str(tmp_path / "dump.csv")
+    rows = [
+        [
+            "line\nbreak {}".format(i),
+            '{{"type": "Point", "coordinates": [-79.{0}, 43.{0}]}}'.format(i),
+        ]
+        for i in range(5)
+    ]
+    dump_index = utils.write_to_csv(
+        dump_filepath, ["name", "geometry"], iter(rows), index=True
+    )
+    with open(dump_filepath, "rb") as f:
+        dump = f.read()
+    assert [dump[offset:].startswith(b'"line\nbreak ') for offset in dump_index] \
+        == [True, True, True]
+
+    serial = utils.Reprojection(None, 4326, 2952, precision=3)
+    expected = [dict(serial(row[1])) for row in rows]
+
+    cache = utils.GeometryCache(
+        str(tmp_path), dump_filepath, dump_index, workers=2, keep=False
+    )
+    parallel = utils.Reprojection(cache, 4326, 2952, precision=3)
+    try:
+        assert [parallel(row[1]) for row in rows] == expected
+        parallel.finish()
+    finally:
+        parallel.close()
+    assert cache.filepaths == {}
+    assert sorted(os.listdir(str(tmp_path))) == ["dump.csv"]
+
+
+@pytest.mark.parametrize("policy", ["skip", "null"])
+def test_row_errors(tmp_path, policy):
+    """checks if transform_dump_epsg hands rows whose geometry fails to
+    utils.RowErrors, and skips or nulls them"""
+    dump_filepath = str(tmp_path / "dump.csv")
+    utils.write_to_csv(dump_filepath, ["_id", "geometry"], iter([
+        ["1", '{"type": "Point", "coordinates": [-79.5, 43.6]}'],
+        ["2", '{"type": "Point"}'],
+    ]))
+    errors = utils.RowErrors(str(tmp_path / "errors.csv"), policy)
+    rows = list(utils.transform_dump_epsg(
+        dump_filepath, ["_id", "geometry"], 4326, 4326, errors=errors
+    ))
+    errors.close()
+
+    assert [row[0] for row in rows] == (["1"] if policy == "skip" else ["1", "2"])
+    if policy == "null":
+        assert rows[1][1] == ""
+    assert errors.skipped(4326) == (1 if policy == "skip" else 0)
+    with open(errors.filepath) as f:
+        assert f.read().splitlines() == [
+            "_id,epsg,error",
+            "2,4326,AssertionError: No coordinates in geometry!",
+        ]
+
+
+@pytest.mark.parametrize("name", ["tile_workers", "reproject_workers"])
+def test_get_process_workers(monkeypatch, name):
+    """checks if utils.get_process_workers starts no processes unless
+    asked to, and shares the CPUs between bulk_workers exports"""
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    monkeypatch.setitem(config, "ckanext.iotrans.bulk_workers", 4)
+    monkeypatch.delitem(config, "ckanext.iotrans." + name, raising=False)
+    assert utils.get_process_workers(name) == 1
+
+    monkeypatch.setitem(config, "ckanext.iotrans." + name, 16)
+    assert utils.get_process_workers(name) == 2
+    monkeypatch.setitem(config, "ckanext.iotrans.bulk_workers", 16)
+    assert utils.get_process_workers(name) == 1
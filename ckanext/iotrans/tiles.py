@@ -0,0 +1,729 @@
+'''Builds MBTiles vector tile pyramids for to_file
+
+Tiles are Mapbox Vector Tiles, in web mercator, encoded without a protobuf
+library. Features are projected once into a scratch SQLite database. Each
+zoom level is then cut into pieces of tiles a chunk of features at a
+time, and the pieces are put together into one gzipped tile each a band of
+tile columns at a time. Both run across processes.
+'''
+
+import os
+import math
+import gzip
+import json
+import struct
+import marshal
+import sqlite3
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .geometry import simplify_line
+
+
+# tiles are always web mercator
+EPSG = 3857
+
+# tile coordinates go from 0 to EXTENT, and features are kept this far
+# past the edge of a tile so lines and polygons join up when drawn
+EXTENT = 4096
+BUFFER = 64
+
+# how many features each tile building job cuts at once
+CHUNK_FEATURES = 20000
+
+# bytes an mbtiles row and its index entry take up, besides its tile
+TILE_ROW_BYTES = 32
+
+# web mercator stops short of the poles
+MAX_LATITUDE = 85.0511287798066
+
+# MVT geometry types
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+GEOMETRY_TYPES = {
+    "Point": POINT,
+    "LineString": LINESTRING,
+    "Polygon": POLYGON,
+}
+
+# MVT geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+
+def _varint(value):
+    '''protobuf varint of a positive integer'''
+    data = bytearray()
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _zigzag(value):
+    '''protobuf zigzag encoding, so small negative numbers stay short'''
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(number, wire_type):
+    return _varint(number << 3 | wire_type)
+
+
+def _message(number, data):
+    '''a length delimited protobuf field'''
+    return _key(number, 2) + _varint(len(data)) + data
+
+
+# most geometry commands and tags are small, so their varints are kept
+_SMALL_VARINTS = [_varint(value) for value in range(1 << 14)]
+
+
+def _packed(values):
+    return b"".join([
+        _SMALL_VARINTS[value] if value < 16384 else _varint(value)
+        for value in values
+    ])
+
+
+def _command(command, count):
+    return command | count << 3
+
+
+def project(lon, lat):
+    '''Returns where lon, lat falls in web mercator, scaled from 0 to 1'''
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    sin = math.sin(math.radians(lat))
+    return (
+        (lon + 180) / 360,
+        0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi),
+    )
+
+
+def _project_geometry(geometry):
+    '''Returns the MVT type and projected parts of a EPSG 4326 geometry
+    from transform_epsg, or None if it has no coordinates'''
+    if not geometry or not geometry["coordinates"]:
+        return None
+    name = geometry["type"].replace("Multi", "")
+    coordinates = geometry["coordinates"]
+    if not geometry["type"].startswith("Multi"):
+        coordinates = [coordinates]
+
+    def line(positions):
+        return [project(position[0], position[1]) for position in positions]
+
+    if name == "Point":
+        parts = [
+            project(position[0], position[1]) for position in coordinates
+            if position and position[0] is not None
+        ]
+    elif name == "LineString":
+        parts = [line(part) for part in coordinates if len(part) > 1]
+    else:
+        parts = [
+            [line(ring) for ring in polygon]
+            for polygon in coordinates if polygon
+        ]
+    if not parts:
+        return None
+    return GEOMETRY_TYPES[name], parts
+
+
+def _field_type(value):
+    '''Returns the TileJSON type of a property value'''
+    if isinstance(value, bool):
+        return "Boolean"
+    if isinstance(value, (int, float)):
+        return "Number"
+    return "String"
+
+
+def write_features(features_path, features):
+    '''Projects features from dump_to_geospatial_generator, in EPSG 4326,
+    into a scratch SQLite database to cut tiles from
+
+    Returns the number of features written, the bounds of their
+    coordinates and the TileJSON types of their properties
+    '''
+    database = sqlite3.connect(features_path)
+    database.execute(
+        "CREATE TABLE features "
+        "(id INTEGER PRIMARY KEY, type INTEGER, geometry BLOB, properties TEXT)"
+    )
+    bounds = [180, 90, -180, -90]
+    field_types = {}
+    rows = []
+    count = 0
+    for feature in features:
+        projected = _project_geometry(feature["geometry"])
+        if projected is None:
+            continue
+
+        # bounds are kept in lon, lat for the mbtiles metadata
+        longitudes, latitudes = [], []
+        stack = [feature["geometry"]["coordinates"]]
+        while stack:
+            coordinates = stack.pop()
+            if coordinates and isinstance(coordinates[0], (list, tuple)):
+                stack.extend(coordinates)
+            elif coordinates and coordinates[0] is not None:
+                longitudes.append(coordinates[0])
+                latitudes.append(coordinates[1])
+        bounds = [
+            min(bounds[0], *longitudes), min(bounds[1], *latitudes),
+            max(bounds[2], *longitudes), max(bounds[3], *latitudes),
+        ]
+
+        properties = dict(feature["properties"])
+        for key, value in properties.items():
+            if value is not None and key not in field_types:
+                field_types[key] = _field_type(value)
+
+        count += 1
+        rows.append((
+            count, projected[0], marshal.dumps(projected[1]),
+            json.dumps(properties),
+        ))
+        if len(rows) >= CHUNK_FEATURES:
+            database.executemany(
+                "INSERT INTO features VALUES (?, ?, ?, ?)", rows
+            )
+            rows = []
+    database.executemany("INSERT INTO features VALUES (?, ?, ?, ?)", rows)
+    database.commit()
+    database.close()
+    return count, bounds, field_types
+
+
+def _clip_line(positions, k1, k2, axis, closed):
+    '''Clips a line or ring to k1 <= position[axis] <= k2
+
+    Returns the parts of a line inside the slab, or a list of the one
+    clipped ring. Positions on the slab's edges join up a ring's parts
+    '''
+    parts = []
+    part = []
+
+    def intersect(a, b, k):
+        t = (k - a[axis]) / (b[axis] - a[axis])
+        if axis == 0:
+            return (k, a[1] + (b[1] - a[1]) * t)
+        return (a[0] + (b[0] - a[0]) * t, k)
+
+    def leave():
+        nonlocal part
+        if not closed:
+            parts.append(part)
+            part = []
+
+    for i in range(len(positions) - 1):
+        a, b = positions[i], positions[i + 1]
+        ak, bk = a[axis], b[axis]
+        if ak < k1:
+            if bk > k1:
+                part.append(intersect(a, b, k1))
+                if bk > k2:
+                    part.append(intersect(a, b, k2))
+                    leave()
+        elif ak > k2:
+            if bk < k2:
+                part.append(intersect(a, b, k2))
+                if bk < k1:
+                    part.append(intersect(a, b, k1))
+                    leave()
+        else:
+            part.append(a)
+            if bk < k1:
+                part.append(intersect(a, b, k1))
+                leave()
+            elif bk > k2:
+                part.append(intersect(a, b, k2))
+                leave()
+
+    if positions and k1 <= positions[-1][axis] <= k2:
+        part.append(positions[-1])
+    if closed and part and part[0] != part[-1]:
+        part.append(part[0])
+    parts.append(part)
+    return [part for part in parts if len(part) >= (4 if closed else 2)]
+
+
+def _clip(geometry_type, parts, k1, k2, axis):
+    '''Clips the parts of a geometry to k1 <= position[axis] <= k2'''
+    if geometry_type == POINT:
+        return [
+            position for position in parts if k1 <= position[axis] <= k2
+        ]
+    if geometry_type == LINESTRING:
+        return [
+            clipped for line in parts
+            for clipped in _clip_line(line, k1, k2, axis, False)
+        ]
+
+    polygons = []
+    for polygon in parts:
+        exterior = _clip_line(polygon[0], k1, k2, axis, True)
+        if exterior:
+            polygons.append(exterior + [
+                clipped for ring in polygon[1:]
+                for clipped in _clip_line(ring, k1, k2, axis, True)
+            ])
+    return polygons
+
+
+def _ring_area(positions):
+    '''signed area of a ring, by the surveyor's formula'''
+    return sum(
+        a[0] * b[1] - b[0] * a[1]
+        for a, b in zip(positions, positions[1:] + positions[:1])
+    ) / 2
+
+
+def _encode_geometry(geometry_type, parts, x, y):
+    '''Returns MVT geometry commands for the parts of a geometry, clipped to
+    tile x, y, or None if nothing is left once it is in tile coordinates'''
+    origin_x, origin_y = x * EXTENT, y * EXTENT
+    commands = []
+    cursor = [0, 0]
+
+    def quantize(positions):
+        quantized = []
+        for position in positions:
+            position = (
+                int(round(position[0] - origin_x)),
+                int(round(position[1] - origin_y)),
+            )
+            if not quantized or quantized[-1] != position:
+                quantized.append(position)
+        return quantized
+
+    def move(positions):
+        for position in positions:
+            commands.append(_zigzag(position[0] - cursor[0]))
+            commands.append(_zigzag(position[1] - cursor[1]))
+            cursor[0], cursor[1] = position
+
+    def path(positions, close):
+        commands.append(_command(MOVE_TO, 1))
+        move(positions[:1])
+        commands.append(_command(LINE_TO, len(positions) - 1))
+        move(positions[1:])
+        if close:
+            commands.append(_command(CLOSE_PATH, 1))
+
+    if geometry_type == POINT:
+        positions = quantize(parts)
+        if positions:
+            commands.append(_command(MOVE_TO, len(positions)))
+            move(positions)
+
+    elif geometry_type == LINESTRING:
+        for line in parts:
+            positions = quantize(line)
+            if len(positions) > 1:
+                path(positions, False)
+
+    else:
+        for polygon in parts:
+            for i, ring in enumerate(polygon):
+                positions = quantize(ring)
+                if positions[0] == positions[-1]:
+                    positions.pop()
+                area = _ring_area(positions) if len(positions) > 2 else 0
+                # polygons too small to see at this zoom are dropped
+                if not area:
+                    if i == 0:
+                        break
+                    continue
+                # exterior rings wind clockwise, with a positive area
+                # in tile coordinates, and holes the other way
+                if (area > 0) != (i == 0):
+                    positions.reverse()
+                path(positions, True)
+
+    return _packed(commands) if commands else None
+
+
+def _cut(geometry_type, parts, zoom, tolerance):
+    '''Yields tile x, tile y and the MVT geometry commands of each tile
+    a feature is in at zoom'''
+    size = 2 ** zoom * EXTENT
+
+    # scale to tile coordinates at this zoom, then simplify, so
+    # simplification always removes detail smaller than a few pixels
+    def scale(positions):
+        return [(position[0] * size, position[1] * size) for position in positions]
+
+    if geometry_type == POINT:
+        parts = scale(parts)
+        positions = parts
+    elif geometry_type == LINESTRING:
+        parts = [simplify_line(scale(line), tolerance, 2) for line in parts]
+        positions = [position for line in parts for position in line]
+    else:
+        parts = [
+            [simplify_line(scale(ring), tolerance, 4) for ring in polygon]
+            for polygon in parts
+        ]
+        positions = [polygon_position for polygon in parts
+                     for polygon_position in polygon[0]]
+
+    last_tile = 2 ** zoom - 1
+    min_x = max(0, int((min(p[0] for p in positions) - BUFFER) // EXTENT))
+    max_x = min(last_tile, int((max(p[0] for p in positions) + BUFFER) // EXTENT))
+    min_y = max(0, int((min(p[1] for p in positions) - BUFFER) // EXTENT))
+    max_y = min(last_tile, int((max(p[1] for p in positions) + BUFFER) // EXTENT))
+
+    # clip to a column of tiles, then to each tile in the column
+    for x in range(min_x, max_x + 1):
+        column = _clip(
+            geometry_type, parts,
+            x * EXTENT - BUFFER, (x + 1) * EXTENT + BUFFER, 0,
+        )
+        if not column:
+            continue
+        for y in range(min_y, max_y + 1):
+            tile = _clip(
+                geometry_type, column,
+                y * EXTENT - BUFFER, (y + 1) * EXTENT + BUFFER, 1,
+            )
+            if tile:
+                geometry = _encode_geometry(geometry_type, tile, x, y)
+                if geometry:
+                    yield x, y, geometry
+
+
+def _kept(feature_id, zoom, options):
+    '''Whether a point feature is drawn at zoom
+
+    Below max_zoom, each zoom out keeps 1 in drop_rate of the points kept
+    at the zoom above. Features are picked by a hash of their id, so
+    the points of a zoom are always drawn at every zoom above it
+    '''
+    if options["drop_rate"] <= 1 or zoom >= options["max_zoom"]:
+        return True
+    share = options["drop_rate"] ** (zoom - options["max_zoom"])
+    return (feature_id * 2654435761) % 4294967296 < share * 4294967296
+
+
+def _cut_chunk(job):
+    '''Cuts a chunk of features into tile pieces at one zoom, and writes
+    them to a shard database. Runs in the tile building processes'''
+    features_path, shard_path, zoom, first_id, last_id, options = job
+    tolerance = options["simplify"] * EXTENT / 256
+
+    source = sqlite3.connect(features_path)
+    shard = sqlite3.connect(shard_path)
+    shard.execute(
+        "CREATE TABLE pieces (z INTEGER, x INTEGER, y INTEGER, "
+        "id INTEGER, type INTEGER, geometry BLOB)"
+    )
+    pieces = []
+    for feature_id, geometry_type, geometry in source.execute(
+        "SELECT id, type, geometry FROM features WHERE id BETWEEN ? AND ?",
+        (first_id, last_id),
+    ):
+        if geometry_type == POINT and not _kept(feature_id, zoom, options):
+            continue
+        for x, y, commands in _cut(
+            geometry_type, marshal.loads(geometry), zoom, tolerance
+        ):
+            pieces.append((zoom, x, y, feature_id, geometry_type, commands))
+        if len(pieces) >= CHUNK_FEATURES:
+            shard.executemany(
+                "INSERT INTO pieces VALUES (?, ?, ?, ?, ?, ?)", pieces
+            )
+            pieces = []
+    shard.executemany("INSERT INTO pieces VALUES (?, ?, ?, ?, ?, ?)", pieces)
+    shard.commit()
+    shard.close()
+    source.close()
+    return shard_path
+
+
+def _encode_value(value):
+    '''an MVT Value message'''
+    if isinstance(value, bool):
+        return _key(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        if value < 0:
+            return _key(6, 0) + _varint(_zigzag(value))
+        return _key(5, 0) + _varint(value)
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack("<d", value)
+    return _message(1, str(value).encode("utf-8"))
+
+
+def encode_tile(layer_name, features):
+    '''Returns an MVT tile with a single layer of features
+
+    features are (id, MVT type, MVT geometry commands, properties)
+    '''
+    keys = {}
+    values = {}
+    encoded = []
+    for feature_id, geometry_type, geometry, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            # 1 and True are the same dict key, so types are kept apart
+            tags.append(values.setdefault(
+                (type(value).__name__, value), len(values)
+            ))
+        feature = _key(1, 0) + _varint(feature_id)
+        if tags:
+            feature += _message(2, _packed(tags))
+        feature += _key(3, 0) + _varint(geometry_type)
+        feature += _message(4, geometry)
+        encoded.append(_message(2, feature))
+
+    layer = b"".join(
+        [_key(15, 0) + _varint(2), _message(1, layer_name.encode("utf-8"))]
+        + encoded
+        + [_message(3, key.encode("utf-8")) for key in keys]
+        + [_message(4, _encode_value(value)) for _, value in values]
+        + [_key(5, 0) + _varint(EXTENT)]
+    )
+    return _message(3, layer)
+
+
+def _encode_band(job):
+    '''Puts the pieces of a band of tile columns at one zoom together into
+    gzipped tiles, and writes them to a shard database. Runs in the tile
+    building processes'''
+    features_path, shard_path, layer_name, zoom, first_x, last_x = job
+
+    source = sqlite3.connect(features_path)
+    shard = sqlite3.connect(shard_path)
+    shard.execute(
+        "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+        "tile_row INTEGER, tile_data BLOB)"
+    )
+    pieces = source.execute(
+        "SELECT p.x, p.y, p.id, p.type, p.geometry, f.properties "
+        "FROM pieces p JOIN features f ON f.id = p.id "
+        "WHERE p.z = ? AND p.x BETWEEN ? AND ? ORDER BY p.x, p.y, p.id",
+        (zoom, first_x, last_x),
+    )
+    tiles = []
+    for (x, y), tile_pieces in itertools.groupby(
+        pieces, key=lambda piece: piece[:2]
+    ):
+        tile = encode_tile(layer_name, [
+            (feature_id, geometry_type, geometry, json.loads(properties))
+            for _, _, feature_id, geometry_type, geometry, properties
+            in tile_pieces
+        ])
+        # mbtiles rows count up from the bottom of the map
+        tiles.append((
+            zoom, x, 2 ** zoom - 1 - y, gzip.compress(tile, mtime=0)
+        ))
+        if len(tiles) >= 1000:
+            shard.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", tiles)
+            tiles = []
+    shard.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", tiles)
+    shard.commit()
+    shard.close()
+    source.close()
+    return shard_path
+
+
+def _run_jobs(run, jobs, workers):
+    '''Runs tile building jobs, across processes if there are workers
+    to spare, and yields their shard paths'''
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield run(job)
+        return
+
+    # spawn keeps the workers clear of the parent's open connections
+    with ProcessPoolExecutor(
+        min(workers, len(jobs)), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        yield from executor.map(run, jobs)
+
+
+def _gather(database, table, shard_paths):
+    '''Copies a table of each shard into database, and removes the shard'''
+    for shard_path in shard_paths:
+        database.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+        database.execute(
+            "INSERT INTO {0} SELECT * FROM shard.{0}".format(table)
+        )
+        database.commit()
+        database.execute("DETACH DATABASE shard")
+        os.remove(shard_path)
+
+
+def write_to_mbtiles(output_filepath, features, layer_name, min_zoom=0,
+                     max_zoom=14, simplify=1, drop_rate=2.5, workers=1):
+    '''Builds an MBTiles vector tile pyramid from features made by
+    dump_to_geospatial_generator in EPSG 4326
+
+    inputs:
+        min_zoom, max_zoom: zoom levels to build tiles for
+        simplify: how far, in pixels of a 256 pixel tile, lines and
+            polygons are simplified at each zoom
+        drop_rate: below max_zoom, each zoom out keeps 1 in drop_rate of
+            the points of the zoom above. 1 keeps every point
+        workers: how many processes cut tiles at once
+    '''
+    options = {
+        "max_zoom": max_zoom, "simplify": simplify, "drop_rate": drop_rate,
+    }
+    scratch_path = output_filepath + "-scratch"
+    os.makedirs(scratch_path)
+    features_path = os.path.join(scratch_path, "features.sqlite")
+    try:
+        count, bounds, field_types = write_features(features_path, features)
+
+        jobs = [
+            (
+                features_path,
+                os.path.join(scratch_path, "{}-{}.sqlite".format(zoom, first_id)),
+                zoom, first_id, first_id + CHUNK_FEATURES - 1, options,
+            )
+            for zoom in range(min_zoom, max_zoom + 1)
+            for first_id in range(1, count + 1, CHUNK_FEATURES)
+        ]
+
+        # gather every job's pieces next to the features they belong to
+        database = sqlite3.connect(features_path)
+        database.execute(
+            "CREATE TABLE pieces (z INTEGER, x INTEGER, y INTEGER, "
+            "id INTEGER, type INTEGER, geometry BLOB)"
+        )
+        _gather(database, "pieces", _run_jobs(_cut_chunk, jobs, workers))
+        database.execute("CREATE INDEX pieces_tile ON pieces (z, x, y, id)")
+        database.commit()
+
+        # then split each zoom into bands of columns with about as many
+        # pieces, to put together into tiles
+        jobs = []
+        for zoom, in database.execute(
+            "SELECT DISTINCT z FROM pieces ORDER BY z"
+        ).fetchall():
+            columns = database.execute(
+                "SELECT x, COUNT(*) FROM pieces WHERE z = ? GROUP BY x "
+                "ORDER BY x", (zoom,)
+            ).fetchall()
+            band_pieces = max(1, sum(
+                [pieces for _, pieces in columns]
+            ) // (4 * max(1, workers)))
+            first_x, pieces = columns[0][0], 0
+            for x, column_pieces in columns:
+                pieces += column_pieces
+                if pieces >= band_pieces or x == columns[-1][0]:
+                    jobs.append((
+                        features_path,
+                        os.path.join(
+                            scratch_path, "tiles-{}-{}.sqlite".format(zoom, x)
+                        ),
+                        layer_name, zoom, first_x, x,
+                    ))
+                    first_x, pieces = x + 1, 0
+        database.close()
+
+        mbtiles = sqlite3.connect(output_filepath)
+        mbtiles.executescript(
+            "CREATE TABLE metadata (name TEXT, value TEXT);"
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+            "tile_row INTEGER, tile_data BLOB);"
+        )
+        if not count:
+            bounds = [-180, -MAX_LATITUDE, 180, MAX_LATITUDE]
+        mbtiles.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("name", layer_name),
+            ("format", "pbf"),
+            ("type", "overlay"),
+            ("version", "2"),
+            ("minzoom", str(min_zoom)),
+            ("maxzoom", str(max_zoom)),
+            ("bounds", ",".join(map(str, bounds))),
+            ("center", "{},{},{}".format(
+                (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2,
+                min_zoom,
+            )),
+            ("json", json.dumps({"vector_layers": [{
+                "id": layer_name,
+                "fields": field_types,
+                "minzoom": min_zoom,
+                "maxzoom": max_zoom,
+            }]})),
+        ])
+        _gather(mbtiles, "tiles", _run_jobs(_encode_band, jobs, workers))
+        mbtiles.execute(
+            "CREATE UNIQUE INDEX tile_index "
+            "ON tiles (zoom_level, tile_column, tile_row)"
+        )
+        mbtiles.commit()
+        mbtiles.close()
+    finally:
+        for filename in os.listdir(scratch_path):
+            os.remove(os.path.join(scratch_path, filename))
+        os.rmdir(scratch_path)
+
+
+def count_tiles(bounds, zoom):
+    '''Returns how many tiles at zoom cover bounds, in lon, lat'''
+    left, top = project(bounds[0], bounds[3])
+    right, bottom = project(bounds[2], bounds[1])
+    tiles = 2 ** zoom
+
+    def index(value):
+        return min(tiles - 1, max(0, int(value * tiles)))
+
+    return (index(right) - index(left) + 1) * (index(bottom) - index(top) + 1)
+
+
+def estimate_mbtiles_bytes(scratch_path, features, sample_rows, rows,
+                           layer_name, min_zoom=0, max_zoom=14, simplify=1,
+                           drop_rate=2.5):
+    '''Estimates the bytes of an mbtiles output of rows features, from
+    one built in scratch_path out of sample_rows of them
+
+    Feature data grows with rows. The tiles of each zoom grow with rows
+    too, up to the tiles that cover the extent of the sample
+    '''
+    sample_filepath = os.path.join(scratch_path, "sample.mbtiles")
+    write_to_mbtiles(
+        sample_filepath, features, layer_name, min_zoom, max_zoom,
+        simplify, drop_rate,
+    )
+    database = sqlite3.connect(sample_filepath)
+    bounds = [float(value) for value in database.execute(
+        "SELECT value FROM metadata WHERE name = 'bounds'"
+    ).fetchone()[0].split(",")]
+    zoom_tiles = dict(database.execute(
+        "SELECT zoom_level, COUNT(*) FROM tiles GROUP BY zoom_level"
+    ).fetchall())
+    tile_bytes, = database.execute(
+        "SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles"
+    ).fetchone()
+    database.close()
+    sample_bytes = os.path.getsize(sample_filepath)
+    os.remove(sample_filepath)
+
+    # what a tile takes up without features
+    layer_bytes = len(gzip.compress(encode_tile(layer_name, []), mtime=0))
+    sample_tiles = sum(zoom_tiles.values())
+    scale = rows / max(1, sample_rows)
+    tiles = sum([
+        min(
+            count_tiles(bounds, zoom),
+            max(zoom_tiles.get(zoom, 0),
+                math.ceil(zoom_tiles.get(zoom, 0) * scale)),
+        )
+        for zoom in range(min_zoom, max_zoom + 1)
+    ])
+    feature_bytes = max(0, tile_bytes - sample_tiles * layer_bytes)
+    return int(
+        sample_bytes + feature_bytes * (scale - 1)
+        + (tiles - sample_tiles) * (layer_bytes + TILE_ROW_BYTES)
+    )
@@ -2,21 +2,58 @@
 '''
 
 import os
+import io
+import errno
+import shutil
 import re
 import sys
 import csv
 import json
 import codecs
-from fiona.crs import from_epsg
-from fiona.transform import transform_geom
-from zipfile import ZipFile
+import pstats
+import hashlib
+import itertools
+import marshal
+import operator
+import tempfile
+import threading
+import multiprocessing
+import zipfile
+import tarfile
 import xml.etree.cElementTree as ET
-from fiona import Geometry
-from typing import Dict
+import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, TYPE_CHECKING
 
 import ckan.plugins.toolkit as tk
+from ckan.common import config
+from .geometry import parse_geometry, simplify_line, to_wkt, to_wkb
+from . import scheduler, tiles
+from .progress import REPORT_EVERY
 
-def _geometry_to_json(geom: Geometry) -> str:
+if TYPE_CHECKING:
+    from fiona import Geometry
+
+# fiona brings GDAL, PROJ and their data along, which most CKAN workers
+# never use - load_gdal imports them the first time they're needed
+fiona = None
+from_epsg = None
+transform_geom = None
+_gdal_lock = threading.Lock()
+
+# CKAN datastore types, without digits, and the fiona types they map to
+CKAN_TO_FIONA_TYPES = {
+    "text": "str",
+    "date": "str",
+    "timestamp": "str",
+    "float": "float",
+    "int": "int",
+    "numeric": "float",
+    "time": "str",
+}
+
+def _geometry_to_json(geom: "Geometry") -> str:
     """_geometry_to_json
 
     :param geom: the fiona geometry
@@ -24,6 +61,10 @@ def _geometry_to_json(geom: Geometry) -> str:
     :return: geojson compliant JSON string
     :rtype: str
     """
+    # like WKT and WKB, a missing geometry is an empty string
+    if geom is None:
+        return ""
+
     geom_dict = dict(geom)
 
     # GeoJSON spec does not indicate a case for `null` to be valid json (only mentions
@@ -34,6 +75,14 @@ def _geometry_to_json(geom: Geometry) -> str:
 
     return json.dumps(geom_dict)
 
+
+# how transform_dump_epsg can write geometries into CSVs
+GEOMETRY_ENCODERS = {
+    "geojson": _geometry_to_json,
+    "wkt": to_wkt,
+    "wkb": to_wkb,
+}
+
 def transform_epsg(source_epsg, target_epsg, geometry):
     '''standardize processing when transforming epsg'''
 
@@ -41,26 +90,29 @@ def transform_epsg(source_epsg, target_epsg, geometry):
     if geometry in [None, "None"]:        
         return None
 
-    # if input is a string, make it a json object
+    # if input is a string, read it as GeoJSON, WKT or WKB
     if isinstance(geometry, str):
-        geometry = json.loads(geometry.replace("'", '"')) # replace '' with ""
+        geometry = parse_geometry(geometry)
         assert "coordinates" in geometry.keys(), "No coordinates in geometry!"   
 
     original_geometry_type = geometry["type"]
     if not geometry["type"].startswith("Multi"):
         geometry["type"] = "Multi" + geometry["type"]
 
-    # 0,0 coords need not be transformed - only their brackets changed
-    # Rarely, we receive coords that are near zero - we set those to 0 here using int()
-    if geometry["coordinates"] in [[0,0], [[0,0]]] or [int(x) for x in geometry["coordinates"]] == [0,0]:
-        geometry["coordinates"] = [[0,0]]                
-        return geometry
-
     # null coords need not be transformed - only their brackets changed
     if geometry["coordinates"] in [[None,None], [[None,None]]]:
         geometry["coordinates"] = []
         return geometry
 
+    # 0,0 coords need not be transformed - only their brackets changed
+    # Rarely, we receive coords that are near zero - we set those to 0 here using int()
+    if geometry["coordinates"] in [[0,0], [[0,0]]] or (
+        original_geometry_type == "Point"
+        and [int(x) for x in geometry["coordinates"]] == [0,0]
+    ):
+        geometry["coordinates"] = [[0,0]]                
+        return geometry
+
     # force to multigeometry
     coordinates = list(geometry.get("coordinates", None))
     if not original_geometry_type.startswith("Multi"):       
@@ -69,6 +121,7 @@ def transform_epsg(source_epsg, target_epsg, geometry):
 
     # if the source and target epsg dont match, consider transforming them
     if target_epsg != source_epsg:        
+        load_gdal()
         geometry = transform_geom(
             from_epsg(source_epsg),
             from_epsg(target_epsg),
@@ -85,91 +138,693 @@ def transform_epsg(source_epsg, target_epsg, geometry):
 
     return geometry
 
+
+
+def _round_coordinates(coordinates, precision):
+    '''Rounds nested coordinates to precision decimal places'''
+    if not coordinates:
+        return coordinates
+    if not isinstance(coordinates[0], (list, tuple)):
+        return [
+            value if value is None else round(value, precision)
+            for value in coordinates
+        ]
+    if not isinstance(coordinates[0][0], (list, tuple)):
+        # a whole line or ring of positions is rounded in one pass
+        return [
+            [round(value, precision) for value in position]
+            for position in coordinates
+        ]
+    return [_round_coordinates(part, precision) for part in coordinates]
+
+
+def round_geometry(geometry, precision):
+    '''Rounds the coordinates of a geometry from transform_epsg'''
+    if geometry is None or precision is None:
+        return geometry
+    geometry["coordinates"] = _round_coordinates(
+        geometry["coordinates"], precision
+    )
+    return geometry
+
+
+def simplify_geometry(geometry, tolerance):
+    '''Simplifies the lines and rings of a geometry from the dump
+
+    tolerance is in the units of the geometry's EPSG. Points are left as
+    they are, and rings are never simplified below 4 positions
+    '''
+    if not tolerance or geometry in [None, "None"]:
+        return geometry
+    if isinstance(geometry, str):
+        geometry = parse_geometry(geometry)
+
+    geometry_type = geometry["type"]
+    coordinates = geometry.get("coordinates", None)
+    if not coordinates or geometry_type.endswith("Point"):
+        return geometry
+
+    def line(positions):
+        return simplify_line(positions, tolerance, 2)
+
+    def polygon(rings):
+        return [simplify_line(ring, tolerance, 4) for ring in rings]
+
+    if geometry_type == "LineString":
+        geometry["coordinates"] = line(coordinates)
+    elif geometry_type == "MultiLineString":
+        geometry["coordinates"] = [line(part) for part in coordinates]
+    elif geometry_type == "Polygon":
+        geometry["coordinates"] = polygon(coordinates)
+    elif geometry_type == "MultiPolygon":
+        geometry["coordinates"] = [polygon(part) for part in coordinates]
+    return geometry
+
+
+def get_geometry_options(data_dict):
+    '''Returns how to_file should round and simplify geometries, as
+    inputs of transform_dump_epsg and dump_to_geospatial_generator'''
+    return {
+        "precision": data_dict.get("coordinate_precision", None),
+        "tolerance": data_dict.get("simplify_tolerance", None),
+    }
+
     
-def dump_generator(resource_id, fieldnames, context):
-    '''reads a CKAN datastore_search calls, returns a python generator'''
-    # init some vars
+def fiona_type(ckan_type):
+    '''Maps a CKAN datastore field type to a fiona schema type'''
+    return CKAN_TO_FIONA_TYPES[
+        "".join([char for char in ckan_type if not char.isdigit()])
+    ]
+
+
+def _to_int(value):
+    if value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        # ex: "2014.0"
+        return int(float(value))
+
+
+def _to_float(value):
+    if value == "":
+        return None
+    return float(value)
+
+
+def _to_str_or_none(value):
+    if value == "":
+        return None
+    return value
+
+
+def property_converter(ckan_types, property_names):
+    '''Compiles a function that turns a dump row's values (strings) into
+    a dict of the native types fiona expects for each property
+
+    Empty numbers, dates and times become None. Empty text stays ""
+    '''
+    converters = []
+    for ckan_type in ckan_types:
+        field_type = "".join([char for char in ckan_type if not char.isdigit()])
+        if CKAN_TO_FIONA_TYPES[field_type] == "int":
+            converters.append(_to_int)
+        elif CKAN_TO_FIONA_TYPES[field_type] == "float":
+            converters.append(_to_float)
+        elif field_type in ["date", "timestamp", "time"]:
+            converters.append(_to_str_or_none)
+        else:
+            converters.append(None)
+
+    # text columns are the most common - dont call anything for them
+    plan = list(zip(property_names, converters))
+
+    def to_properties(values):
+        return {
+            name: convert(value) if convert else value
+            for (name, convert), value in zip(plan, values)
+        }
+
+    return to_properties
+
+
+def _to_datetime(value):
+    if value == "":
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def _to_date(value):
+    if value == "":
+        return None
+    try:
+        return datetime.date.fromisoformat(value[:10])
+    except ValueError:
+        return value
+
+
+def _to_time(value):
+    if value == "":
+        return None
+    try:
+        return datetime.time.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def _to_xlsx_text(value):
+    # excel refuses control characters, and cells past its length limit
+    return XLSX_ILLEGAL_CHARACTERS.sub("", value)[:XLSX_MAX_CHARACTERS]
+
+
+def xlsx_converter(ckan_types):
+    '''Compiles a function that turns a dump row's values (strings) into
+    a list of the cell values of an excel row
+
+    Numbers, dates and times become excel numbers, dates and times, so
+    they can be sorted and summed. Empty ones become empty cells
+    '''
+    converters = []
+    for ckan_type in ckan_types:
+        field_type = "".join([char for char in ckan_type if not char.isdigit()])
+        if CKAN_TO_FIONA_TYPES.get(field_type, None) == "int":
+            converters.append(_to_int)
+        elif CKAN_TO_FIONA_TYPES.get(field_type, None) == "float":
+            converters.append(_to_float)
+        elif field_type == "timestamp":
+            converters.append(_to_datetime)
+        elif field_type == "date":
+            converters.append(_to_date)
+        elif field_type == "time":
+            converters.append(_to_time)
+        else:
+            converters.append(_to_xlsx_text)
+
+    def to_cells(values):
+        return [
+            convert(value) for convert, value in zip(converters, values)
+        ]
+
+    return to_cells
+
+
+def row_getter(fieldnames):
+    '''Returns a function that turns a record dict into a row tuple
+
+    column positions are resolved once, instead of once per row
+    '''
+    getter = operator.itemgetter(*fieldnames)
+    if len(fieldnames) == 1:
+        return lambda record: (getter(record),)
+    return getter
+
+
+def datastore_query(data_dict):
+    '''Returns the datastore_search inputs that narrow an export down to
+    the fields and filters asked for in to_file'''
+    query = {}
+    if data_dict.get("fields", None):
+        query["fields"] = data_dict["fields"]
+    if data_dict.get("filters", None):
+        query["filters"] = data_dict["filters"]
+    return query
+
+
+def datastore_records(resource_id, context, progress=None, query=None):
+    '''reads a CKAN datastore resource with datastore_search calls,
+    returns a python generator of its records, a chunk at a time
+
+    query is passed on to datastore_search, so only the fields and
+    records it asks for leave the database
+    '''
     chunk = 20000
     i = 0
 
     while True:
         # get a chunk of records from datastore resource
         records = tk.get_action("datastore_search")(
-            context, {
-                "resource_id": resource_id,
-                "limit": chunk,
-                "offset": chunk * i,
-                }
+            context, dict(
+                query or {},
+                resource_id=resource_id,
+                limit=chunk,
+                offset=chunk * i,
+            )
         )["records"]
 
-        if len(records):
-            for record in records:
-                yield record
-            i += 1
+        if not len(records):
+            break
+
+        yield from records
+        i += 1
+        if progress:
+            progress.update(chunk * (i - 1) + len(records))
+
+
+def geometry_bounds(geometry):
+    '''Returns (min x, min y, max x, max y) of a GeoJSON geometry,
+    or None if it has no coordinates'''
+    if geometry in [None, "None", ""]:
+        return None
+    if isinstance(geometry, str):
+        geometry = parse_geometry(geometry)
+
+    xs, ys = [], []
+
+    def walk(coordinates):
+        if not coordinates:
+            return
+        if not isinstance(coordinates[0], (list, tuple)):
+            if coordinates[0] is not None and coordinates[1] is not None:
+                xs.append(coordinates[0])
+                ys.append(coordinates[1])
+            return
+        for part in coordinates:
+            walk(part)
+
+    for part in geometry.get("geometries", None) or [geometry]:
+        walk(part.get("coordinates", None))
+
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def in_bbox(records, bbox, skip_errors=False):
+    '''Filters records down to those whose geometry intersects bbox,
+    a list of [min x, min y, max x, max y] in the source EPSG
+
+    If skip_errors, records whose geometry can't be read are kept, for the
+    export's error_policy to skip or null them like any other
+    '''
+    min_x, min_y, max_x, max_y = bbox
+    for record in records:
+        try:
+            bounds = geometry_bounds(record["geometry"])
+        except Exception:
+            if not skip_errors:
+                raise
+            yield record
             continue
+        if bounds and not (
+            bounds[0] > max_x or bounds[2] < min_x
+            or bounds[1] > max_y or bounds[3] < min_y
+        ):
+            yield record
 
-        else:
-            break
+
+def dump_generator(resource_id, fieldnames, context, progress=None,
+                   query=None, bbox=None, skip_errors=False):
+    '''reads a CKAN datastore_search calls, returns a python generator
+    of row tuples, in the order of fieldnames
+
+    records can be narrowed down by a datastore_search query, and spatial
+    records by a bbox - see in_bbox for skip_errors
+    '''
+    records = datastore_records(resource_id, context, progress, query)
+    if bbox:
+        records = in_bbox(records, bbox, skip_errors)
+    return map(row_getter(fieldnames), records)
+
+
+# what to_file does with a row whose geometry can't be exported
+ERROR_POLICIES = ["fail", "skip", "null"]
+
+# what Reprojection returns, and spills, for a skipped row
+SKIPPED = False
+
+
+class RowErrors(object):
+    '''Rows whose geometry couldn't be exported, under the skip or null
+    error_policy of to_file
+
+    Each row is written to a CSV of its _id, the EPSG it was going to and
+    the error, the first time it fails for that EPSG. The CSV is only
+    created once a row fails
+    '''
+
+    def __init__(self, filepath, policy):
+        self.filepath = filepath
+        self.policy = policy
+        self.failed = set()
+        self.file = None
+        self.writer = None
+
+    def add(self, row_id, target_epsg, reason):
+        '''Records a row that failed, and returns what to export instead
+        of its geometry: None, or SKIPPED'''
+        if (row_id, target_epsg) not in self.failed:
+            self.failed.add((row_id, target_epsg))
+            if not self.file:
+                # it's opened while outputs are written, so it's added to
+                # a bundle once it's closed instead of streamed into it
+                self.file = open_output(self.filepath, stream=False)
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(["_id", "epsg", "error"])
+            self.writer.writerow([row_id, target_epsg, reason])
+        return SKIPPED if self.policy == "skip" else None
+
+    def skipped(self, target_epsg):
+        '''Returns how many rows were left out of outputs in target_epsg'''
+        if self.policy != "skip":
+            return 0
+        return len([key for key in self.failed if key[1] == target_epsg])
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def row_id_getter(fieldnames):
+    '''Returns a function of a dump row and its 0-based number, that
+    returns the row's _id - or its 1-based number if _id wasn't exported'''
+    if "_id" in fieldnames:
+        id_index = fieldnames.index("_id")
+        return lambda row, number: row[id_index]
+    return lambda row, number: str(number + 1)
+
+
+def first_geometry_type(records, skip_errors=False):
+    '''Returns the type of the first geometry in records, or of the first
+    one that can be read if skip_errors'''
+    for record in records:
+        try:
+            return parse_geometry(record["geometry"])["type"]
+        except Exception:
+            if not skip_errors:
+                raise
+    raise tk.ValidationError(
+        {"constraints": ["None of the first geometries can be read"]}
+    )
+
+
+# the dump's byte offset is kept every DUMP_RANGE_ROWS rows, so its
+# geometries can be reprojected a range of rows at a time
+DUMP_RANGE_ROWS = 10000
+
+
+class GeometryCache(object):
+    '''Spill files of the geometries of a dump, reprojected, so outputs
+    in the same EPSG reproject each geometry once between them
+
+    The first output to reproject the dump writes its geometries to a
+    file, in dump order, as it goes. Outputs after it read them back.
+
+    With the byte offsets of the dump from write_to_csv, and more than one
+    worker, geometries are reprojected a range of rows at a time by a pool
+    of processes instead. Unless keep is set, spill files are only read once
+    '''
+
+    def __init__(self, dir_path, dump_filepath=None, dump_index=None,
+                 workers=1, keep=True):
+        self.dir_path = dir_path
+        self.dump_filepath = dump_filepath
+        self.dump_index = dump_index or []
+        self.workers = workers
+        self.keep = keep
+        self.filepaths = {}
+
+    def forget(self, target_epsg=None):
+        '''Deletes the spill files of target_epsg, or all of them'''
+        for key in list(self.filepaths.keys()):
+            if target_epsg is None or key[1] == target_epsg:
+                for filepath in self.filepaths.pop(key):
+                    os.remove(filepath)
+
+
+def _reproject_range(job):
+    '''Reprojects the geometries of a range of rows of a CSV dump into a
+    spill file - run in the processes of Reprojection'''
+    dump_filepath, offset, first_row, rows, key, policy, spill_filepath = job
+    source_epsg, target_epsg, precision, tolerance = key
+    csv.field_size_limit(sys.maxsize)
+    # rows that failed go back to the parent, to be added to its RowErrors
+    failed = []
+
+    with open(dump_filepath, "r", encoding="utf-8", newline="") as f:
+        fieldnames = next(csv.reader(f))
+        geometry_index = fieldnames.index("geometry")
+        row_id = row_id_getter(fieldnames)
+        # utf-8 has no decoder state, so byte offsets are valid positions
+        f.seek(offset)
+        with open(spill_filepath, "wb") as spill:
+            rows = itertools.islice(csv.reader(f), rows)
+            for number, row in enumerate(rows, first_row):
+                try:
+                    geometry = round_geometry(
+                        transform_epsg(
+                            source_epsg, target_epsg,
+                            simplify_geometry(row[geometry_index], tolerance),
+                        ),
+                        precision,
+                    )
+                except Exception as e:
+                    if policy == "fail":
+                        raise
+                    failed.append((row_id(row, number), describe_error(e)))
+                    geometry = SKIPPED if policy == "skip" else None
+                marshal.dump(geometry and dict(geometry), spill)
+    return spill_filepath, failed
+
+
+class Reprojection(object):
+    '''Simplifies, reprojects and rounds the geometries of a dump, one row
+    at a time and in dump order
+
+    With a GeometryCache, geometries already reprojected the same way are
+    read back from it, and new ones are spilled to it - or reprojected
+    ahead by its workers. finish() has to be called once every row went
+    through, and close() after
+
+    With RowErrors, a row whose geometry fails is added to them and nulled
+    or skipped, instead of failing the output
+    '''
+
+    def __init__(self, geometry_cache, source_epsg, target_epsg,
+                 precision=None, tolerance=None, errors=None):
+        self.geometry_cache = geometry_cache
+        self.key = (source_epsg, target_epsg, precision, tolerance)
+        self.errors = errors
+        self.file = None
+        self.spill_filepath = None
+        # spill files read back, in order, and the ones that are ours
+        self.read_filepaths = iter([])
+        self.own_filepaths = []
+        self.executor = None
+        self.futures = []
+        self.reading = False
+        if geometry_cache is None:
+            return
+
+        ranges = geometry_cache.dump_index
+        if self.key in geometry_cache.filepaths:
+            self.read_filepaths = iter(geometry_cache.filepaths[self.key])
+            self.reading = True
+        elif geometry_cache.workers > 1 and len(ranges) > 1:
+            self._start_workers(ranges)
+        elif geometry_cache.keep:
+            fd, self.spill_filepath = tempfile.mkstemp(
+                dir=geometry_cache.dir_path, suffix=".geometries"
+            )
+            self.file = os.fdopen(fd, "wb")
+
+    def _start_workers(self, ranges):
+        '''Reprojects every range of rows of the dump in a process pool'''
+        for _ in ranges:
+            fd, filepath = tempfile.mkstemp(
+                dir=self.geometry_cache.dir_path, suffix=".geometries"
+            )
+            os.close(fd)
+            self.own_filepaths.append(filepath)
+        policy = self.errors.policy if self.errors else "fail"
+        jobs = [
+            (
+                self.geometry_cache.dump_filepath, offset,
+                i * DUMP_RANGE_ROWS,
+                None if i == len(ranges) - 1 else DUMP_RANGE_ROWS,
+                self.key, policy, filepath,
+            )
+            for i, (offset, filepath) in enumerate(
+                zip(ranges, self.own_filepaths)
+            )
+        ]
+        # spawn keeps the workers clear of the parent's open connections
+        self.executor = ProcessPoolExecutor(
+            min(self.geometry_cache.workers, len(jobs)),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.futures = [
+            self.executor.submit(_reproject_range, job) for job in jobs
+        ]
+        # ranges are read back in order, as soon as each one is done
+        self.read_filepaths = (
+            self._add_errors(*future.result()) for future in self.futures
+        )
+        self.reading = True
+
+    def _add_errors(self, filepath, failed):
+        '''Adds the rows of a range that failed to errors'''
+        for row_id, reason in failed:
+            self.errors.add(row_id, self.key[1], reason)
+        return filepath
+
+    def __call__(self, geometry, row_id=None):
+        if self.reading:
+            while True:
+                if self.file:
+                    try:
+                        return marshal.load(self.file)
+                    except EOFError:
+                        self.file.close()
+                self.file = open(next(self.read_filepaths), "rb")
+
+        source_epsg, target_epsg, precision, tolerance = self.key
+        try:
+            geometry = round_geometry(
+                transform_epsg(
+                    source_epsg, target_epsg,
+                    simplify_geometry(geometry, tolerance),
+                ),
+                precision,
+            )
+        except Exception as e:
+            if not self.errors or self.errors.policy == "fail":
+                raise
+            geometry = self.errors.add(row_id, target_epsg, describe_error(e))
+        if self.file:
+            # fiona geometries are mappings, which marshal can't write
+            marshal.dump(geometry and dict(geometry), self.file)
+        return geometry
+
+    def finish(self):
+        '''Keeps the spill files, now that they hold every geometry'''
+        if self.spill_filepath:
+            self.file.close()
+            self.own_filepaths.append(self.spill_filepath)
+            self.spill_filepath = None
+        if self.own_filepaths and self.geometry_cache.keep:
+            self.geometry_cache.filepaths[self.key] = self.own_filepaths
+            self.own_filepaths = []
+
+    def close(self):
+        '''Closes the spill files, and deletes the ones not kept'''
+        if self.file:
+            self.file.close()
+        if self.executor:
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+        if self.spill_filepath:
+            self.own_filepaths.append(self.spill_filepath)
+            self.spill_filepath = None
+        for filepath in self.own_filepaths:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        self.own_filepaths = []
 
 
 def dump_to_geospatial_generator(
     dump_filepath, fieldnames, target_format, source_epsg, target_epsg,
-    col_map=None
+    col_map=None, progress=None, fields=None, precision=None, tolerance=None,
+    geometry_cache=None, errors=None,
 ):
-    '''reads a CKAN CSV dump, creates generator with converted CRS'''
+    '''reads a CKAN CSV dump, creates generator with converted CRS
 
-    # For each row in the dump ...
-    with codecs.open(dump_filepath, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f, fieldnames=fieldnames)
-        next(reader)
-        for row in reader:
+    if the datastore fields are given, properties are converted to the
+    python types of the fiona schema. Otherwise they stay strings.
+    Geometries are simplified by tolerance before they are reprojected,
+    and rounded to precision decimal places after - or read from
+    geometry_cache if another output already did. Rows whose geometry
+    fails go to errors, if given - see Reprojection
+    '''
 
-            # if the data contains a "geometry" column, we know its spatial
-            geometry = row.pop("geometry")
+    # resolve the geometry column and property names once for the schema
+    # shapefile column names need to be mapped from col_map
+    geometry_index = fieldnames.index("geometry")
+    property_names = [
+        col_map[fieldname] if target_format == "shp" else fieldname
+        for fieldname in fieldnames if fieldname != "geometry"
+    ]
+    if fields:
+        to_properties = property_converter(
+            [field["type"] for field in fields if field["id"] != "geometry"],
+            property_names,
+        )
+    else:
+        to_properties = lambda values: dict(zip(property_names, values))
 
-            #if geometry not in ["None", None]:
-                # shapefile column names need to be mapped from col_map
-            if target_format == "shp":
-                working_row = {}
-                for key, value in row.items():
-                    working_row[col_map[key]] = value
-                row = working_row
+    row_id = row_id_getter(fieldnames)
+    reproject = Reprojection(
+        geometry_cache, source_epsg, target_epsg, precision, tolerance, errors
+    )
 
-            # if we need to transform the EPSG, we do it here
-            geometry = transform_epsg(source_epsg, target_epsg, geometry)
+    # For each row in the dump ...
+    with open(dump_filepath, "r", encoding="utf-8", newline="") as f:
+        try:
+            reader = csv.reader(f)
+            next(reader)
+            for i, row in enumerate(reader):
+                if progress and not i % REPORT_EVERY:
+                    progress.update(i)
 
-            output = {
-                "type": "Feature",
-                "properties": dict(row),
-                "geometry": geometry,
-            } 
-                        
-            yield (output)
+                # if the data contains a "geometry" column, we know its spatial
+                # if we need to transform the EPSG, we do it here
+                geometry = reproject(row[geometry_index], row_id(row, i))
+                if geometry is SKIPPED:
+                    continue
+                row.pop(geometry_index)
 
-        f.close()
+                yield {
+                    "type": "Feature",
+                    "properties": to_properties(row),
+                    "geometry": geometry,
+                }
+            reproject.finish()
+        finally:
+            reproject.close()
 
 
-def transform_dump_epsg(dump_filepath, fieldnames, source_epsg, target_epsg):
-    '''generator yields dump rows with epsg reformatted/converted'''
+def transform_dump_epsg(dump_filepath, fieldnames, source_epsg, target_epsg,
+                        progress=None, precision=None, tolerance=None,
+                        encoding="geojson", geometry_cache=None,
+                        errors=None):
+    '''generator yields dump rows with epsg reformatted/converted
 
-    # Open the dump CSV into a dictreader
-    with codecs.open(dump_filepath, "r", encoding="utf-8") as f:
-        dictreader = csv.DictReader(f, fieldnames=fieldnames)
-        # skip header
-        next(dictreader)
+    geometries are simplified and rounded like in
+    dump_to_geospatial_generator, then written in encoding: geojson, wkt
+    or wkb
+    '''
 
-        # For each fow, convert the CRS
-        for row in dictreader: 
+    geometry_index = fieldnames.index("geometry")
+    encode = GEOMETRY_ENCODERS[encoding]
+    row_id = row_id_getter(fieldnames)
+    reproject = Reprojection(
+        geometry_cache, source_epsg, target_epsg, precision, tolerance, errors
+    )
 
-            geometry = transform_epsg(
-                source_epsg, 
-                target_epsg, 
-                row["geometry"]
-            )
-            row["geometry"] = _geometry_to_json(geometry)
-            yield (row)                        
+    # Open the dump CSV into a reader
+    with open(dump_filepath, "r", encoding="utf-8", newline="") as f:
+        try:
+            reader = csv.reader(f)
+            # skip header
+            next(reader)
 
-        f.close()
+            # For each fow, convert the CRS
+            for i, row in enumerate(reader):
+                if progress and not i % REPORT_EVERY:
+                    progress.update(i)
+
+                geometry = reproject(row[geometry_index], row_id(row, i))
+                if geometry is SKIPPED:
+                    continue
+                row[geometry_index] = encode(geometry)
+                yield row
+            reproject.finish()
+        finally:
+            reproject.close()
 
 
 
@@ -193,102 +848,1386 @@ def append_to_output(output, target_format, target_epsg, output_filepath):
     return output
 
 
-def write_to_csv(dump_filepath, fieldnames, rows_generator):
-    '''Streams a dump into a CSV file'''
+def part_filepath(output_filepath, part):
+    '''Returns the filepath of a numbered part of an output'''
+    stem, extension = os.path.splitext(output_filepath)
+    return "{} part {}{}".format(stem, part, extension)
+
+
+class Partitioner(object):
+    '''Splits rows into consecutive parts of at most partition_rows rows
+
+    parts() yields an iterator of rows for each part. Each one has to be
+    used up before the next one is asked for. counts holds how many rows
+    went into each part
+    '''
+
+    def __init__(self, rows, partition_rows):
+        self.rows = iter(rows)
+        self.partition_rows = partition_rows
+        self.counts = []
+        self.pending = None
+
+    def parts(self):
+        self.pending = next(self.rows, None)
+        # an empty resource still gets one, empty, part
+        if self.pending is None:
+            self.counts.append(0)
+            yield iter([])
+        while self.pending is not None:
+            self.counts.append(0)
+            yield self._part()
+
+    def _part(self):
+        while (self.pending is not None
+               and self.counts[-1] < self.partition_rows):
+            self.counts[-1] += 1
+            yield self.pending
+            self.pending = next(self.rows, None)
+
+
+def write_partition_index(output_filepath, part_filepaths, counts):
+    '''Writes a json index of the parts an output was split into,
+    and returns what to_file outputs for it
+
+    Each part is listed with the offset of its first row and its row count
+    '''
+    stem, extension = os.path.splitext(output_filepath)
+    index_filepath = "{} {} index.json".format(stem, extension[1:])
+
+    parts = []
+    offset = 0
+    for filepath, rows in zip(part_filepaths, counts):
+        parts.append({
+            "file": os.path.basename(filepath),
+            "offset": offset,
+            "rows": rows,
+            "bytes": os.path.getsize(filepath),
+        })
+        offset += rows
+
+    with codecs.open(index_filepath, "w", encoding="utf-8") as f:
+        json.dump({"rows": offset, "parts": parts}, f, indent=2)
+
+    return {"index": index_filepath, "parts": part_filepaths}
+
+
+# digests of the files open_output wrote, until file_digest picks them up
+_written_digests = {}
+_written_digests_lock = threading.Lock()
+
+# bundles that outputs are streamed into, by the folder of their outputs
+_streaming_bundles = {}
+_streaming_bundles_lock = threading.Lock()
+
+
+class _DigestFile(io.RawIOBase):
+    '''A file that hashes and counts the bytes written to it, and
+    streams them into a bundle entry too, if it's given one'''
+
+    def __init__(self, filepath, entry=None):
+        self.filepath = filepath
+        self.file = open(filepath, "wb")
+        self.entry = entry
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.bytes += len(data)
+        if self.entry:
+            self.entry.write(data)
+        return self.file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            if self.entry:
+                self.entry.close()
+            with _written_digests_lock:
+                _written_digests[self.filepath] = {
+                    "bytes": self.bytes,
+                    "md5": self.md5.hexdigest(),
+                    "sha256": self.sha256.hexdigest(),
+                }
+        super().close()
+
+
+def open_output(filepath, binary=False, stream=True):
+    '''Opens an output file to write, as utf-8 text with no newline
+    translation, or as bytes
+
+    What's written is hashed on its way to the disk, so file_digest
+    doesn't have to read the file back. If a bundle is streaming the
+    outputs of the file's folder, it's written into the archive too, so
+    Bundle.add doesn't have to read it back either
+    '''
+    entry = None
+    if stream:
+        with _streaming_bundles_lock:
+            bundle = _streaming_bundles.get(os.path.dirname(filepath), None)
+        if bundle:
+            entry = bundle.open_entry(filepath)
+    buffered = io.BufferedWriter(_DigestFile(filepath, entry), 1024 * 1024)
+    if binary:
+        return buffered
+    return io.TextIOWrapper(buffered, encoding="utf-8", newline="")
+
+
+def file_digest(filepath):
+    '''Returns the name, size, md5 and sha256 of a finished file
+
+    Files written with open_output were hashed as they were written.
+    Others, ex: the ones GDAL, SQLite or zipfile write, are read once,
+    right after they're written, while they're still in the disk cache
+    '''
+    with _written_digests_lock:
+        digest = _written_digests.pop(filepath, None)
+    if digest is None or digest["bytes"] != os.path.getsize(filepath):
+        md5, sha256, size = hashlib.md5(), hashlib.sha256(), 0
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        digest = {
+            "bytes": size,
+            "md5": md5.hexdigest(),
+            "sha256": sha256.hexdigest(),
+        }
+    return dict(digest, file=os.path.basename(filepath))
+
+
+def forget_digests(dir_path):
+    '''Drops the digests of files under dir_path nobody picked up, and
+    any bundle left streaming there by a failed export'''
+    with _written_digests_lock:
+        for filepath in list(_written_digests.keys()):
+            if filepath.startswith(dir_path):
+                del _written_digests[filepath]
+    with _streaming_bundles_lock:
+        for path in list(_streaming_bundles.keys()):
+            if path.startswith(dir_path):
+                del _streaming_bundles[path]
+
+
+def count_rows(rows, counter):
+    '''Passes rows through, counting them with an itertools.count
+
+    next(counter) is the number of rows once they're used up
+    '''
+    # zip stops at the end of rows before it takes from counter
+    return map(operator.itemgetter(0), zip(rows, counter))
+
+
+def add_to_manifest(manifest, output, rows):
+    '''Adds the to_file outputs not in the manifest yet to it
+
+    Each output gets the size, md5 and sha256 of its file, and its number
+    of rows. Partitioned outputs get them for each of their parts, and
+    for their index
+    '''
+    for key, value in output.items():
+        if key in manifest:
+            continue
+        if isinstance(value, dict):
+            with codecs.open(value["index"], "r", encoding="utf-8") as f:
+                index = json.load(f)
+            manifest[key] = {
+                "rows": index["rows"],
+                "index": file_digest(value["index"]),
+                "parts": [
+                    dict(file_digest(filepath), rows=part["rows"])
+                    for filepath, part in zip(value["parts"], index["parts"])
+                ],
+            }
+        else:
+            manifest[key] = dict(file_digest(value), rows=rows)
+    return manifest
+
+
+def load_gdal():
+    '''Imports fiona, and with it GDAL and PROJ, if it isn't yet,
+    and returns it'''
+    global fiona, from_epsg, transform_geom
+    if fiona is None:
+        with _gdal_lock:
+            if fiona is None:
+                import fiona as fiona_module
+                import fiona.crs as fiona_crs
+                import fiona.transform as fiona_transform
+                from_epsg = fiona_crs.from_epsg
+                transform_geom = fiona_transform.transform_geom
+                # set last, so other threads never see it half loaded
+                fiona = fiona_module
+    return fiona
+
+
+def preload_gdal():
+    '''Loads GDAL and PROJ, and PROJ's database, ahead of the first
+    spatial export
+
+    Set ckanext.iotrans.preload_gdal on workers dedicated to exports,
+    so their first export doesn't pay for it
+    '''
+    load_gdal()
+    transform_geom(
+        from_epsg(4326), from_epsg(2952),
+        {"type": "Point", "coordinates": [-79.38, 43.65]},
+    )
+
+
+def get_scratch_path():
+    '''Returns where to_file writes the dump and outputs
+
+    ckanext.iotrans.scratch_path if set - ex: a local disk, when
+    ckan.storage_path is a network filesystem - else ckan.storage_path
+    '''
+    return config.get("ckanext.iotrans.scratch_path", None) or config.get(
+        "ckan.storage_path"
+    )
+
+
+def publish_outputs(output, dir_path):
+    '''Moves the files of to_file outputs into dir_path, and returns
+    the outputs with their new filepaths
+
+    Each file is renamed into place, or copied next to its place and then
+    renamed if it's on another filesystem, so a file in dir_path is
+    always a finished one
+    '''
+    def publish(filepath):
+        published = os.path.join(dir_path, os.path.basename(filepath))
+        try:
+            os.replace(filepath, published)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            partial = os.path.join(
+                dir_path, "." + os.path.basename(filepath) + ".partial"
+            )
+            shutil.copyfile(filepath, partial)
+            os.replace(partial, published)
+            os.remove(filepath)
+        return published
+
+    published = {}
+    for key, value in output.items():
+        if key == "manifest":
+            published[key] = value
+        elif isinstance(value, dict):
+            published[key] = {
+                "index": publish(value["index"]),
+                "parts": [publish(filepath) for filepath in value["parts"]],
+            }
+        else:
+            published[key] = publish(value)
+            # a profile's summary is next to it
+            if key == "profile":
+                publish(value[:-len("prof")] + "txt")
+    return published
+
+
+def output_filepaths(output_value):
+    '''Returns the files of one to_file output, parts and index included'''
+    if isinstance(output_value, dict):
+        return output_value["parts"] + [output_value["index"]]
+    return [output_value]
+
+
+class Bundle(object):
+    '''A zip or tar archive outputs are added to as soon as they're written
+
+    Files are copied into the archive as they are - zip entries are
+    stored, not compressed, and tar archives aren't compressed. While the
+    bundle is streaming, outputs written with open_output go into the
+    archive as they're written instead, one at a time, and aren't copied.
+    The archive is only opened while files are added to it
+    '''
+
+    def __init__(self, filepath, bundle_format):
+        self.filepath = filepath
+        self.format = bundle_format
+        self.added = set()
+        self.entry = None
+        # where the next tar member goes, over the end of archive blocks
+        self.tar_end = 0
+        # a bundle of nothing is still a valid, empty archive
+        if self.format == "zip":
+            zipfile.ZipFile(self.filepath, "w").close()
+        else:
+            tarfile.open(self.filepath, "w").close()
+
+    def stream(self):
+        '''Streams outputs written in the bundle's folder into the archive,
+        until the next add'''
+        with _streaming_bundles_lock:
+            _streaming_bundles[os.path.dirname(self.filepath)] = self
+
+    def open_entry(self, filepath):
+        '''Returns an archive entry to write filepath's bytes to, or None
+        if another file is being streamed into the archive'''
+        if self.entry or filepath in self.added or filepath == self.filepath:
+            return None
+        if self.format == "zip":
+            self.entry = _ZipEntry(self, filepath)
+        else:
+            self.entry = _TarEntry(self, filepath)
+        return self.entry
+
+    def entry_closed(self, filepath):
+        self.entry = None
+        self.added.add(filepath)
+
+    def add(self, output):
+        '''Adds the files of to_file outputs not in the archive yet, and
+        stops streaming'''
+        with _streaming_bundles_lock:
+            if _streaming_bundles.get(os.path.dirname(self.filepath)) is self:
+                del _streaming_bundles[os.path.dirname(self.filepath)]
+        filepaths = [
+            filepath
+            for value in output.values()
+            for filepath in output_filepaths(value)
+            if filepath not in self.added
+        ]
+        if not filepaths:
+            return
+
+        if self.format == "zip":
+            with zipfile.ZipFile(self.filepath, "a", zipfile.ZIP_STORED,
+                                 allowZip64=True) as archive:
+                for filepath in filepaths:
+                    archive.write(filepath, os.path.basename(filepath))
+        else:
+            with tarfile.open(self.filepath, "a") as archive:
+                for filepath in filepaths:
+                    archive.add(filepath, os.path.basename(filepath))
+                self.tar_end = archive.offset
+        self.added.update(filepaths)
+
+
+class _ZipEntry(object):
+    '''A stored zip entry, written as its file is'''
+
+    def __init__(self, bundle, filepath):
+        self.bundle = bundle
+        self.filepath = filepath
+        self.archive = zipfile.ZipFile(
+            bundle.filepath, "a", zipfile.ZIP_STORED, allowZip64=True
+        )
+        info = zipfile.ZipInfo(
+            os.path.basename(filepath), time.localtime(time.time())[:6]
+        )
+        info.external_attr = 0o644 << 16
+        # the size isn't known yet, so it could be over 4GB
+        self.file = self.archive.open(info, "w", force_zip64=True)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        self.archive.close()
+        self.bundle.entry_closed(self.filepath)
+
+
+class _TarEntry(object):
+    '''A tar member, written as its file is
+
+    Its header is written with no size first, and again once the size is
+    known - GNU headers take the same 512 bytes for any size
+    '''
+
+    def __init__(self, bundle, filepath):
+        self.bundle = bundle
+        self.filepath = filepath
+        self.info = tarfile.TarInfo(os.path.basename(filepath))
+        self.info.mtime = time.time()
+        self.info.mode = 0o644
+        self.offset = bundle.tar_end
+        self.file = open(bundle.filepath, "r+b")
+        self.file.seek(self.offset)
+        self.file.write(self.info.tobuf(tarfile.GNU_FORMAT))
+
+    def write(self, data):
+        self.file.write(data)
+        self.info.size += len(data)
+
+    def close(self):
+        self.file.write(tarfile.NUL * (-self.info.size % tarfile.BLOCKSIZE))
+        end = self.file.tell()
+        # two empty blocks end the archive, padded to a whole record
+        archive_end = end + 2 * tarfile.BLOCKSIZE
+        archive_end += -archive_end % tarfile.RECORDSIZE
+        self.file.write(tarfile.NUL * (archive_end - end))
+        self.file.truncate()
+        self.file.seek(self.offset)
+        self.file.write(self.info.tobuf(tarfile.GNU_FORMAT))
+        self.file.close()
+        self.bundle.tar_end = end
+        self.bundle.entry_closed(self.filepath)
+
+
+def estimate_export_cost(data_dict, context):
+    '''Estimates the cost of a to_file call from its datastore resource'''
+    datastore_resource = tk.get_action("datastore_search")(
+        context, dict(
+            datastore_query(data_dict),
+            resource_id=data_dict["resource_id"],
+            limit=0,
+            include_total=True,
+        )
+    )
+
+    target_formats = data_dict.get("target_formats", None) or []
+    if not isinstance(target_formats, list):
+        target_formats = [target_formats]
+    target_epsgs = data_dict.get("target_epsgs", None) or []
+    if not isinstance(target_epsgs, list):
+        target_epsgs = [target_epsgs]
+
+    return scheduler.estimate_cost(
+        datastore_resource["total"],
+        [field["id"] for field in datastore_resource["fields"]],
+        target_formats,
+        target_epsgs,
+    )
+
+
+def get_bulk_workers(requested=None):
+    '''Returns how many exports to_file_bulk may run at once
+
+    ckanext.iotrans.bulk_workers is the size of the shared export pool,
+    and caps how many workers a caller can ask for
+    '''
+    max_workers = int(config.get("ckanext.iotrans.bulk_workers", 4))
+    if requested in [None, ""]:
+        return max_workers
+
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        raise tk.ValidationError(
+            {"constraints": ["Input 'max_workers' needs to be an integer"]}
+        )
+    return max(1, min(requested, max_workers))
+
+
+def get_process_workers(name):
+    '''Returns how many processes an export can start for a step, set by
+    ckanext.iotrans.<name> - 1 by default, which starts none
+
+    Exports share the CPUs: with bulk_workers exports running at once,
+    each gets at most its share of them
+    '''
+    try:
+        workers = int(config.get("ckanext.iotrans." + name, 1) or 1)
+    except (TypeError, ValueError):
+        workers = 1
+    share = (os.cpu_count() or 1) // get_bulk_workers()
+    return max(1, min(workers, share))
+
+
+def get_gpkg_options(data_dict):
+    '''Returns GDAL config options to write a GeoPackage with
+
+    In bulk load mode, SQLite skips its rollback journal and fsyncs and gets
+    a bigger page cache - outputs are throwaway temp files until they're
+    done, so there is nothing to recover if a write dies halfway
+    GDAL builds the R-tree once the load is done in either mode
+    '''
+    bulk_load = data_dict.get("gpkg_bulk_load", None)
+    if bulk_load in [None, ""]:
+        bulk_load = config.get("ckanext.iotrans.gpkg_bulk_load", True)
+    if not tk.asbool(bulk_load):
+        return {}
+
+    return {
+        "OGR_SQLITE_JOURNAL": "OFF",
+        "OGR_SQLITE_SYNCHRONOUS": "OFF",
+        # in MB
+        "OGR_SQLITE_CACHE": int(
+            config.get("ckanext.iotrans.gpkg_cache_mb", 256)
+        ),
+    }
+
+
+def describe_error(error):
+    '''Makes a json serializable description of an error raised by to_file'''
+    if isinstance(error, tk.ValidationError):
+        return error.error_dict
+    return "{}: {}".format(type(error).__name__, str(error))
+
+
+# fiona writes shapefile attributes at these widths
+SHP_FIELD_WIDTHS = {"str": 80, "int": 18, "float": 24}
+
+# size of an output file before any rows are written to it
+EMPTY_OUTPUT_BYTES = {"gpkg": 98304}
+
+# archives to_file outputs can be bundled in
+BUNDLE_FORMATS = ["zip", "tar"]
+
+# formats to_file can write, for resources with and without a geometry
+SPATIAL_FORMATS = ["csv", "shp", "geojson", "geojsonseq", "gpkg", "mbtiles"]
+NONSPATIAL_FORMATS = ["csv", "json", "jsonl", "xml", "xlsx"]
+
+# .shp and .dbf files cant be bigger than 2GB
+SHP_MAX_BYTES = 2000000000
+
+# excel sheets hold 1,048,576 rows, header included,
+# and cells hold 32,767 characters
+XLSX_MAX_ROWS = 1048576
+XLSX_MAX_CHARACTERS = 32767
+# control characters excel refuses, like openpyxl's ILLEGAL_CHARACTERS_RE
+XLSX_ILLEGAL_CHARACTERS = re.compile(r"[\000-\010\013\014\016-\037]")
+
+# zip compressions shapefiles can be zipped with
+ZIP_COMPRESSIONS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+}
+# zstandard is new in python 3.14
+if hasattr(zipfile, "ZIP_ZSTANDARD"):
+    ZIP_COMPRESSIONS["zstd"] = zipfile.ZIP_ZSTANDARD
+
+_throughput_lock = threading.Lock()
+
+
+def get_throughput_filepath():
+    '''Returns where to_file keeps its throughput history'''
+    return os.path.join(
+        config.get("ckan.storage_path"), "iotrans", "throughput.json"
+    )
+
+
+def get_throughput_history():
+    '''Returns rows and seconds recorded so far for each output type'''
+    try:
+        with codecs.open(get_throughput_filepath(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def record_throughput(target_format, spatial, rows, seconds):
+    '''Adds a finished output to the throughput history
+
+    older runs are decayed, so the history follows this node's current speed
+    '''
+    key = target_format.lower() + ("-spatial" if spatial else "")
+    filepath = get_throughput_filepath()
+
+    with _throughput_lock:
+        history = get_throughput_history()
+        entry = history.get(key, {"rows": 0, "seconds": 0})
+        history[key] = {
+            "rows": entry["rows"] * 0.9 + rows,
+            "seconds": entry["seconds"] * 0.9 + seconds,
+        }
+
+        # write a new file and swap it in, so readers never see half of it
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath))
+        with codecs.open(fd, "w", encoding="utf-8") as f:
+            json.dump(history, f)
+        os.replace(tmp_filepath, filepath)
+
+
+def estimate_seconds(target_format, spatial, rows, history):
+    '''Estimates how long an output takes, or None if it was never timed'''
+    entry = history.get(target_format.lower() + ("-spatial" if spatial else ""))
+    if not entry or not entry["rows"]:
+        return None
+    return rows * entry["seconds"] / entry["rows"]
+
+
+def _count_coordinates(coordinates):
+    '''Returns (number of points, number of parts) in nested coordinates'''
+    if not coordinates:
+        return 0, 0
+    if not isinstance(coordinates[0], (list, tuple)):
+        return 1, 0
+    if not isinstance(coordinates[0][0], (list, tuple)):
+        return len(coordinates), 1
+
+    points, parts = 0, 0
+    for part in coordinates:
+        part_points, part_parts = _count_coordinates(part)
+        points += part_points
+        parts += part_parts
+    return points, parts
+
+
+def estimate_output_sizes(records, fields, target_formats,
+                          source_epsg=None, target_epsgs=None,
+                          export_rows=None, tile_options=None,
+                          layer_name="sample", error_policy="fail"):
+    '''Estimates the bytes per row of the dump and each requested output
+
+    :param records: sample records from datastore_search
+    :param fields: datastore_search fields of the resource
+    :param target_formats: list of requested formats
+    :param source_epsg: source EPSG of the resource, if data is spatial
+    :param target_epsgs: list of requested EPSGs, if data is spatial
+    :param export_rows: rows to export, for outputs that don't grow with
+        them alone (mbtiles)
+    :param tile_options: get_tile_options of the export, for mbtiles
+    :param layer_name: name of the mbtiles layer
+    :param error_policy: to_file error_policy, for sample geometries that
+        can't be reprojected
+    :return: bytes per row, keyed like to_file outputs, plus "dump"
+    :rtype: dict
+    '''
+    fieldnames = [field["id"] for field in fields]
+    sizes = {}
+    if not records:
+        return sizes
+
+    def csv_bytes(rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(rows)
+        return len(buffer.getvalue().encode("utf-8"))
+
+    def per_row(total_bytes):
+        return total_bytes / len(records)
+
+    rows = [[record.get(fieldname) for fieldname in fieldnames]
+            for record in records]
+    sizes["dump"] = per_row(csv_bytes(rows))
+
+    if "geometry" not in fieldnames:
+        for target_format in target_formats:
+            key = str(target_format) + "-None"
+            if target_format.lower() == "csv":
+                sizes[key] = sizes["dump"]
+            elif target_format.lower() == "json":
+                sizes[key] = per_row(
+                    sum([len(json.dumps(record)) + 2 for record in records])
+                )
+            elif target_format.lower() == "jsonl":
+                sizes[key] = per_row(
+                    sum([len(json.dumps(record)) + 1 for record in records])
+                )
+            elif target_format.lower() == "xlsx":
+                # sheets are zipped xml - write the sample to see its size
+                from openpyxl import Workbook
+                to_cells = xlsx_converter([field["type"] for field in fields])
+                workbook = Workbook(write_only=True)
+                sheet = workbook.create_sheet("Data")
+                for row in rows:
+                    sheet.append(to_cells(
+                        ["" if value is None else str(value) for value in row]
+                    ))
+                buffer = io.BytesIO()
+                workbook.save(buffer)
+                sizes[key] = per_row(len(buffer.getvalue()))
+            elif target_format.lower() == "xml":
+                xml_bytes = 0
+                for i, row in enumerate(rows):
+                    xmlrow = ET.Element("ROW", count=str(i))
+                    for fieldname, value in zip(fieldnames, row):
+                        keyname = re.sub(r"[^a-zA-Z0-9-_]", "", fieldname)
+                        ET.SubElement(xmlrow, keyname).text = (
+                            "" if value is None else str(value)
+                        )
+                    xml_bytes += len(ET.tostring(xmlrow, encoding="utf-8"))
+                sizes[key] = per_row(xml_bytes)
+        return sizes
+
+    geometry_index = fieldnames.index("geometry")
+    dbf_bytes = 1 + sum([
+        SHP_FIELD_WIDTHS[fiona_type(field["type"])]
+        for field in fields if field["id"] != "geometry"
+    ])
+
+    def reproject(target_epsg):
+        '''Returns the sample geometries in target_epsg, with SKIPPED or
+        None for those that fail, as to_file would under error_policy'''
+        geometries = []
+        for row in rows:
+            try:
+                geometries.append(transform_epsg(
+                    source_epsg, target_epsg, row[geometry_index]
+                ))
+            except Exception:
+                if error_policy == "fail":
+                    raise
+                geometries.append(SKIPPED if error_policy == "skip" else None)
+        return geometries
+
+    # vector tiles are cut from a sample mbtiles, and scaled up to rows
+    for target_format in target_formats:
+        if target_format.lower() != "mbtiles":
+            continue
+        features = [
+            {
+                "type": "Feature",
+                "properties": {
+                    fieldname: value for fieldname, value
+                    in zip(fieldnames, row) if fieldname != "geometry"
+                },
+                "geometry": geometry,
+            }
+            for row, geometry in zip(rows, reproject(4326))
+            if geometry is not SKIPPED
+        ]
+        options = dict(tile_options or {})
+        options.pop("workers", None)
+        total_rows = max(export_rows or 0, len(records))
+        scratch_path = tempfile.mkdtemp(dir=get_scratch_path())
+        try:
+            sizes["{}-{}".format(target_format, tiles.EPSG)] = (
+                tiles.estimate_mbtiles_bytes(
+                    scratch_path, features, len(records), total_rows,
+                    layer_name, **options
+                ) / total_rows
+            )
+        finally:
+            shutil.rmtree(scratch_path, ignore_errors=True)
+
+    for target_epsg in target_epsgs or []:
+        geometries = reproject(target_epsg)
+        # skipped rows aren't in the outputs, so they add no bytes
+        epsg_rows = [row for row, geometry in zip(rows, geometries)
+                     if geometry is not SKIPPED]
+        geometries = [geometry for geometry in geometries
+                      if geometry is not SKIPPED]
+        property_bytes = per_row(
+            csv_bytes([row[:geometry_index] + row[geometry_index + 1:]
+                       for row in epsg_rows])
+        )
+        geometry_json = [
+            _geometry_to_json(geometry) if geometry else ""
+            for geometry in geometries
+        ]
+        counts = [
+            _count_coordinates(geometry["coordinates"]) if geometry else (0, 0)
+            for geometry in geometries
+        ]
+
+        for target_format in target_formats:
+            key = "{}-{}".format(target_format, target_epsg)
+            if target_format.lower() == "csv":
+                sizes[key] = per_row(csv_bytes([
+                    row[:geometry_index] + [geometry] + row[geometry_index + 1:]
+                    for row, geometry in zip(epsg_rows, geometry_json)
+                ]))
+            elif target_format.lower() in ["geojson", "geojsonseq"]:
+                # properties are written as json, geometry with spaced brackets
+                sizes[key] = per_row(sum([
+                    len(json.dumps(properties)) + len(geometry) + 60 +
+                    4 * points + 2 * parts
+                    for properties, geometry, (points, parts) in zip(
+                        [{fieldname: value for fieldname, value
+                          in zip(fieldnames, row) if fieldname != "geometry"}
+                         for row in epsg_rows],
+                        geometry_json,
+                        counts,
+                    )
+                ]))
+            elif target_format.lower() == "gpkg":
+                # wkb geometry, envelope, attributes and rtree/sqlite overhead
+                sizes[key] = property_bytes + per_row(sum([
+                    8 + 32 + 9 + 9 * parts + 21 * points + 60
+                    for points, parts in counts
+                ]))
+            elif target_format.lower() == "shp":
+                # .shp record, .shx entry and fixed width .dbf record
+                sizes[key] = per_row(sum([
+                    dbf_bytes + 8 + 44 + 4 * parts + 16 * points + 8
+                    for points, parts in counts
+                ]))
+
+    return sizes
+
+
+def write_profile(profiler, dir_path, resource_name):
+    '''Saves a to_file profile next to its outputs, returns its filepath
+
+    a .txt summary of the slowest functions is written next to the
+    .prof file, which can be loaded with pstats, snakeviz, etc
+    '''
+    profile_filepath = create_filepath(
+        dir_path, resource_name + " profile", None, "prof"
+    )
+    profiler.dump_stats(profile_filepath)
+
+    with codecs.open(
+        profile_filepath[:-len("prof")] + "txt", "w", encoding="utf-8"
+    ) as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats("cumulative").print_stats(50)
+        stats.sort_stats("tottime").print_stats(50)
+
+    return profile_filepath
+
+
+def write_to_csv(dump_filepath, fieldnames, rows_generator, index=False):
+    '''Streams rows (tuples or lists in the order of fieldnames)
+    into a CSV file
+
+    With index, returns the byte offset of every DUMP_RANGE_ROWS-th row -
+    rows can have line breaks, so they can't be found after the fact
+    '''
     csv.field_size_limit(sys.maxsize)
     
-    with codecs.open(dump_filepath, "w", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames)
-        writer.writeheader()
-        writer.writerows(rows_generator)
-        f.close()
-
-
-def write_to_zipped_shapefile(fieldnames, dir_path,
-                              resource_metadata, output_filepath, col_map):
-    '''Zips shp component files together with optional colname mapping csv'''
-
-    # put a mapping of full names to truncated names into a csv
-    fields_filepath = dir_path + "/" + resource_metadata["name"]+" fields.csv"
-    with codecs.open(fields_filepath, "w", encoding="utf-8") as fields_file:
-        writer = csv.DictWriter(fields_file, fieldnames=["field", "name"])
-        writer.writeheader()
-        for fieldname in [
-            fieldname for fieldname in fieldnames if fieldname != "geometry"
-        ]:
-            writer.writerow({"field": col_map[fieldname], "name": fieldname})
-
-    # put shapefile components into a .zip
-    output_filepath = output_filepath.replace(".shp", ".zip")
-    with ZipFile(output_filepath, "w") as zipfile:
-        shp_components = ["shp", "cpg", "dbf", "prj", "shx"]
+    with open_output(dump_filepath) as f:
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        if not index:
+            writer.writerows(rows_generator)
+            return None
+
+        offsets = []
+        for i, row in enumerate(rows_generator):
+            if not i % DUMP_RANGE_ROWS:
+                # everything before the row has to reach the file
+                f.flush()
+                offsets.append(f.buffer.raw.bytes)
+            writer.writerow(row)
+    return offsets
+
+
+def _round_up(number):
+    '''adds 1 to the last digit of a formatted number, carrying over 9s'''
+    digits = list(number)
+    i = len(digits) - 1
+    while i >= 0 and digits[i] != "-":
+        if digits[i] == "9":
+            digits[i] = "0"
+        elif digits[i] != ".":
+            digits[i] = chr(ord(digits[i]) + 1)
+            return "".join(digits)
+        i -= 1
+    digits.insert(i + 1, "1")
+    return "".join(digits)
+
+
+def _trim_round_off(number):
+    '''drops trailing 00000x and 99999x round off noise from a
+    formatted number, the same way GDAL does'''
+    dot = number.find(".")
+    if len(number) <= 10 or dot < 0:
+        return number
+    # digits before the dot. Big numbers can have fewer noise digits
+    before = dot - 1 - (number[0] == "-")
+
+    if number[-6:-1] == "00000":
+        return number[:-1]
+    if (dot < len(number) - 8 and number[-9:-7] == "00"
+            and all([before >= i or number[1 - i] == "0"
+                     for i in range(4, 9)])):
+        return number[:-8]
+    if number[-6:-1] == "99999":
+        return _round_up(number[:-6])
+    if (dot < len(number) - 9 and number[-9:-7] == "99"
+            and all([before >= i or number[1 - i] == "9"
+                     for i in range(4, 9)])):
+        return _round_up(number[:-9])
+    return number
+
+
+def _geojson_coordinate(value):
+    '''formats a coordinate like GDAL's GeoJSON driver: 15 decimals,
+    without round off noise or trailing zeros'''
+    if abs(value) > 1e50:
+        return "%.18g" % value
+    number = "%.15f" % value
+    # only numbers ending in runs of 0s or 9s can hold round off noise
+    if number[-9:-7] in ["00", "99"] or number[-6:-1] in ["00000", "99999"]:
+        number = _trim_round_off(number)
+    number = number.rstrip("0")
+    return number + "0" if number[-1] == "." else number
 
-        for file in os.listdir(dir_path):
-            if (
-                file[-3:] in shp_components
-                or file == resource_metadata["name"] + " fields.csv"
+
+def _rounded_coordinate(precision):
+    '''returns a coordinate formatter for coordinates rounded to
+    precision decimal places, like GDAL's COORDINATE_PRECISION option'''
+    template = "%.{}f".format(precision)
+
+    def format_coordinate(value):
+        number = template % value
+        if "." in number:
+            number = number.rstrip("0")
+        return number + "0" if number[-1] == "." else number
+
+    return format_coordinate
+
+
+def _geojson_coordinates(coordinates, format_coordinate=_geojson_coordinate):
+    '''formats nested coordinates like GDAL's GeoJSON driver'''
+    if not coordinates:
+        return "[ ]"
+    first = coordinates[0]
+    if not isinstance(first, (list, tuple)):
+        return "[ " + ", ".join(map(format_coordinate, coordinates)) + " ]"
+    # most of the work is in lists of positions, so they get a fast path
+    if first and not isinstance(first[0], (list, tuple)):
+        return "[ [ " + " ], [ ".join(
+            [", ".join(map(format_coordinate, position))
+             for position in coordinates]
+        ) + " ] ]"
+    return "[ " + ", ".join(
+        [_geojson_coordinates(part, format_coordinate) for part in coordinates]
+    ) + " ]"
+
+
+def _close_rings(polygons):
+    '''closes each ring of a list of polygons by repeating its first
+    position at its end, like OGR does before GDAL writes a polygon'''
+    return [
+        [list(ring) + [ring[0]]
+         if len(ring) > 1 and list(ring[0]) != list(ring[-1]) else ring
+         for ring in polygon]
+        for polygon in polygons
+    ]
+
+
+def _geojson_string(value):
+    # GDAL strings are C strings - they end at the first NUL
+    return json.dumps(value.split("\x00")[0], ensure_ascii=False)
+
+
+def _geojson_float(value):
+    '''formats a float property like GDAL's GeoJSON driver: 17
+    significant digits, or fewer if that hides round off noise'''
+    if value != value:
+        return "NaN"
+    if value in [float("inf"), float("-inf")]:
+        return "Infinity" if value > 0 else "-Infinity"
+
+    number = "%.17g" % value
+    if "." in number and re.search("999999|000000", number.split(".")[1]):
+        for precision in [16, 15, 14]:
+            shorter = "%.{}g".format(precision) % value
+            if "." in shorter and not re.search(
+                "999999|000000", shorter.split(".")[1]
             ):
-                zipfile.write(dir_path + "/" + file, arcname=file)
-                os.remove(dir_path + "/" + file)
+                number = shorter
+                break
+    if "." not in number and "e" not in number:
+        number += ".0"
+    return number
 
-    return output_filepath
 
+def _geojson_value(value):
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        return _geojson_string(value)
+    if isinstance(value, float):
+        return _geojson_float(value)
+    return str(value)
 
-def write_to_json(dump_filepath, output_filepath, datastore_resource, context):
-    '''Stream into a JSON file by running datastore_search over and over'''
-    with codecs.open(output_filepath, "w", encoding="utf-8") as jsonfile:
-        # write starting bracket
-        jsonfile.write("[")
 
-        # grab first chunk of records
-        chunk_size = 20000
-        iteration = 0
-        data_chunk = tk.get_action("datastore_search")(
-            context, {
-                "resource_id": datastore_resource["resource_id"],
-                "limit": chunk_size,
-                }
+def geojson_crs_name(epsg):
+    '''Returns the name GDAL gives an EPSG in a GeoJSON "crs" member'''
+    if int(epsg) == 4326:
+        return "urn:ogc:def:crs:OGC:1.3:CRS84"
+    return "urn:ogc:def:crs:EPSG::{}".format(epsg)
+
+
+def _geojson_features(features, precision=None):
+    '''Yields the GeoJSON text of each feature, as GDAL writes them'''
+    format_coordinate = _geojson_coordinate
+    if precision is not None:
+        format_coordinate = _rounded_coordinate(precision)
+    keys = {}
+    for feature in features:
+        properties = []
+        for key, value in feature["properties"].items():
+            if key not in keys:
+                keys[key] = _geojson_string(key) + ": "
+            properties.append(keys[key] + _geojson_value(value))
+
+        geometry = feature["geometry"]
+        if geometry is None:
+            geometry = "null"
+        else:
+            coordinates = geometry["coordinates"]
+            if geometry["type"] == "MultiPolygon":
+                coordinates = _close_rings(coordinates)
+            elif geometry["type"] == "Polygon":
+                coordinates = _close_rings([coordinates])[0]
+            geometry = '{{ "type": "{}", "coordinates": {} }}'.format(
+                geometry["type"],
+                _geojson_coordinates(coordinates, format_coordinate),
+            )
+
+        yield (
+            '{{ "type": "Feature", "properties": {}, "geometry": {} }}'
+        ).format(
+            "{ " + ", ".join(properties) + " }" if properties else "{ }",
+            geometry,
+        )
+
+
+def write_to_geojson(output_filepath, features, target_epsg, precision=None):
+    '''Streams features from dump_to_geospatial_generator
+    into a GeoJSON FeatureCollection
+
+    Output is byte for byte what fiona and GDAL's GeoJSON driver write,
+    without building OGR features out of each row first. Coordinates
+    rounded by round_geometry are written with at most precision decimals
+    '''
+    header = (
+        '{{\n"type": "FeatureCollection",\n"name": {},\n'
+        '"crs": {{ "type": "name", "properties": {{ "name": "{}" }} }},\n'
+        '"features": [\n'
+    ).format(
+        _geojson_string(os.path.splitext(os.path.basename(output_filepath))[0]),
+        geojson_crs_name(target_epsg),
+    )
+
+    with open_output(output_filepath) as f:
+        f.write(header)
+        separator = ""
+        for feature in _geojson_features(features, precision):
+            f.write(separator)
+            f.write(feature)
+            separator = ",\n"
+        f.write("\n]\n}\n")
+
+
+def write_to_geojsonseq(output_filepath, features, precision=None):
+    '''Streams features from dump_to_geospatial_generator
+    into a GeoJSON text sequence, one feature per line
+
+    Lines are written as they come and nothing is closed at the end,
+    so files can be appended to, and read back, a line at a time
+    '''
+    with open_output(output_filepath) as f:
+        for feature in _geojson_features(features, precision):
+            f.write(feature)
+            f.write("\n")
+
+
+def get_zip_compression(data_dict):
+    '''Returns the zipfile compression to zip shapefiles with
+
+    Set by the shp_compression input of to_file, or by
+    ckanext.iotrans.shp_compression. Defaults to "stored" (no compression)
+    '''
+    compression = data_dict.get("shp_compression", None) or config.get(
+        "ckanext.iotrans.shp_compression", "stored"
+    )
+    if str(compression).lower() not in ZIP_COMPRESSIONS.keys():
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'shp_compression' must be in the following: "
+                    "{}".format(", ".join(ZIP_COMPRESSIONS.keys()))
+                ]
+            }
+        )
+    return ZIP_COMPRESSIONS[str(compression).lower()]
+
+
+def get_tile_options(data_dict):
+    '''Returns how to build mbtiles outputs, as inputs of
+    tiles.write_to_mbtiles
+
+    Set by the tile_* inputs of to_file, or by the ckanext.iotrans.tile_*
+    config. Tiles are cut by ckanext.iotrans.tile_workers processes,
+    see get_process_workers
+    '''
+    def option(name, default, cast):
+        value = data_dict.get(name, None)
+        if value is None:
+            value = config.get("ckanext.iotrans." + name, default)
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            raise tk.ValidationError(
+                {"constraints": ["Input '{}' needs to be a number".format(name)]}
             )
-        # as long as there is more to grab, grab the next chunk
-        while len(data_chunk["records"]):
-
-            for record in data_chunk["records"]:
-                jsonfile.write(json.dumps(record))
-                jsonfile.write(", ")
-            iteration += 1
-            data_chunk = tk.get_action("datastore_search")(
-                context, {
-                    "resource_id": datastore_resource["resource_id"],
-                    "limit": chunk_size,
-                    "offset": chunk_size*iteration,
-                    }
+
+    options = {
+        "min_zoom": option("tile_min_zoom", 0, int),
+        "max_zoom": option("tile_max_zoom", 14, int),
+        "simplify": option("tile_simplify", 1, float),
+        "drop_rate": option("tile_drop_rate", 2.5, float),
+        "workers": get_process_workers("tile_workers"),
+    }
+    if not 0 <= options["min_zoom"] <= options["max_zoom"] <= 24:
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Inputs 'tile_min_zoom' and 'tile_max_zoom' need to be "
+                    "zoom levels from 0 to 24, min first"
+                ]
+            }
+        )
+    if options["simplify"] < 0 or options["drop_rate"] < 1:
+        raise tk.ValidationError(
+            {
+                "constraints": [
+                    "Input 'tile_simplify' can't be negative, and "
+                    "'tile_drop_rate' can't be less than 1"
+                ]
+            }
+        )
+    return options
+
+
+def shapefile_record_bytes(geometry):
+    '''Returns how many bytes a geometry takes up in a .shp file
+
+    Unclosed polygon rings get closed when written, so polygons are counted
+    as if none of their rings were closed
+    '''
+    if not geometry:
+        return 12
+    points, parts = _count_coordinates(geometry["coordinates"])
+    if geometry["type"].endswith("Polygon"):
+        points += parts
+
+    if geometry["type"].endswith("Point"):
+        record_bytes = 48 + 16 * points
+    else:
+        record_bytes = 52 + 4 * parts + 16 * points
+
+    # 3D geometries store a z range and a z per point too
+    position = geometry["coordinates"]
+    while position and isinstance(position[0], (list, tuple)):
+        position = position[0]
+    if len(position) > 2:
+        record_bytes += 16 + 8 * points
+
+    return record_bytes
+
+
+def write_shapefile_parts(shapefile_path, schema, crs, features,
+                          max_bytes=None):
+    '''Writes features into a shapefile, and rolls over to a new part
+    before its .shp or .dbf file would grow past max_bytes
+
+    If the features need more than one part, each part is named
+    "<shapefile name> part <n>". Returns a list of (filepath, rows)
+    for each part
+    '''
+    max_bytes = int(
+        max_bytes or config.get("ckanext.iotrans.shp_max_bytes", SHP_MAX_BYTES)
+    )
+    dbf_record_bytes = 1 + sum(
+        [SHP_FIELD_WIDTHS[field_type]
+         for field_type in schema["properties"].values()]
+    )
+    stem = os.path.splitext(shapefile_path)[0]
+
+    features = iter(features)
+    pending = [next(features, None)]
+    parts = []
+
+    def part_features(part):
+        # yields features until the next one doesnt fit in this part
+        shp_bytes = 100
+        dbf_bytes = 34 + 32 * len(schema["properties"])
+        while pending[0] is not None:
+            shp_bytes += shapefile_record_bytes(pending[0]["geometry"])
+            dbf_bytes += dbf_record_bytes
+            # a part gets at least one feature, however big it is
+            if part["rows"] and max(shp_bytes, dbf_bytes) > max_bytes:
+                return
+            part["rows"] += 1
+            yield pending[0]
+            pending[0] = next(features, None)
+
+    while pending[0] is not None or not parts:
+        if len(parts) == 1:
+            # name the first part like the ones after it
+            shp_dir = os.path.dirname(shapefile_path)
+            for filename in os.listdir(shp_dir):
+                name, extension = os.path.splitext(filename)
+                if os.path.join(shp_dir, name) == stem:
+                    os.rename(
+                        os.path.join(shp_dir, filename),
+                        "{} part 1{}".format(stem, extension),
+                    )
+            parts[0]["filepath"] = "{} part 1.shp".format(stem)
+
+        part = {
+            "filepath": shapefile_path if not parts else "{} part {}.shp".format(
+                stem, len(parts) + 1
+            ),
+            "rows": 0,
+        }
+        with load_gdal().open(
+            part["filepath"],
+            "w",
+            schema=schema,
+            driver="ESRI Shapefile",
+            crs=crs,
+        ) as outlayer:
+            outlayer.writerecords(part_features(part))
+        parts.append(part)
+
+    return [(part["filepath"], part["rows"]) for part in parts]
+
+
+def write_to_zipped_shapefile(fieldnames, resource_metadata, shapefile_path,
+                              output_filepath, col_map,
+                              compression=zipfile.ZIP_STORED, parts=None):
+    '''Zips shp component files together with a colname mapping csv
+
+    shapefile_path must be in a directory of its own: every file in it is
+    moved into the zip. If the shapefile was split into parts by
+    write_shapefile_parts, a manifest csv of those parts is zipped too.
+    Returns the filepath of the zip
+    '''
+
+    output_filepath = output_filepath.replace(".shp", ".zip")
+    shp_dir = os.path.dirname(shapefile_path)
+    components = sorted(os.listdir(shp_dir))
+    with zipfile.ZipFile(output_filepath, "w", compression) as archive:
+        # stream each component into the zip, and drop it once its in
+        for component in components:
+            archive.write(os.path.join(shp_dir, component), arcname=component)
+            os.remove(os.path.join(shp_dir, component))
+
+        # put a mapping of full names to truncated names into a csv
+        fields_name = resource_metadata["name"] + " fields.csv"
+        with archive.open(fields_name, "w") as entry:
+            with io.TextIOWrapper(entry, encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["field", "name"])
+                writer.writerows(
+                    [[col_map[fieldname], fieldname]
+                     for fieldname in fieldnames if fieldname != "geometry"]
                 )
 
-    with codecs.open(output_filepath, "rb+", encoding="utf-8") as jsonfile:
-        # remove last ", "
-        jsonfile.seek(-2, 2)
-        jsonfile.truncate()
+        # list the parts, in order, for whoever has to put them back together
+        if parts and len(parts) > 1:
+            manifest_name = os.path.basename(
+                os.path.splitext(output_filepath)[0]
+            ) + " manifest.csv"
+            with archive.open(manifest_name, "w") as entry:
+                with io.TextIOWrapper(entry, encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(["part", "shapefile", "rows"])
+                    writer.writerows(
+                        [[i, os.path.basename(filepath), rows]
+                         for i, (filepath, rows) in enumerate(parts, 1)]
+                    )
+
+    return output_filepath
+
+
+def write_to_json(dump_filepath, output_filepath, datastore_resource, context,
+                  progress=None, records=None):
+    '''Stream into a JSON file by running datastore_search over and over
+
+    records from datastore_records can be given instead, to write only
+    some of the resource
+    '''
+    if records is None:
+        records = datastore_records(
+            datastore_resource["resource_id"], context, progress
+        )
 
-    with codecs.open(output_filepath, "a", encoding="utf-8") as jsonfile:
+    with open_output(output_filepath) as jsonfile:
+        # write starting bracket
+        jsonfile.write("[")
+        separator = ""
+        for record in records:
+            jsonfile.write(separator)
+            jsonfile.write(json.dumps(record))
+            separator = ", "
         # add last closing ]
         jsonfile.write("]")
 
 
-def write_to_xml(dump_filepath, output_filepath):
-    '''Stream into an XML file'''
+def write_to_jsonl(output_filepath, records):
+    '''Streams records from datastore_records into a JSON Lines file,
+    one JSON object per line'''
+
+    with open_output(output_filepath) as jsonlfile:
+        for record in records:
+            jsonlfile.write(json.dumps(record))
+            jsonlfile.write("\n")
+
+
+def write_to_xml(dump_filepath, output_filepath, progress=None, rows=None,
+                 start=0):
+    '''Stream into an XML file
+
+    rows of the dump can be given instead, to write only some of them.
+    start is the count of the first row
+    '''
 
-    with codecs.open(dump_filepath, "r", encoding="utf-8") as csvfile:
-        dictreader = csv.DictReader(csvfile)
+    with open(dump_filepath, "r", encoding="utf-8", newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        # element names are made from the header once
+        keynames = [re.sub(r"[^a-zA-Z0-9-_]","",key) for key in next(reader)]
         root = ET.Element("DATA")
-        i = 0
-        for csvrow in dictreader:
+        for i, csvrow in enumerate(reader if rows is None else rows, start):
+            if progress and not i % REPORT_EVERY:
+                progress.update(i)
             xmlrow = ET.SubElement(root, "ROW", count = str(i))
-            i+=1
-            for key, value in csvrow.items():
-                keyname = re.sub(r"[^a-zA-Z0-9-_]","",key)
+            for keyname, value in zip(keynames, csvrow):
                 ET.SubElement(xmlrow, keyname).text = value
         tree = ET.ElementTree(root)
-        tree.write(output_filepath, encoding='utf-8', xml_declaration=True)            
+        with open_output(output_filepath, binary=True) as xmlfile:
+            tree.write(xmlfile, encoding='utf-8', xml_declaration=True)
+
+
+def write_to_xlsx(dump_filepath, output_filepath, fields, progress=None,
+                  rows=None, start=0, max_rows=XLSX_MAX_ROWS):
+    '''Stream into an excel workbook, in write only mode
+
+    rows go to a new sheet, under a copy of the header, each time a sheet
+    reaches max_rows rows. rows of the dump can be given instead, to write
+    only some of them. start is the count of the first row
+    '''
+    # only xlsx exports need openpyxl
+    from openpyxl import Workbook
+
+    types = {field["id"]: field["type"] for field in fields}
+
+    with open(dump_filepath, "r", encoding="utf-8", newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        to_cells = xlsx_converter([types.get(key, "text") for key in header])
+
+        workbook = Workbook(write_only=True)
+        sheet = None
+        sheet_rows = max_rows
+        for i, csvrow in enumerate(reader if rows is None else rows, start):
+            if progress and not i % REPORT_EVERY:
+                progress.update(i)
+            if sheet_rows == max_rows:
+                sheet = workbook.create_sheet(
+                    "Data {}".format(len(workbook.worksheets) + 1)
+                    if workbook.worksheets else "Data"
+                )
+                sheet.freeze_panes = "A2"
+                sheet.append(header)
+                sheet_rows = 1
+            sheet.append(to_cells(csvrow))
+            sheet_rows += 1
+
+        # a workbook needs a sheet, even if there are no rows
+        if sheet is None:
+            sheet = workbook.create_sheet("Data")
+            sheet.append(header)
+        workbook.save(output_filepath)
+
+
+def read_dump(dump_filepath):
+    '''generator of the rows of a CSV dump, without its header'''
+    csv.field_size_limit(sys.maxsize)
+    with open(dump_filepath, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        yield from reader
 
 
 def iotrans_auth_function(context, data_dict=None):